@@ -0,0 +1,87 @@
+"""
+John F. Wu
+
+Gradient accumulation for fastai training runs.
+
+`GradientAccumulation` runs `n_steps` forward/backward passes (micro-
+batches of `--bs` images each) before every optimizer step, so the
+effective batch size is `n_steps * bs` while only one micro-batch of
+activations is held in memory. Together with `--checkpoint-stages` (see
+`CheckpointedStage` in `mxresnet.py`) this makes deep MXResNets trainable
+at large image sizes on machines with little memory.
+
+The callback returns `skip_step`/`skip_zero` from `on_backward_end` on
+all but the last micro-batch, so `Ranger.step` (and the decoupled weight
+decay of fastai's `OptimWrapper`) only runs once per effective batch.
+Ranger's per-group `step_counter`, and hence the lookahead sync every `k`
+steps, therefore counts optimizer steps, not micro-batches: `k=6` with
+`--accum-steps 4` syncs the slow weights every 24 micro-batches. The
+one-cycle schedule still advances per micro-batch, so the learning rate
+of each step is the one scheduled at its last micro-batch.
+
+The summed gradients are divided by the number of micro-batches, i.e. the
+step uses the mean of the per-micro-batch gradients. For the RMSE loss
+this is the gradient of the mean of the micro-batch RMSEs, which differs
+slightly from the RMSE of one large batch. A partial group at the end of
+an epoch is still stepped, with its own mean.
+
+Under `DistributedCPUTrainer` all but the last micro-batch of each group
+run inside `DistributedDataParallel.no_sync()`, so the gradients are
+all-reduced once per optimizer step rather than once per micro-batch.
+
+Mixed precision is not supported: fastai's `MixedPrecision` callback
+clears the fp16 gradients after every batch.
+"""
+
+from fastai.basic_train import LearnerCallback
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+
+class GradientAccumulation(LearnerCallback):
+    """Step the optimizer once every `n_steps` training batches."""
+
+    _order = -10  # before the timing and profiling callbacks
+
+    def __init__(self, learn, n_steps=2):
+        super().__init__(learn)
+        if n_steps < 1:
+            raise ValueError(f"n_steps must be positive, got {n_steps}")
+        self.n_steps = n_steps
+
+    def on_train_begin(self, **kwargs):
+        self.learn.opt.zero_grad()
+
+    def on_epoch_begin(self, **kwargs):
+        self.count = 0
+        self.no_sync = None
+
+    def _is_last(self, num_batch):
+        # a partial group at the end of the epoch is stepped before validation
+        return self.count + 1 >= self.n_steps or num_batch + 1 >= len(self.learn.data.train_dl)
+
+    def on_batch_begin(self, train, num_batch, **kwargs):
+        # DDP decides in the forward pass whether the backward all-reduces
+        if train and isinstance(self.learn.model, DistributedDataParallel) and not self._is_last(num_batch):
+            self.no_sync = self.learn.model.no_sync()
+            self.no_sync.__enter__()
+
+    def _average_grads(self):
+        with torch.no_grad():
+            for p in self.learn.model.parameters():
+                if p.grad is not None:
+                    p.grad.div_(self.count)
+
+    def on_backward_end(self, train, num_batch, **kwargs):
+        if not train:
+            return
+        last = self._is_last(num_batch)
+        self.count += 1
+        if self.no_sync is not None:
+            self.no_sync.__exit__(None, None, None)
+            self.no_sync = None
+        if not last:
+            return {"skip_step": True, "skip_zero": True}
+        self._average_grads()
+        self.count = 0
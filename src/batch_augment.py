@@ -0,0 +1,107 @@
+"""
+John F. Wu
+
+Batched, on-tensor data augmentation for fastai DataBunches.
+
+The training scripts' `get_transforms(do_flip=True, flip_vert=True,
+max_rotate=15.0, ...)` are applied item by item in the DataLoader
+workers. `BatchAugment` instead draws one random dihedral transform (as
+in fastai's `dihedral_affine`) and, with probability `p_rotate`, one
+rotation of up to `max_rotate` degrees per image, composes them into a
+single affine matrix, and resamples the whole collated batch with one
+`affine_grid`/`grid_sample` call. Normalization by the channel statistics
+is applied in the same step. `add_batch_tfms` attaches it to the training
+loader (and normalization alone to the validation loader).
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def dihedral_matrices(k, flip):
+    """(B, 2, 2) matrices of `k` quarter turns, preceded by a horizontal
+    flip where `flip` is True."""
+    angle = k.float() * (math.pi / 2)
+    c, s = torch.cos(angle).round(), torch.sin(angle).round()
+    rot = torch.stack([torch.stack([c, -s], -1), torch.stack([s, c], -1)], -2)
+    f = torch.ones_like(c) - 2 * flip.float()
+    return rot * torch.stack([f, torch.ones_like(f)], -1)[:, None, :]
+
+
+def rotation_matrices(degrees):
+    angle = degrees * (math.pi / 180)
+    c, s = torch.cos(angle), torch.sin(angle)
+    return torch.stack([torch.stack([c, -s], -1), torch.stack([s, c], -1)], -2)
+
+
+class BatchNormalize:
+    """Convert a uint8 or [0, 1] float batch to normalized floats."""
+
+    def __init__(self, stats=None):
+        self.stats = stats
+
+    def normalize(self, x):
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255)
+        if self.stats is not None:
+            mean, std = [s.to(x.device).view(1, -1, 1, 1) for s in self.stats]
+            x = (x - mean) / std
+        return x
+
+    def __call__(self, b):
+        x, y = b
+        return self.normalize(x), y
+
+
+class BatchAugment(BatchNormalize):
+    """Random flips, quarter turns and small rotations of a whole (B, C, H,
+    W) batch in one resampling pass, followed by normalization."""
+
+    def __init__(self, stats=None, max_rotate=15.0, p_rotate=0.75, do_flip=True, flip_vert=True,
+                 mode="bilinear", padding_mode="reflection"):
+        super().__init__(stats)
+        self.max_rotate, self.p_rotate = max_rotate, p_rotate
+        self.do_flip, self.flip_vert = do_flip, flip_vert
+        self.mode, self.padding_mode = mode, padding_mode
+
+    def affine(self, n, device):
+        """(n, 2, 3) random affine matrices for `F.affine_grid`."""
+        k = torch.zeros(n, device=device, dtype=torch.long)
+        flip = torch.zeros(n, device=device, dtype=torch.bool)
+        if self.do_flip:
+            flip = torch.rand(n, device=device) < 0.5
+            if self.flip_vert:
+                # all 8 symmetries of the square
+                k = torch.randint(0, 4, (n,), device=device)
+        m = dihedral_matrices(k, flip)
+
+        degrees = (torch.rand(n, device=device) * 2 - 1) * self.max_rotate
+        degrees = torch.where(torch.rand(n, device=device) < self.p_rotate, degrees, torch.zeros_like(degrees))
+        m = rotation_matrices(degrees) @ m
+
+        return torch.cat([m, torch.zeros(n, 2, 1, device=device)], dim=2)
+
+    def augment(self, x):
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255)
+        theta = self.affine(len(x), x.device).to(x.dtype)
+        grid = F.affine_grid(theta, x.shape, align_corners=False)
+        x = F.grid_sample(x, grid, mode=self.mode, padding_mode=self.padding_mode, align_corners=False)
+        return self.normalize(x)
+
+    def __call__(self, b):
+        x, y = b
+        return self.augment(x), y
+
+
+def add_batch_tfms(data, stats, **kwargs):
+    """Attach `BatchAugment` to the training loader of the (un-normalized)
+    DataBunch `data`, and normalization to the other loaders."""
+    data.train_dl.add_tfm(BatchAugment(stats, **kwargs))
+    for dl in [data.valid_dl, data.fix_dl, data.test_dl]:
+        if dl is not None:
+            dl.add_tfm(BatchNormalize(stats))
+    data.stats = stats
+    return data
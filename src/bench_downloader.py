@@ -0,0 +1,120 @@
+"""
+John F. Wu
+
+Offline throughput benchmark for `cutout_downloader.py`.
+
+Starts a local stand-in for the SkyServer/Legacy cutout services that
+serves fake JPEG bytes after a configurable latency, and occasionally
+answers 429/503 so that the retry path is exercised. The downloader is
+then run sequentially (one thread, like the old `itertuples()` loop) and
+concurrently, and the throughput of both is reported.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+import os
+import random
+import tempfile
+import threading
+import time
+
+from cutout_downloader import CutoutDownloader, Job
+
+
+class CutoutHandler(BaseHTTPRequestHandler):
+    """Serve fake cutouts with a fixed latency and random throttling."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    error_rate = 0.02
+    payload = b"\xff\xd8\xff\xe0" + os.urandom(20000) + b"\xff\xd9"
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            status = random.choice([429, 503])
+            self.send_response(status)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency=0.05, error_rate=0.02):
+    """Start the stand-in cutout service on a free local port and return
+    the server (call `server.shutdown()` when done)."""
+    handler = type(
+        "Handler", (CutoutHandler,), dict(latency=latency, error_rate=error_rate)
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def make_jobs(server, n, output):
+    host, port = server.server_address
+    return [
+        Job(
+            i,
+            f"http://{host}:{port}/ImgCutout/getjpeg"
+            f"?ra={random.uniform(0, 360)}&dec={random.uniform(-5, 35)}"
+            "&width=224&height=224",
+            f"{output}/{i}.jpg",
+        )
+        for i in range(n)
+    ]
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--n", dest="n", type=int, default=500, help="number of cutouts")
+    parser.add_option("--threads", dest="threads", type=int, default=16, help="concurrent threads")
+    parser.add_option("--rate", dest="rate", type=float, default=200, help="requests per second")
+    parser.add_option("--latency", dest="latency", type=float, default=0.05, help="server latency (s)")
+    parser.add_option("--error-rate", dest="error_rate", type=float, default=0.02, help="fraction of 429/503 answers")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    server = start_server(latency=opt.latency, error_rate=opt.error_rate)
+
+    results = {}
+    for label, n_threads in [("sequential", 1), ("concurrent", opt.threads)]:
+        with tempfile.TemporaryDirectory() as output:
+            jobs = make_jobs(server, opt.n, output)
+            downloader = CutoutDownloader(
+                n_threads=n_threads, rate=opt.rate, backoff=0.01
+            )
+            report = downloader.download(jobs, progress=False)
+            n_files = len(os.listdir(output))
+        results[label] = report
+        print(f"{label:>10}: {report.summary()} [{n_files} files written]")
+
+    server.shutdown()
+
+    speedup = results["concurrent"].images_per_sec / results["sequential"].images_per_sec
+    print(f"Speedup with {opt.threads} threads: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+John F. Wu
+
+Numerical equivalence and CPU latency of `optimize_for_inference` across
+mxresnet18-152.
+
+For each depth we randomize the BatchNorm statistics (so that folding is
+non-trivial), check that the optimized model and its frozen TorchScript
+export reproduce the original outputs, and report the median batch
+latency of all three.
+
+Usage:
+    python bench_inference.py --models 18,34,50,101,152 --bs 16 --sz 224
+"""
+
+from optparse import OptionParser
+import statistics
+import time
+
+import torch
+from torch import nn
+
+from optimize_inference import max_abs_diff, optimize_for_inference
+from predict import build_model
+
+
+def randomize_bn(model):
+    """Give every BatchNorm non-trivial affine parameters and statistics."""
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.2, 0.2)
+                m.running_mean.uniform_(-0.2, 0.2)
+                m.running_var.uniform_(0.5, 1.5)
+    return model
+
+
+def latency(model, x, n_runs=5, n_warmup=2):
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            model(x)
+        times = []
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench(depth, bs=16, sz=224, n_runs=5, atol=1e-4):
+    torch.manual_seed(0)
+    model = randomize_bn(build_model(f"mxresnet{depth}")).eval()
+    optimized = optimize_for_inference(model)
+    scripted = torch.jit.freeze(torch.jit.script(optimized))
+
+    x = torch.randn(bs, 3, sz, sz)
+    diffs = [max_abs_diff(model, optimized, x), max_abs_diff(model, scripted, x)]
+    with torch.no_grad():
+        scale = max(1.0, model(x).abs().max().item())
+    assert max(diffs) < atol * scale, f"mxresnet{depth}: outputs differ by {max(diffs):.2e}"
+
+    return dict(
+        depth=depth,
+        original=latency(model, x, n_runs),
+        optimized=latency(optimized, x, n_runs),
+        scripted=latency(scripted, x, n_runs),
+        max_diff=max(diffs),
+    )
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--models", dest="models", default="18,34,50,101,152", help="comma-separated depths")
+    parser.add_option("--bs", dest="bs", type=int, default=16, help="batch size")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--runs", dest="runs", type=int, default=5, help="timed runs")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    print(f"bs={opt.bs}, sz={opt.sz}, {torch.get_num_threads()} threads")
+    print(f"{'model':>12} {'original (s)':>13} {'folded (s)':>11} {'script (s)':>11} {'speedup':>8} {'max |dy|':>9}")
+    for depth in [int(d) for d in opt.models.split(",")]:
+        r = bench(depth, bs=opt.bs, sz=opt.sz, n_runs=opt.runs)
+        print(
+            f"{'mxresnet' + str(depth):>12} {r['original']:13.3f} {r['optimized']:11.3f} "
+            f"{r['scripted']:11.3f} {r['original'] / r['scripted']:7.2f}x {r['max_diff']:9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+John F. Wu
+
+Peak memory against step time for activation checkpointing and gradient
+accumulation.
+
+Every configuration (depth, image size, micro-batch size, accumulation
+steps, `checkpoint_stages`) is trained for a few Ranger steps on random
+data in a fresh process, so that the peak resident set size (or, on a
+GPU, the peak allocated memory) belongs to that configuration alone. The
+table reports the peak memory above the idle model and the median time
+per optimizer step, i.e. per effective batch of `bs * accum` images.
+
+With `--learner`, every configuration is trained through a fastai
+`Learner` with the `GradientAccumulation` callback (`accumulate.py`), as
+in the training scripts, instead of a plain loop.
+
+With `--check`, a checkpointed and a plain copy of the same model are
+also compared on one batch: gradients and BatchNorm running statistics
+must agree (the recomputation must not update the statistics twice).
+It also fits small `Learner`s with `GradientAccumulation`, alone and on
+two gloo ranks under `DistributedCPUTrainer`, and checks that Ranger's
+`step_counter` counts optimizer steps (including a partial group at the
+end of the epoch) and that the gradients are all-reduced once per
+optimizer step rather than once per micro-batch.
+
+Usage:
+    python bench_memory.py --models 101,152 --sz 448 --bs 32 --accum 1,4 --check
+    python bench_memory.py --models 152 --sz 448 --bs 32 --accum 4 --learner
+"""
+
+from functools import partial
+from optparse import OptionParser
+import copy
+import math
+import multiprocessing as mp
+import os
+import statistics
+import time
+
+import torch
+
+import mxresnet
+from instrument import peak_rss_mb
+from ranger import Ranger
+
+
+def _peak_mb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return peak_rss_mb()
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def run_config(depth, sz, bs, accum, checkpoint, n_steps, threads):
+    """Train `n_steps` optimizer steps of `accum` micro-batches of `bs`
+    images; returns the peak memory above the idle model and the step
+    times."""
+    if threads:
+        torch.set_num_threads(threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    model = getattr(mxresnet, f"mxresnet{depth}")(c_out=1, checkpoint_stages=checkpoint).to(device).train()
+    opt = Ranger(model.parameters(), lr=1e-3)
+    x = torch.randn(bs, 3, sz, sz, device=device)
+    y = torch.randn(bs, 1, device=device)
+    idle = _peak_mb()
+
+    times = []
+    for step in range(n_steps + 1):
+        _sync()
+        start = time.perf_counter()
+        for micro in range(accum):
+            loss = torch.sqrt(((model(x) - y) ** 2).mean())
+            loss.backward()
+        for p in model.parameters():
+            if p.grad is not None:
+                p.grad.div_(accum)
+        opt.step()
+        opt.zero_grad()
+        _sync()
+        if step:  # the first step allocates the optimizer state
+            times.append(time.perf_counter() - start)
+
+    # lookahead counts optimizer steps, not micro-batches
+    assert opt.param_groups[0]["step_counter"] == n_steps + 1
+    return dict(peak_mb=_peak_mb() - idle, step_s=statistics.median(times))
+
+
+def _learner(depth, sz, bs, n_batches, checkpoint=False, k=6, n_valid=2):
+    """fastai `Learner` of an MXResNet with Ranger on `n_batches` batches
+    of random data."""
+    from fastai.basic_data import DataBunch
+    from fastai.basic_train import Learner
+    from torch.utils.data import TensorDataset
+
+    torch.manual_seed(0)
+    x, y = torch.randn(bs * n_batches + n_valid, 3, sz, sz), torch.randn(bs * n_batches + n_valid, 1)
+    data = DataBunch.create(
+        TensorDataset(x[n_valid:], y[n_valid:]), TensorDataset(x[:n_valid], y[:n_valid]),
+        bs=bs, num_workers=0,
+    )
+    model = getattr(mxresnet, f"mxresnet{depth}")(c_out=1, checkpoint_stages=checkpoint)
+    return Learner(data, model, opt_func=partial(Ranger, k=k), loss_func=torch.nn.MSELoss(),
+                   wd=1e-3, bn_wd=False, true_wd=True)
+
+
+def run_learner(depth, sz, bs, accum, checkpoint, n_steps, threads):
+    """Like `run_config`, but through `Learner.fit` with the
+    `GradientAccumulation` callback of the training scripts."""
+    from fastai.basic_train import LearnerCallback
+
+    from accumulate import GradientAccumulation
+
+    if threads:
+        torch.set_num_threads(threads)
+    learn = _learner(depth, sz, bs, (n_steps + 1) * accum, checkpoint=checkpoint)
+
+    class BatchClock(LearnerCallback):
+        def on_train_begin(self, **kwargs):
+            self.times = []
+
+        def on_batch_end(self, train, **kwargs):
+            if train:
+                self.times.append(time.perf_counter())
+
+    clock = BatchClock(learn)
+    learn.create_opt(1e-3, learn.wd)
+    idle = _peak_mb()
+    learn.fit(1, 1e-3, callbacks=[GradientAccumulation(learn, accum), clock])
+
+    # the first group allocates the optimizer state
+    ends = clock.times[accum - 1::accum]
+    assert learn.opt.opt.param_groups[0]["step_counter"] == n_steps + 1
+    return dict(peak_mb=_peak_mb() - idle, step_s=statistics.median([b - a for a, b in zip(ends, ends[1:])]))
+
+
+def _run_in_child(queue, fn, args):
+    queue.put(fn(*args))
+
+
+def isolated(*args, fn=run_config):
+    """`fn` (`run_config` or `run_learner`) in a fresh process."""
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_in_child, args=(queue, fn, args))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def check_checkpointing(depth=18, sz=64, bs=4):
+    """Largest differences of the gradients and of the BatchNorm buffers
+    between a checkpointed and a plain copy of the same model."""
+    torch.manual_seed(0)
+    plain = getattr(mxresnet, f"mxresnet{depth}")(c_out=1).train()
+    ckpt = getattr(mxresnet, f"mxresnet{depth}")(c_out=1, checkpoint_stages=True).train()
+    ckpt.load_state_dict(copy.deepcopy(plain.state_dict()))
+    x = torch.randn(bs, 3, sz, sz)
+    for model in (plain, ckpt):
+        model(x).sum().backward()
+
+    grad_diff = max(
+        (a.grad - b.grad).abs().max().item() for a, b in zip(plain.parameters(), ckpt.parameters())
+    )
+    buffer_diff = max(
+        (a.double() - b.double()).abs().max().item() for a, b in zip(plain.buffers(), ckpt.buffers())
+    )
+    return grad_diff, buffer_diff
+
+
+def check_learner_accumulation(accum=3, n_batches=7, bs=2, sz=32):
+    """Fit one epoch with `GradientAccumulation` and return Ranger's
+    `step_counter` and the expected number of optimizer steps."""
+    from accumulate import GradientAccumulation
+
+    learn = _learner(18, sz, bs, n_batches)
+    learn.fit(1, 1e-3, callbacks=[GradientAccumulation(learn, accum)])
+    return learn.opt.opt.param_groups[0]["step_counter"], math.ceil(n_batches / accum)
+
+
+def _ddp_check_worker(rank, world_size, port, accum=3, n_batches=7, bs=2, sz=32):
+    os.environ.update(
+        RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank),
+        MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port),
+    )
+    torch.set_num_threads(1)
+
+    from fastai.basic_train import LearnerCallback
+    from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+    from accumulate import GradientAccumulation
+    from distributed import DistributedCPUTrainer, check_consistency, init_distributed
+
+    init_distributed()
+    learn = _learner(18, sz, bs, n_batches * world_size)
+    reductions = []
+
+    class CountReductions(LearnerCallback):
+        _order = -15  # after DistributedCPUTrainer has wrapped the model
+
+        def on_train_begin(self, **kwargs):
+            def hook(state, bucket):
+                if bucket.index() == 0:  # once per all-reducing backward pass
+                    reductions.append(1)
+                return allreduce_hook(None, bucket)
+
+            self.learn.model.register_comm_hook(None, hook)
+
+    learn.fit(1, 1e-3, callbacks=[
+        DistributedCPUTrainer(learn), CountReductions(learn), GradientAccumulation(learn, accum),
+    ])
+    n_steps = math.ceil(n_batches / accum)
+    step_counter = learn.opt.opt.param_groups[0]["step_counter"]
+    diff = check_consistency(learn.model, learn.opt.opt)
+    if rank == 0:
+        print(f"{world_size} ranks, {n_batches} micro-batches x accum {accum}: {step_counter} steps, "
+              f"{len(reductions)} all-reduces, max checksum difference {diff:.2e}")
+    assert step_counter == n_steps, f"step_counter {step_counter}, expected {n_steps}"
+    assert len(reductions) == n_steps, f"{len(reductions)} all-reduces for {n_steps} optimizer steps"
+    assert diff == 0, f"ranks diverged by {diff}"
+
+    import torch.distributed as dist
+
+    dist.destroy_process_group()
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--models", dest="models", default="101,152", help="comma-separated depths")
+    parser.add_option("--sz", dest="sz", type=int, default=448, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=32, help="effective batch size")
+    parser.add_option("--accum", dest="accum", default="1,4", help="comma-separated accumulation steps")
+    parser.add_option("--steps", dest="steps", type=int, default=3, help="timed optimizer steps")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+    parser.add_option("--learner", dest="learner", action="store_true", default=False, help="train through a fastai Learner with GradientAccumulation")
+    parser.add_option("--port", dest="port", type=int, default=29501, help="rendezvous port of the distributed check")
+    parser.add_option("--check", dest="check", action="store_true", default=False, help="check checkpointed gradients and BatchNorm statistics")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    if opt.check:
+        grad_diff, buffer_diff = check_checkpointing()
+        print(f"checkpointed vs plain: max |dgrad| {grad_diff:.1e}, max |dbuffer| {buffer_diff:.1e}")
+        assert grad_diff < 1e-4 and buffer_diff == 0, "checkpointed stages disagree with the plain model"
+
+        step_counter, n_steps = check_learner_accumulation()
+        print(f"Learner with GradientAccumulation: step_counter {step_counter}, {n_steps} optimizer steps")
+        assert step_counter == n_steps, "Ranger counted micro-batches instead of optimizer steps"
+        torch.multiprocessing.spawn(_ddp_check_worker, args=(2, opt.port), nprocs=2)
+
+    print(f"{'model':>12} {'sz':>5} {'bs x accum':>11} {'checkpoint':>11} {'peak (MB)':>10} {'step (s)':>9}")
+    for depth in [int(d) for d in opt.models.split(",")]:
+        for accum in [int(a) for a in opt.accum.split(",")]:
+            for checkpoint in (False, True):
+                bs = max(1, opt.bs // accum)
+                r = isolated(
+                    depth, opt.sz, bs, accum, checkpoint, opt.steps, opt.threads,
+                    fn=run_learner if opt.learner else run_config,
+                )
+                print(
+                    f"{'mxresnet' + str(depth):>12} {opt.sz:5d} {f'{bs} x {accum}':>11} {str(checkpoint):>11} "
+                    f"{r['peak_mb']:10.0f} {r['step_s']:9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
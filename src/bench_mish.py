@@ -0,0 +1,125 @@
+"""
+John F. Wu
+
+CPU benchmark of the Mish variants in `mxresnet.py`.
+
+For each activation we build the same MXResNet, run a forward/backward
+step on random images, and report the memory held by autograd for the
+backward pass (measured by the saved-tensor hooks, so it is exact and
+independent of the allocator) and the median step time.
+
+Usage:
+    python bench_mish.py --model mxresnet50 --sz 224 --bs 16
+"""
+
+from optparse import OptionParser
+import statistics
+import time
+
+import torch
+
+import mxresnet
+from mxresnet import MishFunction, MishJitFunction
+
+
+def saved_tensor_bytes(fn):
+    """Run `fn()` and return (result, bytes of distinct tensor storages that
+    autograd saved for backward)."""
+    storages = {}
+
+    def pack(t):
+        try:
+            storage = t.untyped_storage()
+        except AttributeError:
+            storage = t.storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def check_gradients():
+    """Compare the fused gradients against autograd of the reference Mish."""
+    x = torch.randn(64, dtype=torch.double, requires_grad=True)
+    for f in [MishFunction, MishJitFunction]:
+        assert torch.autograd.gradcheck(f.apply, (x,)), f"{f.__name__} gradcheck failed"
+
+    x = torch.randn(4, 8, 16, 16, requires_grad=True)
+    ref = x * torch.tanh(torch.nn.functional.softplus(x))
+    (g_ref,) = torch.autograd.grad(ref.sum(), x)
+    for f in [MishFunction, MishJitFunction]:
+        (g,) = torch.autograd.grad(f.apply(x).sum(), x)
+        assert torch.allclose(g, g_ref, atol=1e-6), f"{f.__name__} gradient mismatch"
+
+
+def bench(model_name, act, bs, sz, n_steps=5, n_warmup=2):
+    torch.manual_seed(0)
+    model = getattr(mxresnet, model_name)(act=act, c_out=1).train()
+    x = torch.randn(bs, 3, sz, sz)
+
+    def step():
+        out = model(x)
+        out.mean().backward()
+        model.zero_grad()
+
+    for _ in range(n_warmup):
+        step()
+
+    _, nbytes = saved_tensor_bytes(lambda: model(x))
+
+    times = []
+    for _ in range(n_steps):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+
+    return dict(
+        act=act,
+        saved_mb=nbytes / 2 ** 20,
+        step_s=statistics.median(times),
+    )
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--bs", dest="bs", type=int, default=16, help="batch size")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--steps", dest="steps", type=int, default=5, help="timed steps")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    check_gradients()
+    print("Fused Mish gradients match the reference implementation.")
+
+    results = [
+        bench(opt.model, act, opt.bs, opt.sz, n_steps=opt.steps)
+        for act in ["mish", "memory_efficient", "jit"]
+    ]
+    base = results[0]
+    print(f"{opt.model}, bs={opt.bs}, sz={opt.sz}, {torch.get_num_threads()} threads")
+    print(f"{'activation':>18} {'saved (MB)':>12} {'step (s)':>10} {'memory':>8} {'speed':>8}")
+    for r in results:
+        print(
+            f"{r['act']:>18} {r['saved_mb']:12.1f} {r['step_s']:10.3f} "
+            f"{r['saved_mb'] / base['saved_mb']:7.2f}x {base['step_s'] / r['step_s']:7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
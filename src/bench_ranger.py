@@ -0,0 +1,103 @@
+"""
+John F. Wu
+
+Micro-benchmark of `Ranger.step` against the multi-tensor `RangerForeach`.
+
+For each MXResNet depth we attach identical random gradients to two copies
+of the model, step both optimizers, check that they produce the same
+parameters (including across lookahead syncs), and report the median time
+per optimizer step.
+
+Usage:
+    python bench_ranger.py --models 18,50,152 --steps 24
+"""
+
+from optparse import OptionParser
+import copy
+import statistics
+import time
+
+import torch
+
+import mxresnet
+from ranger import Ranger, RangerForeach
+
+
+def time_steps(model, opt_cls, grads, n_steps, **kwargs):
+    """Step `opt_cls` on `model` with the precomputed `grads`, returning the
+    per-step times."""
+    params = list(model.parameters())
+    opt = opt_cls(params, **kwargs)
+    times = []
+    for step in range(n_steps):
+        for p, g in zip(params, grads[step % len(grads)]):
+            p.grad = g.clone()
+        start = time.perf_counter()
+        opt.step()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def max_param_diff(model_a, model_b):
+    return max(
+        (a - b).abs().max().item()
+        for a, b in zip(model_a.parameters(), model_b.parameters())
+    )
+
+
+def bench(depth, n_steps=24, n_grads=3, atol=1e-5, **kwargs):
+    torch.manual_seed(0)
+    model = getattr(mxresnet, f"mxresnet{depth}")(c_out=1)
+    grads = [
+        [torch.randn_like(p) * 1e-2 for p in model.parameters()] for _ in range(n_grads)
+    ]
+    model_ref, model_fe = model, copy.deepcopy(model)
+
+    t_ref = time_steps(model_ref, Ranger, grads, n_steps, **kwargs)
+    t_fe = time_steps(model_fe, RangerForeach, grads, n_steps, **kwargs)
+    max_diff = max_param_diff(model_ref, model_fe)
+    assert max_diff < atol, f"mxresnet{depth}: RangerForeach differs from Ranger by {max_diff:.2e}"
+
+    return dict(
+        depth=depth,
+        n_params=sum(p.numel() for p in model.parameters()),
+        n_tensors=len(list(model.parameters())),
+        ranger_ms=statistics.median(t_ref) * 1e3,
+        foreach_ms=statistics.median(t_fe) * 1e3,
+        max_diff=max_diff,
+    )
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--models", dest="models", default="18,34,50,101,152", help="comma-separated depths")
+    parser.add_option("--steps", dest="steps", type=int, default=24, help="optimizer steps (>= k)")
+    parser.add_option("--wd", dest="wd", type=float, default=1e-3, help="weight decay")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    print(f"{'model':>12} {'params':>10} {'tensors':>8} {'Ranger (ms)':>12} {'foreach (ms)':>13} {'speedup':>8} {'max |dp|':>9}")
+    for depth in [int(d) for d in opt.models.split(",")]:
+        r = bench(depth, n_steps=opt.steps, lr=1e-3, weight_decay=opt.wd)
+        print(
+            f"{'mxresnet' + str(depth):>12} {r['n_params']:10d} {r['n_tensors']:8d} "
+            f"{r['ranger_ms']:12.2f} {r['foreach_ms']:13.2f} "
+            f"{r['ranger_ms'] / r['foreach_ms']:7.2f}x {r['max_diff']:9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+John F. Wu
+
+CPU benchmark suite for the training and inference hot paths.
+
+Times, on random data:
+
+    model/       forward, backward and full Ranger training steps for each
+                 MXResNet depth, image size and batch size (and activation)
+    activation/  Mish against ReLU, forward + backward on a stem-sized tensor
+    optimizer/   `Ranger.step` against `torch.optim.Adam.step`
+    loader/      decoding throughput of the JPEG folder (if it exists)
+
+Results are written as JSON together with a fingerprint of the machine
+and software. With `--compare baseline.json`, every timing shared with
+the baseline is reported as a ratio and those slower by more than
+`--tolerance` are flagged as regressions (exit status 1).
+
+Usage:
+    python benchmark.py --models 18,50 --sizes 112,224 --bs 8,32 --out ../results/bench.json
+    python benchmark.py --models 18,50 --sizes 112,224 --bs 8,32 --compare ../results/bench.json
+"""
+
+from optparse import OptionParser
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+
+import mxresnet
+from bench_ranger import time_steps
+from predict import make_loader
+from ranger import Ranger
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def fingerprint():
+    """Machine and software description stored with every result file."""
+    return dict(
+        hostname=socket.gethostname(),
+        platform=platform.platform(),
+        processor=platform.processor() or platform.machine(),
+        cpu_count=os.cpu_count(),
+        python=platform.python_version(),
+        torch=torch.__version__,
+        numpy=np.__version__,
+        torch_threads=torch.get_num_threads(),
+        mkldnn=torch.backends.mkldnn.is_available(),
+    )
+
+
+def summarize(times):
+    return dict(median=statistics.median(times), min=min(times), n=len(times))
+
+
+def bench_model(depth, sz, bs, act="mish", n_runs=3, n_warmup=1):
+    """Median forward, backward, optimizer and full-step seconds of one
+    training step."""
+    torch.manual_seed(0)
+    model = getattr(mxresnet, f"mxresnet{depth}")(c_out=1, act=act).train()
+    opt = Ranger(model.parameters(), lr=1e-5)
+    x = torch.randn(bs, 3, sz, sz)
+
+    phases = {"forward": [], "backward": [], "opt_step": [], "train_step": []}
+    for i in range(n_warmup + n_runs):
+        t0 = time.perf_counter()
+        loss = model(x).pow(2).mean()
+        t1 = time.perf_counter()
+        loss.backward()
+        t2 = time.perf_counter()
+        opt.step()
+        opt.zero_grad()
+        t3 = time.perf_counter()
+        if i >= n_warmup:
+            phases["forward"].append(t1 - t0)
+            phases["backward"].append(t2 - t1)
+            phases["opt_step"].append(t3 - t2)
+            phases["train_step"].append(t3 - t0)
+    return {k: summarize(v) for k, v in phases.items()}
+
+
+def bench_activation(act, sz, bs, channels=64, n_runs=10):
+    """Forward + backward seconds of one activation on a (bs, channels,
+    sz/2, sz/2) tensor, the shape after the MXResNet stem."""
+    # `get_act` reuses the module-level Mish, whose constructor prints a message
+    fn = mxresnet.get_act("mish") if act == "mish" else torch.nn.ReLU()
+    x = torch.randn(bs, channels, sz // 2, sz // 2, requires_grad=True)
+    times = []
+    for i in range(n_runs + 1):
+        start = time.perf_counter()
+        fn(x).sum().backward()
+        x.grad = None
+        if i:
+            times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def bench_optimizer(depth, opt_name, n_steps=24):
+    """Seconds per optimizer step on `mxresnet{depth}` parameters."""
+    torch.manual_seed(0)
+    model = getattr(mxresnet, f"mxresnet{depth}")(c_out=1)
+    grads = [[torch.randn_like(p) * 1e-2 for p in model.parameters()]]
+    opt_cls = Ranger if opt_name == "ranger" else torch.optim.Adam
+    return summarize(time_steps(model, opt_cls, grads, n_steps, lr=1e-3)[1:])
+
+
+def bench_loader(folder, sz, bs, n_workers, n_images=512, suffix=".jpg"):
+    """Images per second decoded and normalized from a JPEG folder."""
+    ids = sorted(
+        e.name[: -len(suffix)] for e in os.scandir(folder) if e.name.endswith(suffix)
+    )[:n_images]
+    loader = make_loader(ids, folder, sz=sz, bs=bs, n_workers=n_workers, suffix=suffix)
+    start = time.perf_counter()
+    n = sum(len(xb) for xb, ok in loader)
+    return dict(images_per_sec=n / (time.perf_counter() - start), n=n)
+
+
+def run(opt):
+    results = {}
+
+    def record(name, r):
+        results[name] = r
+        value = r.get("median", r.get("images_per_sec"))
+        print(f"{name:<48} {value:12.4f}")
+
+    for depth in opt.models:
+        for sz in opt.sizes:
+            for bs in opt.bs:
+                for act in opt.acts:
+                    try:
+                        phases = bench_model(depth, sz, bs, act=act, n_runs=opt.runs)
+                    except RuntimeError as e:  # usually out of memory
+                        print(f"mxresnet{depth} sz={sz} bs={bs} {act}: {e}")
+                        continue
+                    for phase, r in phases.items():
+                        record(f"model/mxresnet{depth}/{act}/sz{sz}/bs{bs}/{phase}", r)
+
+    for sz in opt.sizes:
+        for act in ["mish", "relu"]:
+            record(f"activation/{act}/sz{sz}/bs{opt.bs[0]}", bench_activation(act, sz, opt.bs[0]))
+
+    for depth in opt.models:
+        for name in ["ranger", "adam"]:
+            record(f"optimizer/{name}/mxresnet{depth}", bench_optimizer(depth, name))
+
+    if os.path.isdir(opt.folder):
+        for n_workers in opt.workers:
+            record(
+                f"loader/{os.path.basename(os.path.normpath(opt.folder))}/sz{opt.sizes[0]}/workers{n_workers}",
+                bench_loader(opt.folder, opt.sizes[0], opt.bs[0], n_workers),
+            )
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Print timings relative to `baseline` and return the names of those
+    that regressed by more than `tolerance`."""
+    if baseline["fingerprint"] != fingerprint():
+        print("Warning: the baseline was recorded on a different machine or software stack")
+    regressions = []
+    print(f"{'benchmark':<48} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, r in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        if "median" in r:
+            b, c = old["median"], r["median"]
+            ratio = c / b
+        else:  # throughput, higher is better
+            b, c = old["images_per_sec"], r["images_per_sec"]
+            ratio = b / c
+        flag = ratio > 1 + tolerance
+        if flag:
+            regressions.append(name)
+        print(f"{name:<48} {b:10.4f} {c:10.4f} {ratio:6.2f}x{'  REGRESSION' if flag else ''}")
+    return regressions
+
+
+def _ints(s):
+    return [int(v) for v in s.split(",")]
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--models", dest="models", default="18,34,50,101,152", help="comma-separated depths")
+    parser.add_option("--sizes", dest="sizes", default="112,224,448", help="comma-separated image sizes")
+    parser.add_option("--bs", dest="bs", default="8,32", help="comma-separated batch sizes")
+    parser.add_option("--acts", dest="acts", default="mish,relu", help="activations for the model benchmarks")
+    parser.add_option("--runs", dest="runs", type=int, default=3, help="timed runs per configuration")
+    parser.add_option("--folder", dest="folder", default=f"{PATH}/images-OC", help="JPEG folder for the loader benchmark")
+    parser.add_option("--workers", dest="workers", default="0,2,4", help="comma-separated loader worker counts")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+    parser.add_option("--out", dest="out", default=None, help="write results to this JSON file")
+    parser.add_option("--compare", dest="compare", default=None, help="baseline JSON to compare against")
+    parser.add_option("--tolerance", dest="tolerance", type=float, default=0.1, help="allowed slowdown before flagging")
+
+    (options, args) = parser.parse_args()
+    options.models = _ints(options.models)
+    options.sizes = _ints(options.sizes)
+    options.bs = _ints(options.bs)
+    options.acts = options.acts.split(",")
+    options.workers = _ints(options.workers)
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    results = run(opt)
+    report = dict(
+        fingerprint=fingerprint(),
+        config=dict(models=opt.models, sizes=opt.sizes, bs=opt.bs, acts=opt.acts, runs=opt.runs),
+        results=results,
+    )
+
+    if opt.out:
+        os.makedirs(os.path.dirname(os.path.abspath(opt.out)), exist_ok=True)
+        with open(opt.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {len(results)} results to {opt.out}")
+
+    if opt.compare:
+        with open(opt.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=opt.tolerance)
+        print(f"{len(regressions)} regressions beyond {opt.tolerance:.0%}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+John F. Wu
+
+Periodic, atomic training checkpoints that can be resumed mid-schedule.
+
+A checkpoint holds the model weights, the optimizer state (for `Ranger`
+this includes the lookahead slow weights, the RAdam buffer and the
+per-group step counters), the number of completed epochs, and the Python,
+NumPy and PyTorch RNG states. Resuming passes the completed epochs to
+`fit_one_cycle(..., start_epoch=...)`, which fast-forwards the one-cycle
+learning rate and momentum schedule to the right batch.
+"""
+
+from fastai.basic_train import LearnerCallback
+from fastai.torch_core import get_model
+
+import os
+import random
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state.get("cuda") is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(learn, fname, epoch):
+    """Atomically write a checkpoint of `learn` after `epoch` completed
+    epochs to `fname`."""
+    state = {
+        "epoch": epoch,
+        "model": get_model(learn.model).state_dict(),
+        "opt": learn.opt.state_dict(),
+        "rng": get_rng_state(),
+    }
+    tmp = f"{fname}.tmp"
+    torch.save(state, tmp)
+    os.replace(tmp, fname)
+
+
+def load_checkpoint(learn, fname, lr):
+    """Restore `learn` from the checkpoint in `fname` and return the number
+    of completed epochs."""
+    return restore_checkpoint(learn, torch.load(fname, map_location="cpu"), lr)
+
+
+def restore_checkpoint(learn, state, lr):
+    """Restore `learn` from a loaded checkpoint `state` and return the
+    number of completed epochs. The optimizer is created first if needed,
+    so that `fit` picks up the restored state instead of building a new
+    one."""
+    get_model(learn.model).load_state_dict(state["model"])
+    if getattr(learn, "opt", None) is None:
+        learn.create_opt(lr, learn.wd)
+    learn.opt.load_state_dict(state["opt"])
+    set_rng_state(state["rng"])
+    return state["epoch"]
+
+
+class CheckpointCallback(LearnerCallback):
+    """Save a resumable checkpoint to `fname` every `every` epochs."""
+
+    def __init__(self, learn, fname, every=1):
+        super().__init__(learn)
+        self.fname, self.every = fname, every
+
+    def on_epoch_end(self, epoch, **kwargs):
+        if (epoch + 1) % self.every == 0:
+            save_checkpoint(self.learn, self.fname, epoch + 1)
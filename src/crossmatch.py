@@ -0,0 +1,191 @@
+"""
+John F. Wu
+
+Fast positional cross-matching of catalogs.
+
+`SkyIndex` converts RA/Dec to unit vectors and builds a KD-tree over them
+once. On the unit sphere the straight-line (chord) distance is a monotonic
+function of the angular separation, so nearest-neighbor and
+within-radius queries are exact and need no special handling at the
+poles or at RA = 0/360. Queries are processed in batches and joins are
+streamed chunk by chunk, so a million-row SDSS catalog can be matched in
+bounded memory:
+
+    index = SkyIndex(t17.RAJ2000, t17.DEJ2000)
+    joined = match_catalogs(nibles, t17, index=index, left_radec=("ra", "dec"), radius=3)
+
+Usage:
+    python crossmatch.py --left ../data/NIBLES_clean.csv --left-radec ra,dec \
+        --right ../data/Teimoorinia17.csv --right-radec RAJ2000,DEJ2000 \
+        --radius 3 --out ../results/nibles-t17.csv
+"""
+
+from optparse import OptionParser
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def radec_to_xyz(ra, dec):
+    """(N, 3) unit vectors for RA/Dec in degrees."""
+    ra, dec = np.radians(np.asarray(ra, dtype=np.float64)), np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def arcsec_to_chord(sep):
+    return 2 * np.sin(np.radians(np.asarray(sep, dtype=np.float64) / 3600) / 2)
+
+
+def chord_to_arcsec(d):
+    return np.degrees(2 * np.arcsin(np.clip(np.asarray(d) / 2, 0, 1))) * 3600
+
+
+class SkyIndex:
+    """Reusable spatial index over catalog positions (degrees)."""
+
+    def __init__(self, ra, dec, leafsize=16):
+        self.tree = cKDTree(radec_to_xyz(ra, dec), leafsize=leafsize, balanced_tree=False)
+
+    def __len__(self):
+        return self.tree.n
+
+    def nearest(self, ra, dec, k=1, max_sep=None, batch_size=200000):
+        """Separations (arcsec) and catalog indices of the `k` nearest
+        sources to each position, as (N,) arrays for k=1 or (N, k)
+        otherwise. Neighbors beyond `max_sep` arcsec have separation inf
+        and index -1."""
+        xyz = radec_to_xyz(ra, dec)
+        bound = arcsec_to_chord(max_sep) if max_sep is not None else np.inf
+        seps, idxs = [], []
+        for start in range(0, len(xyz), batch_size):
+            d, i = self.tree.query(xyz[start:start + batch_size], k=k, distance_upper_bound=bound, workers=-1)
+            missing = ~np.isfinite(d)
+            d = np.where(missing, np.inf, chord_to_arcsec(np.where(missing, 0, d)))
+            seps.append(d)
+            idxs.append(np.where(missing, -1, i))
+        if not seps:
+            shape = (0,) if k == 1 else (0, k)
+            return np.empty(shape), np.empty(shape, dtype=np.int64)
+        return np.concatenate(seps), np.concatenate(idxs).astype(np.int64)
+
+    def within(self, ra, dec, radius, batch_size=200000):
+        """All pairs closer than `radius` arcsec, as arrays `(query index,
+        catalog index, separation in arcsec)` sorted by query index."""
+        xyz = radec_to_xyz(ra, dec)
+        r = arcsec_to_chord(radius)
+        q_idx, c_idx = [], []
+        for start in range(0, len(xyz), batch_size):
+            hits = self.tree.query_ball_point(xyz[start:start + batch_size], r, workers=-1, return_sorted=True)
+            lengths = np.fromiter((len(h) for h in hits), dtype=np.int64, count=len(hits))
+            q_idx.append(start + np.repeat(np.arange(len(hits)), lengths))
+            c_idx.append(np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]) if lengths.sum()
+                         else np.empty(0, dtype=np.int64))
+        q_idx = np.concatenate(q_idx) if q_idx else np.empty(0, dtype=np.int64)
+        c_idx = np.concatenate(c_idx) if c_idx else np.empty(0, dtype=np.int64)
+        sep = chord_to_arcsec(np.linalg.norm(xyz[q_idx] - self.tree.data[c_idx], axis=1))
+        return q_idx, c_idx, sep
+
+    def save(self, fname):
+        with open(fname, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, "rb") as f:
+            return pickle.load(f)
+
+
+def join_chunk(left, right, index, left_radec, radius, how="nearest", suffix="_right"):
+    """Join the rows of `left` to their matches in `right` (indexed by
+    `index`). `how="nearest"` keeps every left row with its nearest match
+    (or NaNs); `how="all"` returns one row per pair within `radius`."""
+    ra, dec = left[left_radec[0]].to_numpy(), left[left_radec[1]].to_numpy()
+    if how == "nearest":
+        sep, idx = index.nearest(ra, dec, max_sep=radius)
+        l_idx = np.arange(len(left))
+    elif how == "all":
+        l_idx, idx, sep = index.within(ra, dec, radius)
+    else:
+        raise ValueError(f"Unknown join: {how}")
+
+    matched = idx >= 0
+    r = right.iloc[idx[matched]]
+    r.index = np.flatnonzero(matched)
+    r = r.reindex(np.arange(len(idx)))
+    r.columns = [c + suffix if c in left.columns else c for c in r.columns]
+
+    out = pd.concat([left.iloc[l_idx].reset_index(drop=True), r], axis=1)
+    out["sep_arcsec"] = np.where(matched, sep, np.nan)
+    return out
+
+
+def match_catalogs(left, right, index=None, left_radec=("ra", "dec"), right_radec=("ra", "dec"),
+                   radius=3.0, how="nearest", chunksize=200000, suffix="_right"):
+    """Cross-match two DataFrames, or an iterator of `left` chunks (e.g.
+    `pd.read_csv(..., chunksize=...)`), yielding joined chunks in the
+    latter case."""
+    if index is None:
+        index = SkyIndex(right[right_radec[0]], right[right_radec[1]])
+    if isinstance(left, pd.DataFrame):
+        chunks = [left.iloc[i:i + chunksize] for i in range(0, len(left), chunksize)]
+        return pd.concat(
+            [join_chunk(c, right, index, left_radec, radius, how, suffix) for c in chunks],
+            ignore_index=True,
+        )
+    return (join_chunk(c, right, index, left_radec, radius, how, suffix) for c in left)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--left", dest="left", default=f"{PATH}/data/NIBLES_clean.csv", help="catalog to stream")
+    parser.add_option("--left-radec", dest="left_radec", default="ra,dec", help="RA,Dec columns of the left catalog")
+    parser.add_option("--right", dest="right", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="catalog to index")
+    parser.add_option("--right-radec", dest="right_radec", default="RAdeg_OC,DECdeg_OC", help="RA,Dec columns of the right catalog")
+    parser.add_option("--right-cols", dest="right_cols", default="", help="comma-separated right columns to keep (default all)")
+    parser.add_option("--radius", dest="radius", type=float, default=3.0, help="match radius in arcsec")
+    parser.add_option("--all", dest="all", action="store_true", default=False, help="keep every pair within the radius")
+    parser.add_option("--chunksize", dest="chunksize", type=int, default=200000, help="left catalog rows per chunk")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/crossmatch.csv", help="output CSV")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    right_radec = opt.right_radec.split(",")
+    usecols = None
+    if opt.right_cols:
+        usecols = list(dict.fromkeys(right_radec + opt.right_cols.split(",")))
+    right = pd.read_csv(opt.right, usecols=usecols)
+    index = SkyIndex(right[right_radec[0]], right[right_radec[1]])
+
+    os.makedirs(os.path.dirname(os.path.abspath(opt.out)), exist_ok=True)
+    n_rows, n_matched = 0, 0
+    chunks = pd.read_csv(opt.left, chunksize=opt.chunksize)
+    joined = match_catalogs(
+        chunks, right, index=index, left_radec=opt.left_radec.split(","),
+        radius=opt.radius, how="all" if opt.all else "nearest",
+    )
+    for df in joined:
+        df.to_csv(opt.out, mode="a" if n_rows else "w", header=not n_rows, index=False)
+        n_rows += len(df)
+        n_matched += int(df.sep_arcsec.notna().sum())
+
+    print(f"Wrote {n_rows} rows ({n_matched} matched within {opt.radius}\") to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
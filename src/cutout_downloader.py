@@ -0,0 +1,333 @@
+"""
+John F. Wu
+
+Concurrent, rate-limited downloader for the survey cutout services used by
+the `get_*_cutouts.py` scripts.
+
+Each worker thread keeps its own keep-alive HTTP connection per host, and
+all threads share a token bucket per host so that we stay polite to the
+SkyServer and Legacy Survey viewers. Requests that fail with 429 or 5xx
+are retried with exponential backoff (honoring `Retry-After`), redirects
+(e.g. from http to https) are followed for up to `MAX_REDIRECTS` hops, and
+a one-line progress report with throughput is written to stdout.
+"""
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import http.client
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+
+# a single cutout to fetch: `key` identifies the catalog row, `url` is the
+# cutout service query, and `dest` is where the image bytes are written
+Job = namedtuple("Job", ["key", "url", "dest"])
+
+# outcome of a single job; `status` is one of "ok" or "failed"
+Result = namedtuple("Result", ["job", "status", "nbytes", "data", "error", "attempts"])
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+
+class Printer:
+    """Print things to stdout on one line dynamically"""
+
+    def __init__(self, data):
+        sys.stdout.write("\r\x1b[K" + data.__str__())
+        sys.stdout.flush()
+
+
+class HTTPStatusError(Exception):
+    """Raised when the cutout service answers with a non-200 status."""
+
+    def __init__(self, status, reason, retry_after=None):
+        super().__init__(f"HTTP {status}: {reason}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket that allows `rate` requests per second on
+    average, with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        if not rate > 0:
+            raise ValueError(f"Invalid rate: {rate}")
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections, one per thread and host."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self.local, "conns"):
+            self.local.conns = {}
+        return self.local.conns
+
+    def get(self, scheme, netloc):
+        conns = self._connections()
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            cls = (
+                http.client.HTTPSConnection
+                if scheme == "https"
+                else http.client.HTTPConnection
+            )
+            conn = cls(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+        return conn
+
+    def discard(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+
+class CutoutDownloader:
+    """Download many cutouts concurrently.
+
+    `rate` is the maximum number of requests per second *per host*, shared
+    by all `n_threads` workers. Set `rate=None` to disable rate limiting.
+    """
+
+    def __init__(
+        self,
+        n_threads=8,
+        rate=10.0,
+        burst=None,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=60.0,
+        timeout=30,
+        user_agent="HI-convnets cutout downloader",
+    ):
+        self.n_threads = n_threads
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.headers = {"User-Agent": user_agent, "Connection": "keep-alive"}
+        self.pool = ConnectionPool(timeout=timeout)
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def _bucket(self, netloc):
+        if self.rate is None:
+            return None
+        with self.buckets_lock:
+            if netloc not in self.buckets:
+                self.buckets[netloc] = TokenBucket(self.rate, self.burst)
+            return self.buckets[netloc]
+
+    def _request_once(self, url):
+        """Issue a single GET on a pooled connection and return the
+        response (already read) and its body."""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        bucket = self._bucket(parts.netloc)
+        if bucket is not None:
+            bucket.acquire()
+
+        conn = self.pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path, headers=self.headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            # stale keep-alive connection or network hiccup: reconnect next time
+            self.pool.discard(parts.scheme, parts.netloc)
+            raise
+
+        if response.will_close:
+            self.pool.discard(parts.scheme, parts.netloc)
+        return response, body
+
+    def _request(self, url):
+        """GET `url`, following redirects, and return the body."""
+        for _ in range(MAX_REDIRECTS + 1):
+            response, body = self._request_once(url)
+            location = response.getheader("Location")
+            if response.status not in REDIRECT_STATUS or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+        else:
+            raise HTTPStatusError(response.status, f"more than {MAX_REDIRECTS} redirects")
+
+        if response.status != 200:
+            raise HTTPStatusError(
+                response.status, response.reason, response.getheader("Retry-After")
+            )
+        return body
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        # jitter so that throttled threads do not retry in lockstep
+        time.sleep(delay * (0.5 + random.random() / 2))
+
+    def fetch(self, url):
+        """Return the body at `url`, retrying on 429/5xx and connection
+        errors. Returns `(body, attempts)`; on final failure the raised
+        exception carries the number of attempts as `e.attempts`.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._request(url), attempt + 1
+            except HTTPStatusError as e:
+                if e.status not in RETRY_STATUS or attempt >= self.max_retries:
+                    e.attempts = attempt + 1
+                    raise
+                self._sleep_before_retry(attempt, e.retry_after)
+            except (http.client.HTTPException, OSError) as e:
+                if attempt >= self.max_retries:
+                    e.attempts = attempt + 1
+                    raise
+                self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def _run(self, job):
+        try:
+            data, attempts = self.fetch(job.url)
+        except (HTTPStatusError, http.client.HTTPException, OSError) as e:
+            return Result(job, "failed", 0, None, str(e), getattr(e, "attempts", 1))
+
+        if job.dest is not None:
+            # write atomically so an interrupted run never leaves a partial image
+            tmp = f"{job.dest}.part"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, job.dest)
+            except OSError as e:
+                # e.g. disk full or no permission: fail this job, not the run
+                return Result(job, "failed", 0, None, str(e), attempts)
+        return Result(job, "ok", len(data), data, None, attempts)
+
+    def download(self, jobs, on_result=None, progress=True):
+        """Download all `jobs` and return a `DownloadReport`.
+
+        `on_result` is called in the calling thread with each `Result` as
+        soon as it completes, e.g. to update a manifest.
+        """
+        jobs = list(jobs)
+        report = DownloadReport(len(jobs))
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            # bound the number of in-flight futures so huge catalogs do not
+            # queue millions of jobs at once
+            pending = set()
+            window = 4 * self.n_threads
+            it = iter(jobs)
+
+            def submit_next():
+                job = next(it, None)
+                if job is not None:
+                    pending.add(executor.submit(self._run, job))
+
+            for _ in range(window):
+                submit_next()
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    report.update(result)
+                    if on_result is not None:
+                        on_result(result)
+                    submit_next()
+                if progress:
+                    Printer(report.status())
+
+        if progress:
+            print("")
+        return report
+
+
+class DownloadReport:
+    """Running totals and throughput for a batch of downloads."""
+
+    def __init__(self, n_total):
+        self.n_total = n_total
+        self.n_ok = 0
+        self.n_failed = 0
+        self.n_retried = 0
+        self.nbytes = 0
+        self.failures = []
+        self.start = time.monotonic()
+
+    @property
+    def n_done(self):
+        return self.n_ok + self.n_failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def images_per_sec(self):
+        return self.n_done / max(self.elapsed, 1e-9)
+
+    def update(self, result):
+        if result.status == "ok":
+            self.n_ok += 1
+            self.nbytes += result.nbytes
+        else:
+            self.n_failed += 1
+            self.failures.append((result.job.key, result.error))
+        if result.attempts > 1:
+            self.n_retried += 1
+
+    def status(self):
+        pct = self.n_done / max(self.n_total, 1) * 100
+        mb_per_sec = self.nbytes / 1e6 / max(self.elapsed, 1e-9)
+        return (
+            f"{pct:.3f}% of {self.n_total} completed "
+            f"({self.images_per_sec:.1f} img/s, {mb_per_sec:.2f} MB/s, "
+            f"{self.n_failed} failed, {self.n_retried} retried)."
+        )
+
+    def summary(self):
+        return (
+            f"Downloaded {self.n_ok}/{self.n_total} cutouts in {self.elapsed:.1f} s "
+            f"({self.images_per_sec:.1f} img/s, {self.nbytes / 1e6:.1f} MB); "
+            f"{self.n_failed} failed, {self.n_retried} needed retries."
+        )
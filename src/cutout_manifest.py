@@ -0,0 +1,173 @@
+"""
+John F. Wu
+
+Persistent, resumable manifest of downloaded cutouts.
+
+Every cutout is keyed by (catalog ID, survey, layer, size), and we record
+its download status, byte size, SHA-1 checksum and the number of
+attempts in a small SQLite database. On restart the cutout scripts only
+schedule rows that are missing or previously failed, and can report what
+is left without stat-ing every file in the image directory. Images already
+on disk for IDs the manifest has never seen (e.g. from earlier versions of
+the scripts) are adopted automatically, so they are not downloaded again.
+"""
+
+from collections import Counter
+import hashlib
+import os
+import sqlite3
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cutouts (
+    catalog_id TEXT NOT NULL,
+    survey TEXT NOT NULL,
+    layer TEXT NOT NULL,
+    size TEXT NOT NULL,
+    status TEXT NOT NULL,
+    nbytes INTEGER,
+    checksum TEXT,
+    path TEXT,
+    error TEXT,
+    attempts INTEGER,
+    updated REAL,
+    PRIMARY KEY (catalog_id, survey, layer, size)
+)
+"""
+
+
+def checksum(data):
+    """SHA-1 hex digest of the image bytes."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class CutoutManifest:
+    """SQLite manifest for one set of cutouts, i.e. a fixed `survey`,
+    `layer` (e.g. data release) and `size` (e.g. "224x224" or
+    "448@0.262").
+
+    Writes are batched and committed every `commit_every` records; use the
+    manifest as a context manager (or call `close`) to flush the rest.
+    """
+
+    def __init__(self, path, survey, layer, size, commit_every=200):
+        self.path = path
+        self.key = (survey, layer, str(size))
+        self.commit_every = commit_every
+        self.n_uncommitted = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def status(self):
+        """Return a dict mapping catalog ID (as str) to status."""
+        rows = self.db.execute(
+            "SELECT catalog_id, status FROM cutouts "
+            "WHERE survey=? AND layer=? AND size=?",
+            self.key,
+        )
+        return dict(rows)
+
+    def pending(self, ids):
+        """Return the subset of `ids` (in order) that are missing from the
+        manifest or have not been downloaded successfully."""
+        status = self.status()
+        return [i for i in ids if status.get(str(i)) != "ok"]
+
+    def summary(self, ids):
+        """Count `ids` by status ("ok", "failed" or "missing")."""
+        status = self.status()
+        return Counter(status.get(str(i), "missing") for i in ids)
+
+    def record(
+        self, catalog_id, status, nbytes=None, digest=None, path=None, error=None,
+        attempts=None,
+    ):
+        self.db.execute(
+            "INSERT OR REPLACE INTO cutouts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(catalog_id), *self.key, status, nbytes, digest, path, error,
+             attempts, time.time()),
+        )
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_every:
+            self.db.commit()
+            self.n_uncommitted = 0
+
+    def record_result(self, result):
+        """Record a `cutout_downloader.Result`; suitable as the downloader's
+        `on_result` callback."""
+        if result.status == "ok":
+            self.record(
+                result.job.key,
+                "ok",
+                nbytes=result.nbytes,
+                digest=checksum(result.data),
+                path=result.job.dest,
+                attempts=result.attempts,
+            )
+        else:
+            self.record(
+                result.job.key,
+                "failed",
+                path=result.job.dest,
+                error=result.error,
+                attempts=result.attempts,
+            )
+
+    def adopt(self, ids, directory, suffix=".jpg", unseen_only=False):
+        """Mark images that already exist in `directory` as downloaded.
+
+        This lists the directory once (rather than probing every catalog
+        row) and checksums the matching files, so that a manifest can be
+        seeded from a folder populated by earlier versions of the scripts.
+        With `unseen_only`, IDs that have any manifest entry (e.g. failed)
+        are left alone. Returns the number of adopted rows.
+        """
+        status = self.status()
+        if not os.path.isdir(directory):
+            return 0
+        present = {
+            entry.name[: -len(suffix)]: entry.path
+            for entry in os.scandir(directory)
+            if entry.name.endswith(suffix) and entry.is_file()
+        }
+
+        n_adopted = 0
+        for i in ids:
+            fn = present.get(str(i))
+            if fn is None or status.get(str(i)) == "ok":
+                continue
+            if unseen_only and str(i) in status:
+                continue
+            with open(fn, "rb") as f:
+                data = f.read()
+            if len(data) == 0:
+                continue
+            self.record(i, "ok", nbytes=len(data), digest=checksum(data), path=fn)
+            n_adopted += 1
+
+        self.db.commit()
+        return n_adopted
+
+    def report(self, ids):
+        """Human-readable summary of the download state of `ids`."""
+        counts = self.summary(ids)
+        survey, layer, size = self.key
+        return (
+            f"{survey}/{layer}/{size}: {counts['ok']} downloaded, "
+            f"{counts['failed']} failed, {counts['missing']} not yet attempted "
+            f"({counts['failed'] + counts['missing']} of {len(ids)} left)."
+        )
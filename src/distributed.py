@@ -0,0 +1,295 @@
+"""
+John F. Wu
+
+Data-parallel training on CPU nodes with `torch.distributed` (gloo).
+
+Every rank builds the same `Learner` (the `split_by_rand_pct` split is
+seeded, so all ranks agree on the training and validation sets).
+`DistributedCPUTrainer` then
+
+    - wraps the model in `DistributedDataParallel`, which broadcasts rank
+      0's weights and buffers and all-reduces (averages) the gradients in
+      every backward pass,
+    - shards the training set across ranks with a `DistributedSampler`,
+      reshuffled every epoch; `--bs` is the batch size per rank,
+    - broadcasts rank 0's Ranger lookahead slow weights at the start of
+      training and after every epoch. With identical gradients and step
+      counters the ranks stay in lockstep anyway; the broadcast makes this
+      hold also after resuming or if the optimizer was built before the
+      model weights were synchronized.
+
+Validation runs on the full validation set on every rank, and only rank
+0 writes checkpoints and the final model. When resuming, rank 0 reads the
+checkpoint and broadcasts it, so the other ranks need no shared
+filesystem. Each rank seeds its augmentations with `--seed` plus its rank.
+
+The training scripts run distributed when launched with `torchrun` (which
+sets `WORLD_SIZE`, `RANK` and `MASTER_ADDR`/`MASTER_PORT`), e.g. on each of
+two nodes:
+
+    torchrun --nnodes 2 --nproc_per_node 1 --rdzv_endpoint node0:29500 train_alfalfa.py --bs 16
+
+or as several local processes with this script:
+
+    python distributed.py --nproc 4 --script alfalfa -- --model mxresnet34 --bs 8
+    python distributed.py --nproc 2 --self-test
+"""
+
+from fastai.basic_train import LearnerCallback
+
+from contextlib import contextmanager
+from optparse import OptionParser
+import importlib
+import os
+import random
+import shutil
+import sys
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from checkpoint import restore_checkpoint
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", get_rank()))
+
+
+@contextmanager
+def local_main_first():
+    """Run the body on the first process of every node before the other
+    processes, e.g. so that only one of them builds a shared cache and the
+    others open the finished files. A no-op when not distributed."""
+    if not is_distributed():
+        yield
+        return
+    if get_local_rank() != 0:
+        dist.barrier()
+    yield
+    if get_local_rank() == 0:
+        dist.barrier()
+
+
+def init_distributed(backend="gloo"):
+    """Join the process group described by the torchrun environment
+    variables, if there is more than one process. Returns the world size."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend=backend)
+        from fastai.torch_core import defaults
+
+        # gloo trains on CPU
+        defaults.device = torch.device("cpu")
+    return world_size
+
+
+def seed_rank(seed, offset=0):
+    """Seed Python, NumPy and PyTorch differently on every rank, so that
+    the ranks draw different augmentations. `offset` (e.g. the resumed
+    epoch) moves all ranks to fresh streams."""
+    seed = seed + offset * dist.get_world_size() + get_rank()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def broadcast_checkpoint(learn, fname, lr, src=0):
+    """Restore `learn` on every rank from the checkpoint `fname` as read by
+    rank `src`. Returns the number of completed epochs, or None if rank
+    `src` has no checkpoint."""
+    state = [None]
+    if get_rank() == src and os.path.isfile(fname):
+        state = [torch.load(fname, map_location="cpu")]
+    dist.broadcast_object_list(state, src=src)
+    if state[0] is None:
+        return None
+    return restore_checkpoint(learn, state[0], lr)
+
+
+def sync_slow_weights(opt, src=0):
+    """Broadcast the Ranger lookahead slow weights from rank `src`."""
+    for slow_weights in getattr(opt, "slow_weights", []):
+        for q in slow_weights:
+            dist.broadcast(q.data, src)
+
+
+def parameter_checksum(tensors):
+    return torch.stack([t.detach().double().sum() for t in tensors]).sum()
+
+
+def check_consistency(model, opt):
+    """Largest difference, across ranks, of the checksums of the model
+    parameters and the lookahead slow weights."""
+    sums = [parameter_checksum(model.parameters())]
+    slow = [q for group in getattr(opt, "slow_weights", []) for q in group]
+    if slow:
+        sums.append(parameter_checksum(slow))
+    sums = torch.stack(sums)
+    lo, hi = sums.clone(), sums.clone()
+    dist.all_reduce(lo, op=dist.ReduceOp.MIN)
+    dist.all_reduce(hi, op=dist.ReduceOp.MAX)
+    return (hi - lo).max().item()
+
+
+class DistributedCPUTrainer(LearnerCallback):
+    """Distributed data-parallel training of a fastai `Learner` over an
+    initialized (gloo) process group."""
+
+    _order = -20  # before the other callbacks see the model or the data
+
+    def on_train_begin(self, **kwargs):
+        self.learn.model = DistributedDataParallel(self.learn.model)
+        self.old_train_dl = self.learn.data.train_dl
+        self.sampler = DistributedSampler(self.old_train_dl.dataset, shuffle=True)
+        self.learn.data.train_dl = self.old_train_dl.new(shuffle=False, sampler=self.sampler)
+        sync_slow_weights(self.learn.opt.opt)
+        if not is_main_process():
+            self.learn.recorder.silent = True
+
+    def on_epoch_begin(self, epoch, **kwargs):
+        self.sampler.set_epoch(epoch)
+
+    def on_epoch_end(self, **kwargs):
+        sync_slow_weights(self.learn.opt.opt)
+
+    def on_train_end(self, **kwargs):
+        self.learn.model = self.learn.model.module
+        self.learn.data.train_dl = self.old_train_dl
+
+
+def _worker(rank, world_size, port, script, train_args, threads):
+    os.environ.update(
+        RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank),
+        MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port),
+    )
+    torch.set_num_threads(threads)
+    init_distributed()
+
+    mod = importlib.import_module(f"train_{script}")
+    sys.argv = [f"train_{script}.py", *train_args]
+    opt, _ = mod.command_line()
+    learn = mod.get_learner(opt)
+    mod.train(learn, opt)
+    dist.destroy_process_group()
+
+
+def _self_test_worker(rank, world_size, port, n_epochs=2, n_items=32, bs=4):
+    """Fit a small MXResNet `Learner` on random data through
+    `DistributedCPUTrainer`, then perturb the other ranks and resume from
+    a checkpoint that only rank 0 can read. All ranks must end with
+    identical weights and lookahead slow weights both times."""
+    os.environ.update(
+        RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank),
+        MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port),
+    )
+    torch.set_num_threads(1)
+    init_distributed()
+
+    import tempfile
+    from functools import partial
+
+    from fastai.basic_data import DataBunch
+    from fastai.basic_train import Learner
+    from torch.utils.data import TensorDataset
+
+    import mxresnet
+    from checkpoint import save_checkpoint
+    from ranger import Ranger
+
+    def check(stage):
+        diff = check_consistency(learn.model, learn.opt.opt)
+        if rank == 0:
+            print(f"{world_size} ranks, {stage}: max checksum difference {diff:.2e}")
+        assert diff == 0, f"ranks diverged by {diff} {stage}"
+
+    # the same data everywhere, different initial weights on purpose;
+    # DDP and the slow weight broadcast must fix them
+    torch.manual_seed(0)
+    x, y = torch.randn(n_items, 3, 32, 32), torch.randn(n_items, 1)
+    data = DataBunch.create(
+        TensorDataset(x[:-8], y[:-8]), TensorDataset(x[-8:], y[-8:]), bs=bs, num_workers=0
+    )
+    torch.manual_seed(rank)
+    learn = Learner(
+        data, mxresnet.mxresnet18(c_out=1), opt_func=partial(Ranger, k=3),
+        loss_func=torch.nn.MSELoss(), wd=1e-3, bn_wd=False, true_wd=True,
+    )
+    learn.fit_one_cycle(n_epochs, 1e-3, callbacks=[DistributedCPUTrainer(learn)])
+    check(f"after {n_epochs} epochs")
+
+    # only rank 0 has the checkpoint, as on nodes without a shared filesystem
+    tmp = tempfile.mkdtemp()
+    fname = os.path.join(tmp, "checkpoint.pth")
+    if rank == 0:
+        save_checkpoint(learn, fname, n_epochs)
+    else:
+        with torch.no_grad():
+            for p in learn.model.parameters():
+                p.add_(torch.randn_like(p))
+    dist.barrier()
+    start_epoch = broadcast_checkpoint(learn, fname, lr=1e-3)
+    assert start_epoch == n_epochs, f"rank {rank} resumed at epoch {start_epoch}"
+    check("after resuming")
+
+    learn.fit_one_cycle(
+        n_epochs + 1, 1e-3, start_epoch=start_epoch, callbacks=[DistributedCPUTrainer(learn)]
+    )
+    check("after the resumed epoch")
+    shutil.rmtree(tmp, ignore_errors=True)
+    dist.destroy_process_group()
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    Options after `--` are passed to the training script.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options] -- [training script options]\n")
+    parser.add_option("--nproc", dest="nproc", type=int, default=2, help="number of local processes")
+    parser.add_option("--script", dest="script", default="alfalfa", help="`alfalfa` or `xGASS`")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch threads per process")
+    parser.add_option("--port", dest="port", type=int, default=29500, help="rendezvous port")
+    parser.add_option("--self-test", dest="self_test", action="store_true", default=False, help="check rank consistency on random data")
+
+    argv = sys.argv[1:]
+    train_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+    (options, args) = parser.parse_args(argv)
+    if options.threads is None:
+        options.threads = max(1, os.cpu_count() // options.nproc)
+
+    return options, train_args
+
+
+def main():
+
+    opt, train_args = cmdline()
+
+    if opt.self_test:
+        mp.spawn(_self_test_worker, args=(opt.nproc, opt.port), nprocs=opt.nproc)
+        print("Self-test passed.")
+        return
+
+    mp.spawn(
+        _worker, args=(opt.nproc, opt.port, opt.script, train_args, opt.threads), nprocs=opt.nproc
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+John F. Wu
+
+Persistent cache of penultimate-layer MXResNet embeddings.
+
+The confidence and latent-space analyses need the pooled 512-d (resnet18/
+34) or 2048-d (resnet50+) activations feeding the final linear layer. This
+module computes them once per (model weights, catalog, image set), in the
+same forward pass that produces the logfgas predictions, and stores both
+as memory-mapped segments with an ID index:
+
+    {PATH}/cache/embeddings/{model}-{weights hash}/{catalog}-{image set}/
+        seg-00000.npy       float32 (N, D) embeddings
+        seg-00000.csv       id, logfgas_pred
+        failed.csv          id, mtime_ns, size of images that could not be read
+
+When a catalog grows, only the new IDs are run through the network and
+appended as new segments, one every `flush_every` batches. A segment
+counts once its index CSV exists, and later segments take precedence, so
+an interrupted update or compaction never leaves a broken cache. IDs
+whose image is missing or unreadable are remembered with the fingerprint
+of their source (the JPEG, or the array of a packed store) and are not
+retried until it changes.
+
+Usage:
+    python embeddings.py --cat ../data/NIBLES_clean.csv --cols nibles_id \
+        --images ../images-nibles --weights ../models/best_a40.pth
+"""
+
+from glob import glob
+from optparse import OptionParser
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+from packed_images import PackedImageStore
+from predict import load_model, make_loader, open_images
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CACHE_DIR = f"{PATH}/cache/embeddings"
+
+
+def weights_hash(fname, n_chars=12):
+    """Short SHA-1 of a weights file, so that retrained weights saved under
+    the same name get a fresh cache."""
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:n_chars]
+
+
+def _name(path):
+    return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+
+@torch.no_grad()
+def embed_batches(model, loader):
+    """Yield `(embeddings, preds, ok)` for each batch, splitting the model
+    in front of its final linear layer so one forward pass gives both."""
+    body, head = model[:-1], model[-1]
+    for xb, ok in loader:
+        feats = body(xb)
+        preds = head(feats).view(-1)
+        yield feats.numpy().astype(np.float32), preds.numpy(), ok.numpy()
+
+
+def _save_array(fname, arr):
+    """Atomically save `arr` as a .npy file."""
+    with open(f"{fname}.part", "wb") as f:
+        np.save(f, arr)
+    os.replace(f"{fname}.part", fname)
+
+
+class EmbeddingCache:
+    """Embeddings and predictions of one model on one catalog/image set."""
+
+    def __init__(self, model_name, weights, catalog, images, cache_dir=CACHE_DIR):
+        self.model_name = model_name
+        self.weights = weights
+        self.images = images
+        self.root = os.path.join(
+            cache_dir,
+            f"{model_name}-{weights_hash(weights)}",
+            f"{_name(catalog)}-{_name(images)}",
+        )
+        self._load_index()
+
+    def _segments(self):
+        """(array file, index file) of every completed segment, in order."""
+        return [
+            (f"{fn[:-len('.csv')]}.npy", fn)
+            for fn in sorted(glob(os.path.join(self.root, "seg-*.csv")))
+        ]
+
+    def _load_index(self):
+        self.arrays, self.index = [], {}
+        frames = []
+        for seg, (array_fn, index_fn) in enumerate(self._segments()):
+            df = pd.read_csv(index_fn, dtype={"id": str})
+            self.arrays.append(np.load(array_fn, mmap_mode="r"))
+            for row, i in enumerate(df["id"]):
+                self.index[i] = (seg, row)
+            frames.append(df)
+        self.table = (
+            pd.concat(frames, ignore_index=True).drop_duplicates("id", keep="last").set_index("id")
+            if frames else pd.DataFrame(columns=["logfgas_pred"], index=pd.Index([], name="id"))
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, i):
+        return str(i) in self.index
+
+    def missing(self, ids):
+        return [i for i in map(str, ids) if i not in self.index]
+
+    def _source_fingerprints(self, ids, suffix=".jpg"):
+        """(mtime_ns, size) of the image source of each ID; (-1, -1) for
+        missing files."""
+        images = open_images(self.images)
+        if isinstance(images, PackedImageStore):
+            st = os.stat(images.array_fn)
+            return [(st.st_mtime_ns, st.st_size)] * len(ids)
+        fingerprints = []
+        for i in ids:
+            try:
+                st = os.stat(os.path.join(images, f"{i}{suffix}"))
+                fingerprints.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                fingerprints.append((-1, -1))
+        return fingerprints
+
+    def _load_failed(self):
+        fn = os.path.join(self.root, "failed.csv")
+        if not os.path.isfile(fn):
+            return {}
+        df = pd.read_csv(fn, dtype={"id": str})
+        return {i: (int(m), int(n)) for i, m, n in zip(df["id"], df["mtime_ns"], df["size"])}
+
+    def _write_failed(self, failed):
+        os.makedirs(self.root, exist_ok=True)
+        fn = os.path.join(self.root, "failed.csv")
+        pd.DataFrame(
+            [(i, m, n) for i, (m, n) in failed.items()], columns=["id", "mtime_ns", "size"]
+        ).to_csv(f"{fn}.part", index=False)
+        os.replace(f"{fn}.part", fn)
+
+    def _next_prefix(self):
+        segments = self._segments()
+        seg = int(os.path.basename(segments[-1][1])[len("seg-"):-len(".csv")]) + 1 if segments else 0
+        return os.path.join(self.root, f"seg-{seg:05d}")
+
+    def _write_segment(self, feats, preds, ids):
+        os.makedirs(self.root, exist_ok=True)
+        prefix = self._next_prefix()
+        _save_array(f"{prefix}.npy", np.concatenate(feats))
+        # the index is written last; a segment without one is ignored
+        pd.DataFrame({"id": ids, "logfgas_pred": np.concatenate(preds)}).to_csv(
+            f"{prefix}.csv.part", index=False
+        )
+        os.replace(f"{prefix}.csv.part", f"{prefix}.csv")
+
+    def update(self, ids, model=None, sz=224, bs=64, n_workers=0, act="mish", flush_every=50):
+        """Compute and append embeddings for the `ids` not yet cached,
+        writing a segment every `flush_every` batches. Rows whose images
+        are missing are recorded as failed and skipped until their source
+        changes. Returns the number of new rows."""
+        todo = self.missing(ids)
+        fingerprints = dict(zip(todo, self._source_fingerprints(todo)))
+        failed = self._load_failed()
+        # skip images that failed before and have not changed since
+        todo = [i for i in todo if failed.get(i) != fingerprints[i]]
+        if not todo:
+            return 0
+        if model is None:
+            model = load_model(self.model_name, self.weights, act=act)
+
+        loader = make_loader(todo, open_images(self.images), sz=sz, bs=bs, n_workers=n_workers)
+        feats, preds, new_ids = [], [], []
+        n_new, n_batches, offset = 0, 0, 0
+        for f, p, ok in embed_batches(model, loader):
+            batch = np.array(todo[offset:offset + len(ok)])
+            feats.append(f[ok])
+            preds.append(p[ok])
+            new_ids.extend(batch[ok])
+            failed.update((i, fingerprints[i]) for i in batch[~ok])
+            offset += len(ok)
+            n_batches += 1
+            if new_ids and n_batches % flush_every == 0:
+                self._write_segment(feats, preds, new_ids)
+                self._write_failed(failed)
+                n_new += len(new_ids)
+                feats, preds, new_ids = [], [], []
+        if new_ids:
+            self._write_segment(feats, preds, new_ids)
+            n_new += len(new_ids)
+        self._write_failed(failed)
+
+        self._load_index()
+        return n_new
+
+    def embeddings(self, ids):
+        """(len(ids), D) float32 array of cached embeddings; raises
+        KeyError for IDs that have not been computed."""
+        locs = [self.index[str(i)] for i in ids]
+        dim = self.arrays[0].shape[1] if self.arrays else 0
+        out = np.empty((len(locs), dim), dtype=np.float32)
+        for n, (seg, row) in enumerate(locs):
+            out[n] = self.arrays[seg][row]
+        return out
+
+    def predictions(self, ids):
+        """logfgas predictions for `ids`, as a numpy array."""
+        return self.table.loc[[str(i) for i in ids], "logfgas_pred"].to_numpy()
+
+    def compact(self, chunk=65536):
+        """Merge all segments into one, to keep reads sequential after many
+        incremental updates.
+
+        The merged segment is written after the existing ones (array, then
+        index), and the old segments are removed only once it is complete,
+        so a crash at any point leaves a readable cache."""
+        segments = self._segments()
+        if len(segments) < 2:
+            return
+        ids = list(self.index)
+        dim = self.arrays[0].shape[1]
+
+        prefix = self._next_prefix()
+        arr = np.lib.format.open_memmap(
+            f"{prefix}.npy.part", mode="w+", dtype=np.float32, shape=(len(ids), dim)
+        )
+        for start in range(0, len(ids), chunk):
+            arr[start:start + chunk] = self.embeddings(ids[start:start + chunk])
+        arr.flush()
+        del arr
+        os.replace(f"{prefix}.npy.part", f"{prefix}.npy")
+        pd.DataFrame({"id": ids, "logfgas_pred": self.predictions(ids)}).to_csv(
+            f"{prefix}.csv.part", index=False
+        )
+        os.replace(f"{prefix}.csv.part", f"{prefix}.csv")
+
+        self.arrays = []
+        for array_fn, index_fn in segments:
+            os.remove(index_fn)
+            os.remove(array_fn)
+        self._load_index()
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-OC", help="image folder or packed store prefix")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=64, help="batch size")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="data loader workers")
+    parser.add_option("--compact", dest="compact", action="store_true", default=False, help="merge segments afterwards")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    ids = pd.read_csv(opt.cat, usecols=[opt.cols])[opt.cols].tolist()
+    cache = EmbeddingCache(opt.model, opt.weights, opt.cat, opt.images)
+    n_new = cache.update(ids, sz=opt.sz, bs=opt.bs, n_workers=opt.workers, act=opt.act)
+    if opt.compact:
+        cache.compact()
+
+    print(f"{cache.root}: {len(cache)} embeddings cached ({n_new} new)")
+
+
+if __name__ == "__main__":
+    main()
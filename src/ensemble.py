@@ -0,0 +1,224 @@
+"""
+John F. Wu
+
+Train an ensemble of models in parallel and gather them into one file.
+
+Each member is a run of `train_alfalfa.py` or `train_xGASS.py` with the
+same command line options (given after `--`), differing only in its
+training seed and/or architecture. The images are decoded once, into the
+packed store of `image_cache.py`, which every worker opens as a read-only
+memory map; with `--shm` the store is first copied to /dev/shm, so all
+workers share a single copy in RAM. Each worker is pinned to its own set
+of cores with a matching number of torch threads, so that N concurrent
+runs do not oversubscribe the CPU; with fewer cores than `--workers *
+--threads`, each run gets `cores // workers` threads (at least one).
+
+The validation split is fixed by the training script's `--seed`, so all
+members are evaluated on the same galaxies. The output holds every
+member's weights and validation predictions, and the image size `--sz`
+the members were trained at (`ensemble_predict.py` checks it):
+
+    {
+        "script", "train_args", "sz",
+        "members": [{"name", "model", "act", "seed", "sz", "state_dict"}, ...],
+        "valid_ids", "valid_targets",
+        "valid_preds": (n_members, n_valid) tensor,
+    }
+
+Usage:
+    python ensemble.py --script alfalfa --seeds 0,1,2,3 --workers 4 \
+        --out ../models/a40-ensemble.pth -- --model mxresnet34 --n_epochs 30
+"""
+
+from optparse import OptionParser
+import importlib
+import multiprocessing as mp
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from image_cache import cached_store
+from packed_images import store_paths
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# catalog, ID column and image folder used by each training script
+SCRIPTS = {
+    "alfalfa": ("a40-SDSS_gas-frac.csv", "AGCNr", "images-OC"),
+    "xGASS": ("xGASS_representative_sample.csv", "GASS", "images-xGASS"),
+}
+
+
+def share_store(store, shm_dir):
+    """Copy a packed store into `shm_dir` (normally under /dev/shm) and
+    return the new prefix."""
+    prefix = os.path.join(shm_dir, os.path.basename(store.prefix))
+    for src, dst in zip(store_paths(store.prefix), store_paths(prefix)):
+        shutil.copyfile(src, dst)
+    return prefix
+
+
+def available_cores():
+    """Cores this process may run on."""
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+        else list(range(os.cpu_count()))
+
+
+def worker_threads(n_workers, threads):
+    """`threads`, capped so that `n_workers` concurrent runs fit on the
+    available cores."""
+    return max(1, min(threads, len(available_cores()) // n_workers))
+
+
+def core_sets(n_workers, threads):
+    """Disjoint sets of `threads` cores for each worker; with more workers
+    than cores, one core each, shared round-robin."""
+    cores = available_cores()
+    return [cores[i * threads:(i + 1) * threads] or [cores[i % len(cores)]] for i in range(n_workers)]
+
+
+def _init_worker(cores, threads, loader_workers):
+    my_cores = cores.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, my_cores)
+    torch.set_num_threads(threads)
+
+    from fastai.core import defaults
+
+    defaults.cpus = loader_workers
+
+
+def train_member(task):
+    """Train one member and return its weights and validation predictions."""
+    from fastai.basic_data import DatasetType
+
+    script, train_args, name, model, seed, prefix, sz = task
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    mod = importlib.import_module(f"train_{script}")
+    sys.argv = [
+        f"train_{script}.py", *train_args,
+        "--model", model, "--sz", str(sz), "--packed", prefix, "--save", name, "--checkpoint-every", "0",
+    ]
+    opt, _ = mod.command_line()
+
+    learn = mod.get_learner(opt)
+    mod.train(learn, opt)
+
+    preds, targets = learn.get_preds(ds_type=DatasetType.Valid)
+    model = learn.model.cpu()
+    return dict(
+        name=name,
+        model=opt.model,
+        act=opt.act,
+        seed=seed,
+        sz=opt.sz,
+        state_dict={k: v.cpu() for k, v in model.state_dict().items()},
+        valid_ids=list(learn.data.valid_ds.x.items),
+        valid_preds=preds.view(-1),
+        valid_targets=targets.view(-1),
+    )
+
+
+def run_ensemble(script, train_args, seeds, models, n_workers, threads, shm=False, loader_workers=1, sz=224):
+    """Train every (model, seed) combination on a pool of `n_workers`
+    processes and return the gathered ensemble dict."""
+    cat, cols, folder = SCRIPTS[script]
+    ids = pd.read_csv(f"{PATH}/data/{cat}", usecols=[cols])[cols]
+    store = cached_store(ids, f"{PATH}/{folder}", sz)
+
+    shm_dir = tempfile.mkdtemp(prefix="hi-convnets-", dir="/dev/shm") if shm else None
+    try:
+        prefix = share_store(store, shm_dir) if shm else store.prefix
+        tasks = [
+            (script, train_args, f"{model}-seed{seed}", model, seed, prefix, sz)
+            for model in models for seed in seeds
+        ]
+
+        threads = worker_threads(n_workers, threads)
+        ctx = mp.get_context("spawn")
+        cores = ctx.Queue()
+        for c in core_sets(n_workers, threads):
+            cores.put(c)
+        with ctx.Pool(n_workers, initializer=_init_worker, initargs=(cores, threads, loader_workers)) as pool:
+            members = pool.map(train_member, tasks, chunksize=1)
+    finally:
+        if shm_dir is not None:
+            shutil.rmtree(shm_dir, ignore_errors=True)
+
+    valid_ids = members[0]["valid_ids"]
+    for m in members[1:]:
+        assert m["valid_ids"] == valid_ids, "members were validated on different galaxies"
+    assert all(m["sz"] == sz for m in members), "members were trained at a different image size"
+
+    return dict(
+        script=script,
+        train_args=train_args,
+        sz=sz,
+        members=[{k: m[k] for k in ["name", "model", "act", "seed", "sz", "state_dict"]} for m in members],
+        valid_ids=valid_ids,
+        valid_targets=members[0]["valid_targets"],
+        valid_preds=torch.stack([m["valid_preds"] for m in members]),
+    )
+
+
+def rmse(p, y):
+    return ((p - y) ** 2).mean().sqrt().item()
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    Options after `--` are passed to the training script.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options] -- [training script options]\n")
+    parser.add_option("--script", dest="script", default="alfalfa", help="`alfalfa` or `xGASS`")
+    parser.add_option("--seeds", dest="seeds", default="0,1,2,3", help="comma-separated training seeds")
+    parser.add_option("--models", dest="models", default="mxresnet50", help="comma-separated architectures")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="concurrent training runs")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch threads per run")
+    parser.add_option("--loader-workers", dest="loader_workers", type=int, default=1, help="data loader workers per run")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size of the shared store and of training")
+    parser.add_option("--shm", dest="shm", action="store_true", default=False, help="copy the decoded images to /dev/shm")
+    parser.add_option("--out", dest="out", default=f"{PATH}/models/ensemble.pth", help="ensemble output file")
+
+    argv = sys.argv[1:]
+    train_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+    (options, args) = parser.parse_args(argv)
+    options.seeds = [int(s) for s in options.seeds.split(",")]
+    options.models = options.models.split(",")
+    if options.threads is None:
+        options.threads = max(1, (os.cpu_count() - options.workers * options.loader_workers) // options.workers)
+
+    return options, train_args
+
+
+def main():
+
+    opt, train_args = cmdline()
+
+    ensemble = run_ensemble(
+        opt.script, train_args, opt.seeds, opt.models, opt.workers, opt.threads,
+        shm=opt.shm, loader_workers=opt.loader_workers, sz=opt.sz,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(opt.out)), exist_ok=True)
+    torch.save(ensemble, opt.out)
+
+    y, preds = ensemble["valid_targets"], ensemble["valid_preds"]
+    for m, p in zip(ensemble["members"], preds):
+        print(f"{m['name']:>24}: validation RMSE {rmse(p, y):.4f} dex")
+    print(f"{'ensemble mean':>24}: validation RMSE {rmse(preds.mean(0), y):.4f} dex")
+    print(f"Saved {len(preds)} members to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
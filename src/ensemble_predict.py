@@ -0,0 +1,208 @@
+"""
+John F. Wu
+
+Ensemble inference: K models evaluated on each decoded batch in one pass.
+
+`StackedEnsemble` takes K trained MXResNets, folds each one for inference
+(`optimize_inference.py`) and stacks their parameters, so a batch is
+decoded once and evaluated by all members with `torch.func.vmap`. Members
+of different architectures are grouped and each group is stacked
+separately; `method="loop"` instead runs the members one after another on
+the same batch, which is useful on older PyTorch versions.
+
+Members come either from an ensemble file written by `ensemble.py` or
+from a list of weight files of one architecture. The output has the
+ensemble mean and spread, and the prediction of every member:
+
+    id, logfgas_pred, logfgas_std, member_0, ..., member_{K-1}
+
+Usage:
+    python ensemble_predict.py --ensemble ../models/a40-ensemble.pth \
+        --cat ../data/NIBLES_clean.csv --cols nibles_id --images ../images-nibles \
+        --out ../results/nibles-ensemble.csv
+"""
+
+from optparse import OptionParser
+import copy
+import os
+import time
+
+import pandas as pd
+import torch
+from torch import nn
+
+from optimize_inference import optimize_for_inference
+from predict import (
+    Printer, PredictionWriter, build_model, load_weights, make_loader, open_images,
+)
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def load_members(ensemble=None, weights=(), model="mxresnet50", act="mish", sz=None):
+    """List of `(name, arch, model)` from an `ensemble.py` file or from
+    weight files of architecture `model`. Raises ValueError if `sz` is not
+    the image size the ensemble was trained at."""
+    members = []
+    if ensemble:
+        saved = torch.load(ensemble, map_location="cpu")
+        if sz is not None and saved.get("sz", sz) != sz:
+            raise ValueError(f"{ensemble} was trained at --sz {saved['sz']}, not {sz}")
+        for m in saved["members"]:
+            net = build_model(m["model"], act=m["act"])
+            net.load_state_dict(m["state_dict"])
+            members.append((m["name"], m["model"], net.eval()))
+    for fname in weights:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        members.append((name, model, load_weights(build_model(model, act=act), fname).eval()))
+    return members
+
+
+class _StackedGroup(nn.Module):
+    """Members of one architecture with stacked parameters.
+
+    The stacked tensors are registered as buffers (`param_0`, ...,
+    `buffer_0`, ...), so `.to(device)` and `state_dict` see them."""
+
+    def __init__(self, models):
+        super().__init__()
+        from torch.func import functional_call, stack_module_state
+
+        params, buffers = stack_module_state(models)
+        self.param_names, self.buffer_names = list(params), list(buffers)
+        for n, name in enumerate(self.param_names):
+            self.register_buffer(f"param_{n}", params[name].detach())
+        for n, name in enumerate(self.buffer_names):
+            self.register_buffer(f"buffer_{n}", buffers[name])
+        base = copy.deepcopy(models[0]).to("meta")
+
+        def call(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        self.call = torch.func.vmap(call, in_dims=(0, 0, None))
+
+    def stacked_params(self):
+        return {name: getattr(self, f"param_{n}") for n, name in enumerate(self.param_names)}
+
+    def stacked_buffers(self):
+        return {name: getattr(self, f"buffer_{n}") for n, name in enumerate(self.buffer_names)}
+
+    def forward(self, x):
+        return self.call(self.stacked_params(), self.stacked_buffers(), x)
+
+
+class _LoopGroup(nn.Module):
+    def __init__(self, models):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+
+    def forward(self, x):
+        return torch.stack([m(x) for m in self.models])
+
+
+class StackedEnsemble(nn.Module):
+    """Evaluate `members` (from `load_members`) on a batch; `forward`
+    returns a (K, B) tensor of predictions in member order."""
+
+    def __init__(self, members, method="vmap"):
+        super().__init__()
+        self.names = [name for name, _, _ in members]
+        group_cls = _StackedGroup if method == "vmap" else _LoopGroup
+
+        groups = {}
+        for k, (_, arch, model) in enumerate(members):
+            groups.setdefault(arch, []).append((k, optimize_for_inference(model)))
+        self.order = [k for g in groups.values() for k, _ in g]
+        self.groups = nn.ModuleList([group_cls([m for _, m in g]) for g in groups.values()])
+
+    @torch.no_grad()
+    def forward(self, x):
+        out = torch.cat([g(x).view(-1, len(x)) for g in self.groups])
+        # back to member order
+        return out[torch.argsort(torch.tensor(self.order))]
+
+
+def predict_ensemble(
+    ensemble, cat, id_col, images, out, sz=224, bs=64, n_workers=0, chunksize=20000,
+    suffix=".jpg", progress=True,
+):
+    """Stream mean, spread and per-member predictions for every row of the
+    catalog CSV `cat` into `out`. Returns `(n_rows, images_per_sec)`."""
+    images = open_images(images)
+    member_cols = [f"member_{k}" for k in range(len(ensemble.names))]
+    n_rows = 0
+    start = time.perf_counter()
+
+    with PredictionWriter(out) as writer:
+        for chunk in pd.read_csv(cat, usecols=[id_col], chunksize=chunksize):
+            ids = chunk[id_col].tolist()
+            loader = make_loader(ids, images, sz=sz, bs=bs, n_workers=n_workers, suffix=suffix)
+
+            offset = 0
+            for xb, ok in loader:
+                preds = ensemble(xb).double()
+                preds[:, ~ok] = float("nan")
+                df = pd.DataFrame(preds.T.numpy(), columns=member_cols)
+                df.insert(0, "logfgas_std", preds.std(0).numpy())
+                df.insert(0, "logfgas_pred", preds.mean(0).numpy())
+                df.insert(0, "id", ids[offset:offset + len(xb)])
+                writer.write(df)
+
+                offset += len(xb)
+                n_rows += len(xb)
+                if progress:
+                    Printer(f"{n_rows} predictions ({n_rows / (time.perf_counter() - start):.1f} images/sec)")
+
+    if progress:
+        print("")
+    return n_rows, n_rows / (time.perf_counter() - start)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options] [weights ...]\n")
+    parser.add_option("--ensemble", dest="ensemble", default="", help="ensemble file from `ensemble.py`")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="architecture of the weight files")
+    parser.add_option("--act", dest="act", default="mish", help="activation of the weight files")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/NIBLES_clean.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="nibles_id", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-nibles", help="image folder or packed store prefix")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--method", dest="method", default="vmap", help="`vmap` (stacked weights) or `loop`")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/ensemble-predictions.csv", help="output CSV or .parquet")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=64, help="batch size")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="data loader workers")
+    parser.add_option("--chunksize", dest="chunksize", type=int, default=20000, help="catalog rows per chunk")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, weights = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    try:
+        members = load_members(opt.ensemble, weights, model=opt.model, act=opt.act, sz=opt.sz)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if not members:
+        raise SystemExit("Please give an --ensemble file or weight files")
+    ensemble = StackedEnsemble(members, method=opt.method).eval()
+
+    n_rows, rate = predict_ensemble(
+        ensemble, opt.cat, opt.cols, opt.images, opt.out, sz=opt.sz, bs=opt.bs,
+        n_workers=opt.workers, chunksize=opt.chunksize, suffix=opt.suffix,
+    )
+    print(f"Wrote {n_rows} predictions of {len(members)} members to {opt.out} at {rate:.1f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
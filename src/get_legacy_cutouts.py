@@ -9,25 +9,16 @@ Default size is now 448x448 (ImageNet-inspired).
 
 from optparse import OptionParser
 import pandas as pd
-import skimage.io
 
 import os
-import time
-import sys
-import urllib
+
+from cutout_downloader import CutoutDownloader, Job
+from cutout_manifest import CutoutManifest
 
 # assuming that this is being run in the ${ROOT}/src directory
 PATH = os.path.abspath("..")
 
 
-class Printer:
-    """Print things to stdout on one line dynamically"""
-
-    def __init__(self, data):
-        sys.stdout.write("\r\x1b[K" + data.__str__())
-        sys.stdout.flush()
-
-
 def cmdline():
     """ Controls the command line argument handling for this little program.
     """
@@ -55,6 +46,40 @@ def cmdline():
         # default=f'{PATH}/../xgass-convnets/data/xGASS_representative_sample.csv',
         help="Catalog to get image names from.",
     )
+    parser.add_option(
+        "--threads",
+        dest="threads",
+        type=int,
+        default=8,
+        help="Number of concurrent download threads",
+    )
+    parser.add_option(
+        "--rate",
+        dest="rate",
+        type=float,
+        default=10,
+        help="Maximum requests per second to the cutout service",
+    )
+    parser.add_option(
+        "--manifest",
+        dest="manifest",
+        default=None,
+        help="Download manifest (default: manifest.sqlite in the output path)",
+    )
+    parser.add_option(
+        "--status",
+        dest="status",
+        action="store_true",
+        default=False,
+        help="Report what is left to download and exit",
+    )
+    parser.add_option(
+        "--adopt",
+        dest="adopt",
+        action="store_true",
+        default=False,
+        help="Also record images in the output path whose download previously failed",
+    )
 
     (options, args) = parser.parse_args()
 
@@ -74,30 +99,44 @@ def main():
     # remove trailing slash in output path if it's there.
     opt.output = opt.output.rstrip("\/")
 
-    # total number of images
-    n_gals = df.shape[0]
-
-    for row in df.itertuples():
-        url = (
-            "http://legacysurvey.org/viewer/cutout.jpg"
-            "?ra={}"
-            "&dec={}"
-            "&pixscale={}"
-            "&layer=dr8"
-            "&size={}".format(row.RAdeg_OC, row.DECdeg_OC, pixscale, size)
-        )
-        if not os.path.isfile(f"{opt.output}/{row.AGCNr}.jpg"):
-            try:
-                img = skimage.io.imread(url)
-                skimage.io.imsave(f"{opt.output}/{row.AGCNr}.jpg", img)
-                time.sleep(0.1)
-            except urllib.error.HTTPError:
-                pass
-        current = row.Index / n_gals * 100
-        status = "{:.3f}% of {} completed.".format(current, n_gals)
-        Printer(status)
-
-    print("")
+    if opt.manifest is None:
+        opt.manifest = f"{opt.output}/manifest.sqlite"
+    ids = df.AGCNr.tolist()
+
+    with CutoutManifest(opt.manifest, "legacy", "dr8", f"{size}@{pixscale}") as manifest:
+        # `--status` reports from the manifest alone, without the image folder
+        if opt.status:
+            print(manifest.report(ids))
+            return
+
+        # images on disk that the manifest has never seen are not fetched
+        # again; `--adopt` also takes over previously failed ones
+        n_adopted = manifest.adopt(ids, opt.output, unseen_only=not opt.adopt)
+        if n_adopted:
+            print(f"Adopted {n_adopted} existing images into {opt.manifest}")
+
+        print(manifest.report(ids))
+
+        pending = set(map(str, manifest.pending(ids)))
+
+        jobs = []
+        for row in df.itertuples():
+            if str(row.AGCNr) not in pending:
+                continue
+            url = (
+                "https://www.legacysurvey.org/viewer/cutout.jpg"
+                "?ra={}"
+                "&dec={}"
+                "&pixscale={}"
+                "&layer=dr8"
+                "&size={}".format(row.RAdeg_OC, row.DECdeg_OC, pixscale, size)
+            )
+            jobs.append(Job(row.AGCNr, url, f"{opt.output}/{row.AGCNr}.jpg"))
+
+        downloader = CutoutDownloader(n_threads=opt.threads, rate=opt.rate)
+        report = downloader.download(jobs, on_result=manifest.record_result)
+        print(report.summary())
+        print(manifest.report(ids))
 
 
 if __name__ == "__main__":
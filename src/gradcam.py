@@ -0,0 +1,207 @@
+"""
+John F. Wu
+
+Batched Grad-CAM maps for whole catalogs.
+
+`GradCAM` registers a single forward hook on one MXResNet stage and, for
+each batch, takes the gradient of the predicted logfgas with respect to
+that stage's activations in one backward pass. Because the network is in
+eval mode, every prediction depends only on its own image, so the
+gradient of the batch sum gives every galaxy's map at once. Parameters
+are frozen, so the backward pass only runs through the layers after the
+hooked stage.
+
+`catalog_cams` streams a catalog through the model and writes the maps to
+a float16 memory-mapped array aligned with the catalog IDs:
+
+    {out}.npy           float16 (N, map_sz, map_sz), NaN for missing images
+    {out}-index.csv     id plus optional summary statistics
+
+The statistics (`cam_stats`) locate the heat-weighted centroid of each
+map relative to the image center and measure how concentrated it is, so
+unusual attention patterns can be found without looking at every map.
+
+Usage:
+    python gradcam.py --cat ../data/a40-SDSS_gas-frac.csv --cols AGCNr \
+        --images ../images-OC --weights ../models/best_a40.pth \
+        --out ../results/gradcam/a40 --stats
+"""
+
+from optparse import OptionParser
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from numpy.lib.format import open_memmap
+
+from predict import Printer, load_model, make_loader, open_images
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# MXResNet is Sequential: 3 stem convs, max pool, 4 residual stages, ...
+FIRST_STAGE = 4
+
+
+class GradCAM:
+    """Grad-CAM on residual stage `stage` (1-4) of an MXResNet.
+
+    With `sign=-1` the maps highlight regions that lower the prediction
+    instead of raising it.
+    """
+
+    def __init__(self, model, stage=4, sign=1):
+        self.model = model.eval()
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        self.sign = sign
+        self.acts = None
+        self.hook = model[FIRST_STAGE + stage - 1].register_forward_hook(self._hook)
+
+    def _hook(self, module, input, output):
+        # the graph starts here, so backward stops at this stage
+        output.requires_grad_(True)
+        self.acts = output
+
+    def remove(self):
+        self.hook.remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.remove()
+
+    def __call__(self, xb, size=None):
+        """(B, h, w) maps for batch `xb`, each scaled to a maximum of 1, and
+        the (B,) predictions. Maps are resized to `size` if given."""
+        with torch.enable_grad():
+            preds = self.model(xb).view(-1)
+            grads, = torch.autograd.grad(self.sign * preds.sum(), self.acts)
+
+        weights = grads.mean(dim=(2, 3), keepdim=True)
+        cams = F.relu((weights * self.acts.detach()).sum(1, keepdim=True))
+        if size is not None:
+            cams = F.interpolate(cams, size=(size, size), mode="bilinear", align_corners=False)
+        cams = cams[:, 0]
+        peak = cams.flatten(1).max(1)[0].clamp_min(1e-12)
+        self.acts = None
+        return cams / peak.view(-1, 1, 1), preds.detach()
+
+
+def cam_stats(cams, r_inner=0.25):
+    """Summary statistics of a (B, h, w) stack of maps, as a dict of (B,)
+    arrays. Positions are in units of the image size, relative to the
+    image center:
+
+        cx, cy          heat-weighted centroid
+        offset          distance of the centroid from the center
+        radius          heat-weighted rms radius about the centroid
+        concentration   fraction of heat within `r_inner` of the center
+    """
+    cams = np.asarray(cams, dtype=np.float64)
+    _, h, w = cams.shape
+    y, x = np.meshgrid((np.arange(h) + 0.5) / h - 0.5, (np.arange(w) + 0.5) / w - 0.5, indexing="ij")
+    total = cams.sum(axis=(1, 2))
+    norm = np.where(total > 0, total, np.nan)
+
+    cx = (cams * x).sum(axis=(1, 2)) / norm
+    cy = (cams * y).sum(axis=(1, 2)) / norm
+    r2 = (x[None] - cx[:, None, None]) ** 2 + (y[None] - cy[:, None, None]) ** 2
+    radius = np.sqrt((cams * r2).sum(axis=(1, 2)) / norm)
+    inner = (x ** 2 + y ** 2) <= r_inner ** 2
+    concentration = (cams * inner).sum(axis=(1, 2)) / norm
+
+    return dict(cx=cx, cy=cy, offset=np.hypot(cx, cy), radius=radius, concentration=concentration)
+
+
+def catalog_cams(
+    model, ids, images, out, stage=4, sz=224, map_sz=56, bs=32, n_workers=0,
+    suffix=".jpg", stats=True, sign=1, progress=True,
+):
+    """Write Grad-CAM maps for every ID in `ids` to `{out}.npy` and the
+    aligned index (with statistics) to `{out}-index.csv`. Returns the
+    index DataFrame."""
+    ids = [str(i) for i in ids]
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    maps = open_memmap(f"{out}.npy", mode="w+", dtype=np.float16, shape=(len(ids), map_sz, map_sz))
+
+    loader = make_loader(ids, open_images(images), sz=sz, bs=bs, n_workers=n_workers, suffix=suffix)
+    preds = np.full(len(ids), np.nan)
+    columns = {}
+    offset = 0
+    start = time.perf_counter()
+
+    with GradCAM(model, stage=stage, sign=sign) as gradcam:
+        for xb, ok in loader:
+            cams, p = gradcam(xb, size=map_sz)
+            cams, ok = cams.numpy(), ok.numpy()
+            cams[~ok] = np.nan
+            sl = slice(offset, offset + len(ok))
+            maps[sl] = cams
+            preds[sl] = np.where(ok, p.numpy(), np.nan)
+
+            if stats:
+                for k, v in cam_stats(np.nan_to_num(cams)).items():
+                    columns.setdefault(k, np.full(len(ids), np.nan))[sl] = np.where(ok, v, np.nan)
+
+            offset += len(ok)
+            if progress:
+                Printer(f"{offset}/{len(ids)} maps ({offset / (time.perf_counter() - start):.1f} images/sec)")
+
+    if progress:
+        print("")
+    maps.flush()
+    del maps
+
+    index = pd.DataFrame({"id": ids, "logfgas_pred": preds, **columns})
+    index.to_csv(f"{out}-index.csv", index=False)
+    return index
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-OC", help="image folder or packed store prefix")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--stage", dest="stage", type=int, default=4, help="residual stage to hook (1-4)")
+    parser.add_option("--negative", dest="negative", action="store_true", default=False, help="regions lowering the prediction")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--map-sz", dest="map_sz", type=int, default=56, help="size of the stored maps")
+    parser.add_option("--bs", dest="bs", type=int, default=32, help="batch size")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="data loader workers")
+    parser.add_option("--stats", dest="stats", action="store_true", default=False, help="add centroid/concentration statistics")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/gradcam/a40", help="output prefix")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    model = load_model(opt.model, opt.weights, act=opt.act)
+    ids = pd.read_csv(opt.cat, usecols=[opt.cols])[opt.cols].tolist()
+
+    index = catalog_cams(
+        model, ids, opt.images, opt.out, stage=opt.stage, sz=opt.sz, map_sz=opt.map_sz,
+        bs=opt.bs, n_workers=opt.workers, suffix=opt.suffix, stats=opt.stats,
+        sign=-1 if opt.negative else 1,
+    )
+    print(f"Wrote {len(index)} Grad-CAM maps to {opt.out}.npy "
+          f"({index.logfgas_pred.isna().sum()} missing images)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+John F. Wu
+
+On-disk cache of cutouts pre-resized to the training `--sz`.
+
+The Legacy cutouts are downloaded at 448 px while we train at 112, 224 or
+448 px, so `src.transform(tfms, size=opt.sz)` would otherwise resample
+every image in every epoch. The cache keeps one packed store (see
+`packed_images.py`) per (image folder, suffix, sz) under `{PATH}/cache`,
+named after the folder plus a hash of its absolute path and the suffix.
+Each entry remembers the modification time and size of its source file,
+so changed or new cutouts are re-decoded while everything else is copied
+over from the previous store. Files that cannot be decoded are listed,
+with their fingerprints, in `{prefix}-failed.csv`, so they are not
+retried (and do not trigger a rebuild) until they change on disk. The
+index also records the mtime and size of the array it was written with,
+so an index left next to a different array by an interrupted rebuild is
+not trusted.
+
+Usage:
+    python image_cache.py --folder images-OC --sz 224
+    python image_cache.py --self-test
+"""
+
+from optparse import OptionParser
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from packed_images import PackedImageStore, decode_images, store_paths, truncate_store
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CACHE_DIR = f"{PATH}/cache"
+
+
+def cache_prefix(folder, sz, suffix=".jpg", cache_dir=CACHE_DIR):
+    """Prefix of the cached store for the image `folder` at size `sz`."""
+    folder = os.path.abspath(folder)
+    name = os.path.basename(os.path.normpath(folder))
+    key = hashlib.sha1(f"{folder}{os.pathsep}{suffix}".encode()).hexdigest()[:8]
+    return f"{cache_dir}/{name}-{key}-{sz}"
+
+
+def scan_sources(folder, suffix=".jpg"):
+    """Map image ID -> (mtime_ns, size) for every file in `folder`, using a
+    single directory listing."""
+    sources = {}
+    for entry in os.scandir(folder):
+        if entry.name.endswith(suffix) and entry.is_file():
+            st = entry.stat()
+            sources[entry.name[: -len(suffix)]] = (st.st_mtime_ns, st.st_size)
+    return sources
+
+
+def _cached_fingerprints(prefix):
+    """Map image ID -> (row, mtime_ns, size) of an existing cache entry."""
+    if not PackedImageStore.exists(prefix):
+        return {}
+    array_fn, index_fn = store_paths(prefix)
+    index = pd.read_csv(index_fn, dtype={"id": str})
+    if not {"mtime_ns", "size", "array_mtime_ns", "array_size"}.issubset(index.columns):
+        return {}
+    st = os.stat(array_fn)
+    if len(index) and (index["array_mtime_ns"].iloc[0], index["array_size"].iloc[0]) != (st.st_mtime_ns, st.st_size):
+        # the array was replaced without this index (interrupted rebuild)
+        return {}
+    return {
+        i: (row, int(mtime_ns), int(size))
+        for row, (i, mtime_ns, size) in enumerate(
+            zip(index["id"], index["mtime_ns"], index["size"])
+        )
+    }
+
+
+def failed_path(prefix):
+    return f"{prefix}-failed.csv"
+
+
+def _failed_fingerprints(prefix):
+    """Map image ID -> (mtime_ns, size) of source files that could not be
+    decoded when the cache at `prefix` was built."""
+    fn = failed_path(prefix)
+    if not os.path.isfile(fn):
+        return {}
+    failed = pd.read_csv(fn, dtype={"id": str})
+    return {
+        i: (int(mtime_ns), int(size))
+        for i, mtime_ns, size in zip(failed["id"], failed["mtime_ns"], failed["size"])
+    }
+
+
+def cached_store(ids, folder, sz, suffix=".jpg", cache_dir=CACHE_DIR, n_workers=None):
+    """Return a `PackedImageStore` of `folder` resized to `sz` that contains
+    every one of `ids` with an image on disk, (re)building the cache first
+    if any of them are new or their source files have changed.
+    """
+    prefix = cache_prefix(folder, sz, suffix=suffix, cache_dir=cache_dir)
+    sources = scan_sources(folder, suffix=suffix)
+    cached = _cached_fingerprints(prefix)
+    failed = _failed_fingerprints(prefix)
+
+    def is_fresh(i):
+        return i in cached and cached[i][1:] == sources.get(i)
+
+    def failed_before(i):
+        return failed.get(i) == sources.get(i)
+
+    wanted = [str(i) for i in ids if str(i) in sources]
+    stale = [i for i in wanted if not is_fresh(i) and not failed_before(i)]
+    if not stale and PackedImageStore.exists(prefix):
+        return PackedImageStore(prefix)
+
+    # keep every still-valid entry, even if not requested by this catalog,
+    # since different catalogs share the same image folder
+    keep = [i for i in cached if is_fresh(i)]
+    still_failed = [i for i in failed if i in sources and failed_before(i)]
+    new_ids = keep + list(dict.fromkeys(stale))
+    print(
+        f"Caching {len(stale)} images from {folder} at sz={sz} "
+        f"({len(keep)} cached entries reused)"
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    array_fn, index_fn = store_paths(prefix)
+    tmp_fn = f"{array_fn}.{os.getpid()}.part"
+    arr = np.lib.format.open_memmap(
+        tmp_fn, mode="w+", dtype=np.uint8, shape=(len(new_ids), 3, sz, sz)
+    )
+
+    if keep:
+        old = np.load(array_fn, mmap_mode="r")
+        for row, i in enumerate(keep):
+            arr[row] = old[cached[i][0]]
+        del old
+
+    packed = list(keep)
+    to_decode = new_ids[len(keep):]
+    fnames = [os.path.join(folder, f"{i}{suffix}") for i in to_decode]
+    for i, img in zip(to_decode, decode_images(fnames, sz, n_workers=n_workers)):
+        if img is None:
+            still_failed.append(i)
+            continue
+        arr[len(packed)] = img
+        packed.append(i)
+    arr.flush()
+    del arr
+
+    # drop unreadable images from the end of the array
+    truncate_store(tmp_fn, len(packed))
+
+    # ties the index to this array; os.replace keeps the mtime
+    st = os.stat(tmp_fn)
+    index = pd.DataFrame(
+        {
+            "id": packed,
+            "mtime_ns": [sources[i][0] for i in packed],
+            "size": [sources[i][1] for i in packed],
+            "array_mtime_ns": st.st_mtime_ns,
+            "array_size": st.st_size,
+        }
+    )
+    index.to_csv(f"{index_fn}.{os.getpid()}.part", index=False)
+    failures = pd.DataFrame(
+        {
+            "id": still_failed,
+            "mtime_ns": [sources[i][0] for i in still_failed],
+            "size": [sources[i][1] for i in still_failed],
+        }
+    )
+    failures.to_csv(f"{failed_path(prefix)}.{os.getpid()}.part", index=False)
+    os.replace(tmp_fn, array_fn)
+    os.replace(f"{index_fn}.{os.getpid()}.part", index_fn)
+    os.replace(f"{failed_path(prefix)}.{os.getpid()}.part", failed_path(prefix))
+    if still_failed:
+        print(f"{len(still_failed)} unreadable images listed in {failed_path(prefix)}")
+
+    return PackedImageStore(prefix)
+
+
+def self_test(n_images=8, sz=32):
+    """Build a cache of a folder with one unreadable JPEG and check that a
+    second call reuses it instead of rebuilding."""
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "images")
+        os.makedirs(folder)
+        rng = np.random.RandomState(0)
+        for i in range(n_images):
+            Image.fromarray(rng.randint(0, 255, (48, 48, 3), dtype=np.uint8)).save(f"{folder}/{i}.jpg")
+        with open(f"{folder}/{n_images}.jpg", "wb") as f:
+            f.write(b"not a jpeg")
+        ids = list(range(n_images + 1))
+
+        cache_dir = os.path.join(tmp, "cache")
+        store = cached_store(ids, folder, sz, cache_dir=cache_dir, n_workers=2)
+        assert len(store) == n_images, len(store)
+        array_fn, _ = store_paths(store.prefix)
+        built = os.stat(array_fn).st_mtime_ns
+
+        store = cached_store(ids, folder, sz, cache_dir=cache_dir, n_workers=2)
+        assert os.stat(array_fn).st_mtime_ns == built, "cache was rebuilt for an unreadable image"
+        assert str(n_images) not in store
+
+        # an array that does not match its index (interrupted rebuild) is not trusted
+        os.utime(array_fn, ns=(built + 10 ** 9, built + 10 ** 9))
+        store = cached_store(ids, folder, sz, cache_dir=cache_dir, n_workers=2)
+        assert os.stat(array_fn).st_mtime_ns != built + 10 ** 9, "mismatched array was reused"
+
+        # a repaired file is picked up
+        Image.fromarray(rng.randint(0, 255, (48, 48, 3), dtype=np.uint8)).save(f"{folder}/{n_images}.jpg")
+        store = cached_store(ids, folder, sz, cache_dir=cache_dir, n_workers=2)
+        assert len(store) == n_images + 1 and str(n_images) in store
+    print("Self-test passed: unreadable images do not trigger a rebuild, mismatched arrays do")
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option(
+        "--cat",
+        dest="cat",
+        default=f"{PATH}/data/a40-SDSS_gas-frac.csv",
+        help="Catalog to get image names from.",
+    )
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--folder", dest="folder", default="images-OC", help="image folder relative to PATH")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--sz", dest="sz", type=int, action="append", help="image size(s) to cache")
+    parser.add_option("--workers", dest="workers", type=int, default=None, help="decoding processes")
+    parser.add_option("--self-test", dest="self_test", action="store_true", default=False, help="run on a synthetic folder")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    if opt.self_test:
+        self_test()
+        return
+
+    df = pd.read_csv(opt.cat)
+    for sz in opt.sz or [224]:
+        store = cached_store(
+            df[opt.cols], f"{PATH}/{opt.folder}", sz, suffix=opt.suffix, n_workers=opt.workers
+        )
+        print(f"{store.prefix}: {len(store)} images at sz={sz}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+John F. Wu
+
+Per-phase timing and profiling callbacks for fastai training runs.
+
+`PhaseTimer` splits every training batch into
+
+    data        waiting for the DataLoader (decoding, augmentation, collation)
+    forward     model forward pass and loss
+    backward    loss.backward()
+    step        optimizer step, excluding the lookahead sync
+    lookahead   `Ranger.lookahead_step` (slow weight update every k steps)
+
+and writes one JSON line per batch and one summary line per epoch,
+including samples/sec and the peak resident set size of the process.
+
+`ProfilerCallback` records a `torch.profiler` trace of a window of
+training steps and writes it as a Chrome trace (open in
+chrome://tracing or Perfetto), plus a table of the most expensive ops.
+
+Both are enabled from the training scripts with `--instrument` and
+`--profile-steps`.
+"""
+
+from fastai.basic_train import LearnerCallback
+
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+
+
+def _now():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+PHASES = ["data", "forward", "backward", "step", "lookahead"]
+
+
+class PhaseTimer(LearnerCallback):
+    """Write per-batch and per-epoch phase timings of training batches to
+    the JSONL file `fname`."""
+
+    def __init__(self, learn, fname):
+        super().__init__(learn)
+        self.fname = fname
+
+    def _timed_lookahead(self, lookahead_step):
+        def timed():
+            start = _now()
+            lookahead_step()
+            self.lookahead += _now() - start
+
+        return timed
+
+    def on_train_begin(self, **kwargs):
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        self.file = open(self.fname, "a")
+        # time the lookahead sync separately from the rest of the step
+        self.opt = self.learn.opt.opt
+        if hasattr(self.opt, "lookahead_step"):
+            self.opt.__dict__.pop("lookahead_step", None)
+            self.opt.lookahead_step = self._timed_lookahead(self.opt.lookahead_step)
+
+    def on_epoch_begin(self, **kwargs):
+        self.epoch_totals = dict.fromkeys(PHASES, 0.0)
+        self.epoch_samples = 0
+        self.epoch_start = self.last = _now()
+
+    def on_batch_begin(self, last_input, train, **kwargs):
+        now = _now()
+        if train:
+            self.times = {"data": now - self.last}
+            self.bs = len(last_input)
+            self.lookahead = 0.0
+        self.last = now
+
+    def on_loss_begin(self, train, **kwargs):
+        if train:
+            now = _now()
+            self.times["forward"] = now - self.last
+            self.last = now
+
+    def on_backward_begin(self, train, **kwargs):
+        if train:
+            # the loss is computed between `on_loss_begin` and here
+            now = _now()
+            self.times["forward"] += now - self.last
+            self.last = now
+
+    def on_backward_end(self, train, **kwargs):
+        if train:
+            now = _now()
+            self.times["backward"] = now - self.last
+            self.last = now
+
+    def on_step_end(self, train, **kwargs):
+        if train:
+            now = _now()
+            self.times["step"] = now - self.last - self.lookahead
+            self.times["lookahead"] = self.lookahead
+            self.last = now
+
+    def on_batch_end(self, epoch, iteration, train, **kwargs):
+        now = _now()
+        if not train:
+            self.last = now
+            return
+        self.times["step"] += now - self.last  # zero_grad
+        self.last = now
+
+        total = sum(self.times.values())
+        for k in PHASES:
+            self.epoch_totals[k] += self.times[k]
+        self.epoch_samples += self.bs
+        record = dict(
+            type="batch", epoch=epoch, iteration=iteration, bs=self.bs,
+            **{k: round(self.times[k], 6) for k in PHASES},
+            total=round(total, 6), samples_per_sec=round(self.bs / total, 2),
+            peak_rss_mb=round(peak_rss_mb(), 1),
+        )
+        self.file.write(json.dumps(record) + "\n")
+
+    def on_epoch_end(self, epoch, **kwargs):
+        # the epoch total includes validation; phases cover training only
+        wall = _now() - self.epoch_start
+        train = sum(self.epoch_totals.values())
+        record = dict(
+            type="epoch", epoch=epoch, samples=self.epoch_samples,
+            **{k: round(v, 3) for k, v in self.epoch_totals.items()},
+            train=round(train, 3), wall=round(wall, 3),
+            samples_per_sec=round(self.epoch_samples / train, 2) if train else None,
+            peak_rss_mb=round(peak_rss_mb(), 1),
+        )
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def on_train_end(self, **kwargs):
+        self.opt.__dict__.pop("lookahead_step", None)
+        self.file.close()
+
+
+class ProfilerCallback(LearnerCallback):
+    """Profile `n_steps` training steps after skipping `start` steps (plus
+    one warm-up step), writing a Chrome trace to `fname` and an op summary
+    to `fname` with a `.txt` extension."""
+
+    def __init__(self, learn, fname, start=10, n_steps=5):
+        super().__init__(learn)
+        self.fname, self.start, self.n_steps = str(fname), start, n_steps
+
+    def _on_trace_ready(self, prof):
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        prof.export_chrome_trace(self.fname)
+        with open(os.path.splitext(self.fname)[0] + ".txt", "w") as f:
+            f.write(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=40))
+        print(f"\nWrote profiler trace of {self.n_steps} steps to {self.fname}")
+
+    def on_train_begin(self, **kwargs):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.start, warmup=1, active=self.n_steps, repeat=1),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.prof.__enter__()
+
+    def on_batch_end(self, train, **kwargs):
+        if train:
+            self.prof.step()
+
+    def on_train_end(self, **kwargs):
+        self.prof.__exit__(None, None, None)
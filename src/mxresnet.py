@@ -5,7 +5,9 @@
 import torch.nn as nn
 import torch,math,sys
 import torch.utils.model_zoo as model_zoo
+from contextlib import contextmanager
 from functools import partial
+from torch.utils.checkpoint import checkpoint
 #from ...torch_core import Module
 from fastai.torch_core import Module
 
@@ -23,10 +25,60 @@ class Mish(nn.Module):
 
         return x
 
+class MishFunction(torch.autograd.Function):
+    "Mish that saves only its input for backward and recomputes the rest."
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return x.mul(torch.tanh(F.softplus(x)))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        tanh_sp = torch.tanh(F.softplus(x))
+        return grad_output * (tanh_sp + x * torch.sigmoid(x) * (1 - tanh_sp * tanh_sp))
+
+@torch.jit.script
+def mish_jit_fwd(x):
+    return x.mul(torch.tanh(F.softplus(x)))
+
+@torch.jit.script
+def mish_jit_bwd(x, grad_output):
+    tanh_sp = torch.tanh(F.softplus(x))
+    return grad_output * (tanh_sp + x * torch.sigmoid(x) * (1 - tanh_sp * tanh_sp))
+
+class MishJitFunction(torch.autograd.Function):
+    "Same as `MishFunction`, with TorchScript-fused forward and backward kernels."
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return mish_jit_fwd(x)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        return mish_jit_bwd(x, grad_output)
+
+class MemoryEfficientMish(nn.Module):
+    def forward(self, x): return MishFunction.apply(x)
+
+class MishJit(nn.Module):
+    def forward(self, x): return MishJitFunction.apply(x)
+
 # or: ELU+init (a=0.54; gain=1.55)
 act_fn = Mish()#nn.ReLU(inplace=True)
 
-__all__ = ['MXResNet', 'mxresnet18', 'mxresnet34', 'mxresnet50', 'mxresnet101', 'mxresnet152']
+# activations selectable with e.g. `mxresnet50(act='memory_efficient')`
+acts = {'mish': lambda: act_fn, 'memory_efficient': MemoryEfficientMish, 'jit': MishJit,
+        'relu': partial(nn.ReLU, inplace=True)}
+
+def get_act(act='mish'):
+    if isinstance(act, nn.Module): return act
+    if act not in acts: raise ValueError(f'Unknown activation: {act}; choose from {list(acts)}')
+    return acts[act]()
+
+__all__ = ['MXResNet', 'mxresnet18', 'mxresnet34', 'mxresnet50', 'mxresnet101', 'mxresnet152',
+           'CheckpointedStage', 'Mish', 'MemoryEfficientMish', 'MishJit', 'get_act']
 
 # or: ELU+init (a=0.54; gain=1.55)
 act_fn = Mish() #nn.ReLU(inplace=True)
@@ -44,7 +96,7 @@ def conv(ni, nf, ks=3, stride=1, bias=False):
 
 def noop(x): return x
 
-def conv_layer(ni, nf, ks=3, stride=1, zero_bn=False, act=True):
+def conv_layer(ni, nf, ks=3, stride=1, zero_bn=False, act=True, act_fn=act_fn):
     bn = nn.BatchNorm2d(nf)
     nn.init.constant_(bn.weight, 0. if zero_bn else 1.)
     layers = [conv(ni, nf, ks, stride=stride), bn]
@@ -52,36 +104,63 @@ def conv_layer(ni, nf, ks=3, stride=1, zero_bn=False, act=True):
     return nn.Sequential(*layers)
 
 class ResBlock(Module):
-    def __init__(self, expansion, ni, nh, stride=1):
+    def __init__(self, expansion, ni, nh, stride=1, act_fn=act_fn):
         nf,ni = nh*expansion,ni*expansion
-        layers  = [conv_layer(ni, nh, 3, stride=stride),
+        layers  = [conv_layer(ni, nh, 3, stride=stride, act_fn=act_fn),
                    conv_layer(nh, nf, 3, zero_bn=True, act=False)
         ] if expansion == 1 else [
-                   conv_layer(ni, nh, 1),
-                   conv_layer(nh, nh, 3, stride=stride),
+                   conv_layer(ni, nh, 1, act_fn=act_fn),
+                   conv_layer(nh, nh, 3, stride=stride, act_fn=act_fn),
                    conv_layer(nh, nf, 1, zero_bn=True, act=False)
         ]
         self.convs = nn.Sequential(*layers)
         # TODO: check whether act=True works better
         self.idconv = noop if ni==nf else conv_layer(ni, nf, 1, act=False)
         self.pool = noop if stride==1 else nn.AvgPool2d(2, ceil_mode=True)
-
-    def forward(self, x): return act_fn(self.convs(x) + self.idconv(self.pool(x)))
+        self.act_fn = act_fn
+
+    def forward(self, x): return self.act_fn(self.convs(x) + self.idconv(self.pool(x)))
+
+@contextmanager
+def frozen_bn_stats(m):
+    "Undo the BatchNorm running-stat updates made inside the block, e.g. by a recomputed forward pass."
+    bns = [b for b in m.modules() if isinstance(b, nn.modules.batchnorm._BatchNorm) and b.track_running_stats]
+    saved = [(b.running_mean.clone(), b.running_var.clone(), b.num_batches_tracked.clone()) for b in bns]
+    try: yield
+    finally:
+        with torch.no_grad():
+            for b,(mean,var,n) in zip(bns, saved):
+                b.running_mean.copy_(mean); b.running_var.copy_(var); b.num_batches_tracked.copy_(n)
+
+class CheckpointedStage(nn.Sequential):
+    "A `_make_layer` stage whose activations are recomputed in backward instead of stored."
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()): return super().forward(x)
+        calls = []
+        def run(x):
+            # the recomputation must not update the BatchNorm statistics a second time
+            if calls:
+                with frozen_bn_stats(self): return nn.Sequential.forward(self, x)
+            calls.append(x)
+            return nn.Sequential.forward(self, x)
+        return checkpoint(run, x, use_reentrant=False)
 
 def filt_sz(recep): return min(64, 2**math.floor(math.log2(recep*0.75)))
 
 class MXResNet(nn.Sequential):
-    def __init__(self, expansion, layers, c_in=3, c_out=1000):
+    def __init__(self, expansion, layers, c_in=3, c_out=1000, act='mish', checkpoint_stages=False):
+        act_fn = get_act(act)
         stem = []
         sizes = [c_in,32,64,64]  #modified per Grankin
         for i in range(3):
-            stem.append(conv_layer(sizes[i], sizes[i+1], stride=2 if i==0 else 1))
+            stem.append(conv_layer(sizes[i], sizes[i+1], stride=2 if i==0 else 1, act_fn=act_fn))
             #nf = filt_sz(c_in*9)
             #stem.append(conv_layer(c_in, nf, stride=2 if i==1 else 1))
             #c_in = nf
 
         block_szs = [64//expansion,64,128,256,512]
-        blocks = [self._make_layer(expansion, block_szs[i], block_szs[i+1], l, 1 if i==0 else 2)
+        blocks = [self._make_layer(expansion, block_szs[i], block_szs[i+1], l, 1 if i==0 else 2, act_fn,
+                                   checkpoint=checkpoint_stages)
                   for i,l in enumerate(layers)]
         super().__init__(
             *stem,
@@ -92,9 +171,9 @@ class MXResNet(nn.Sequential):
         )
         init_cnn(self)
 
-    def _make_layer(self, expansion, ni, nf, blocks, stride):
-        return nn.Sequential(
-            *[ResBlock(expansion, ni if i==0 else nf, nf, stride if i==0 else 1)
+    def _make_layer(self, expansion, ni, nf, blocks, stride, act_fn=act_fn, checkpoint=False):
+        return (CheckpointedStage if checkpoint else nn.Sequential)(
+            *[ResBlock(expansion, ni if i==0 else nf, nf, stride if i==0 else 1, act_fn=act_fn)
               for i in range(blocks)])
 
 def mxresnet(expansion, n_layers, name, pretrained=False, **kwargs):
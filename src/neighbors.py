@@ -0,0 +1,202 @@
+"""
+John F. Wu
+
+Nearest-neighbor index over MXResNet embeddings for confidence scoring.
+
+The "Assigning confidences" analysis asks how close a test galaxy sits to
+the training set in PCA-reduced activation space. `EmbeddingIndex` fits the
+PCA once on the training embeddings and builds either an exact KD-tree/
+ball tree or an approximate inverted-file (IVF) index over them. Batched
+queries return the k nearest training galaxies, and `confidence` turns the
+mean k-NN distance into a score in [0, 1]: the fraction of training
+galaxies whose own (leave-one-out) k-NN distance is at least as large. A
+score near 1 means the galaxy is as well covered by the training set as a
+typical training galaxy; near 0 means it lies off the training manifold.
+
+Usage:
+    python neighbors.py --train-cat ../data/a40-SDSS_gas-frac.csv --train-cols AGCNr \
+        --train-images ../images-OC --cat ../data/NIBLES_clean.csv --cols nibles_id \
+        --images ../images-nibles --weights ../models/best_a40.pth
+"""
+
+from optparse import OptionParser
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
+from sklearn.neighbors import BallTree
+
+from embeddings import EmbeddingCache
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class IVFIndex:
+    """Approximate k-NN with an inverted file: points are bucketed by their
+    nearest k-means centroid, and a query only scans the `n_probe` buckets
+    with the closest centroids. Queries are processed bucket by bucket, so
+    each step is a dense (queries x bucket) distance computation."""
+
+    def __init__(self, X, n_list=None, n_probe=8, seed=12345):
+        self.X = np.ascontiguousarray(X, dtype=np.float32)
+        n_list = n_list or max(1, int(np.sqrt(len(X))))
+        self.kmeans = MiniBatchKMeans(n_clusters=n_list, random_state=seed, n_init=3).fit(self.X)
+        self.centroids = self.kmeans.cluster_centers_.astype(np.float32)
+        labels = self.kmeans.labels_
+        self.buckets = [np.flatnonzero(labels == c) for c in range(n_list)]
+        self.n_probe = min(n_probe, n_list)
+
+    def query(self, Q, k):
+        Q = np.ascontiguousarray(Q, dtype=np.float32)
+        best_d = np.full((len(Q), k), np.inf, dtype=np.float32)
+        best_i = np.full((len(Q), k), -1, dtype=np.int64)
+
+        probes = np.argsort(_sq_dists(Q, self.centroids), axis=1)[:, : self.n_probe]
+        for c, bucket in enumerate(self.buckets):
+            q_idx = np.flatnonzero((probes == c).any(axis=1))
+            if len(q_idx) == 0 or len(bucket) == 0:
+                continue
+            d = _sq_dists(Q[q_idx], self.X[bucket])
+            cand_d = np.concatenate([best_d[q_idx], d], axis=1)
+            cand_i = np.concatenate([best_i[q_idx], np.broadcast_to(bucket, d.shape)], axis=1)
+            top = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            best_d[q_idx] = np.take_along_axis(cand_d, top, axis=1)
+            best_i[q_idx] = np.take_along_axis(cand_i, top, axis=1)
+
+        order = np.argsort(best_d, axis=1)
+        best_d = np.sqrt(np.maximum(np.take_along_axis(best_d, order, axis=1), 0))
+        return best_d, np.take_along_axis(best_i, order, axis=1)
+
+
+def _sq_dists(A, B):
+    """Squared Euclidean distances between the rows of A and B."""
+    d = (A ** 2).sum(1)[:, None] - 2 * A @ B.T + (B ** 2).sum(1)[None, :]
+    return np.maximum(d, 0)
+
+
+class EmbeddingIndex:
+    """k-NN index over (optionally PCA-reduced) training embeddings.
+
+    `method` is "kdtree" or "balltree" (exact) or "ivf" (approximate).
+    """
+
+    def __init__(self, train_emb, n_components=10, method="kdtree", k=10,
+                 batch_size=8192, seed=12345, **ivf_kwargs):
+        self.k = k
+        self.method = method
+        self.batch_size = batch_size
+
+        train_emb = np.asarray(train_emb, dtype=np.float32)
+        self.pca = PCA(n_components=n_components, random_state=seed).fit(train_emb) \
+            if n_components else None
+        self.X = self.transform(train_emb)
+
+        if method == "kdtree":
+            self.tree = cKDTree(self.X)
+        elif method == "balltree":
+            self.tree = BallTree(self.X)
+        elif method == "ivf":
+            self.tree = IVFIndex(self.X, seed=seed, **ivf_kwargs)
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+        # leave-one-out k-NN distances of the training set, for calibration
+        d, _ = self.query(self.X, k=k + 1, transformed=True)
+        self.train_dist = np.sort(d[:, 1:].mean(axis=1))
+
+    def transform(self, emb):
+        emb = np.asarray(emb, dtype=np.float32)
+        return self.pca.transform(emb).astype(np.float32) if self.pca is not None else emb
+
+    def _query_batch(self, Q, k):
+        if self.method == "kdtree":
+            d, i = self.tree.query(Q, k=k, workers=-1)
+        else:
+            d, i = self.tree.query(Q, k=k)
+        return np.reshape(d, (len(Q), k)), np.reshape(i, (len(Q), k))
+
+    def query(self, emb, k=None, transformed=False):
+        """Distances and training-set indices of the `k` nearest neighbors
+        of each row of `emb`, processed in batches."""
+        k = k or self.k
+        Q = emb if transformed else self.transform(emb)
+        dists, idxs = [], []
+        for start in range(0, len(Q), self.batch_size):
+            d, i = self._query_batch(Q[start:start + self.batch_size], k)
+            dists.append(d)
+            idxs.append(i)
+        return np.concatenate(dists), np.concatenate(idxs)
+
+    def confidence(self, emb, k=None):
+        """Mean k-NN distance and confidence score for each row of `emb`."""
+        d, _ = self.query(emb, k=k)
+        mean_d = d.mean(axis=1)
+        n = len(self.train_dist)
+        score = 1 - np.searchsorted(self.train_dist, mean_d, side="left") / n
+        return mean_d, score
+
+    def save(self, fname):
+        with open(fname, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, "rb") as f:
+            return pickle.load(f)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--train-cat", dest="train_cat", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="training catalog")
+    parser.add_option("--train-cols", dest="train_cols", default="AGCNr", help="ID column of the training catalog")
+    parser.add_option("--train-images", dest="train_images", default=f"{PATH}/images-OC", help="training images")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/NIBLES_clean.csv", help="catalog to score")
+    parser.add_option("--cols", dest="cols", default="nibles_id", help="ID column of the catalog to score")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-nibles", help="images to score")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--method", dest="method", default="kdtree", help="kdtree, balltree or ivf")
+    parser.add_option("--pca", dest="pca", type=int, default=10, help="PCA components (0 for none)")
+    parser.add_option("--k", dest="k", type=int, default=10, help="number of neighbors")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/confidence/confidences.csv", help="output CSV")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    train_ids = pd.read_csv(opt.train_cat, usecols=[opt.train_cols])[opt.train_cols].tolist()
+    train_cache = EmbeddingCache(opt.model, opt.weights, opt.train_cat, opt.train_images)
+    train_cache.update(train_ids)
+    train_ids = [i for i in train_ids if i in train_cache]
+
+    index = EmbeddingIndex(
+        train_cache.embeddings(train_ids), n_components=opt.pca, method=opt.method, k=opt.k
+    )
+
+    ids = pd.read_csv(opt.cat, usecols=[opt.cols])[opt.cols].tolist()
+    cache = EmbeddingCache(opt.model, opt.weights, opt.cat, opt.images)
+    cache.update(ids)
+    ids = [i for i in ids if i in cache]
+
+    knn_dist, score = index.confidence(cache.embeddings(ids))
+    os.makedirs(os.path.dirname(opt.out), exist_ok=True)
+    pd.DataFrame(
+        {"id": ids, "logfgas_pred": cache.predictions(ids), "knn_dist": knn_dist, "confidence": score}
+    ).to_csv(opt.out, index=False)
+    print(f"Scored {len(ids)} galaxies against {len(train_ids)} training galaxies; wrote {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+John F. Wu
+
+Inference-time graph optimization for MXResNet.
+
+`optimize_for_inference(model)` returns an equivalent eval-only copy in
+which every `conv_layer` (Conv2d -> BatchNorm2d -> act) becomes a single
+Conv2d with the BatchNorm folded into its weights and bias, the `noop`
+shortcut and pooling paths of each `ResBlock` are dropped from the graph
+entirely, and Mish is the plain (scriptable) formulation. The result can
+be exported to TorchScript or ONNX with `export`.
+
+Usage:
+    python optimize_inference.py --model mxresnet50 \
+        --weights ../models/best_a40.pth --out ../models/best_a40-inference.pt
+"""
+
+from optparse import OptionParser
+import copy
+import os
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+import mxresnet
+from mxresnet import MemoryEfficientMish, Mish, MishJit, ResBlock
+from predict import build_model, load_weights
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class InferenceMish(nn.Module):
+    def forward(self, x):
+        return x * torch.tanh(F.softplus(x))
+
+
+def inference_act(act):
+    """Scriptable, autograd-free equivalent of an MXResNet activation."""
+    if isinstance(act, (Mish, MemoryEfficientMish, MishJit)):
+        return InferenceMish()
+    return act
+
+
+def fuse_conv_layer(layer):
+    """Fold a `conv_layer` (Sequential of Conv2d, BatchNorm2d[, act]) into
+    a Conv2d followed by the optional activation."""
+    conv, bn, *act = layer
+    fused = fuse_conv_bn_eval(conv.eval(), bn.eval())
+    return nn.Sequential(fused, *[inference_act(a) for a in act])
+
+
+class FusedResBlock(nn.Module):
+    """`ResBlock` with folded convolutions; identity shortcut and pooling
+    are `None` instead of `noop`, so they do not appear in the graph."""
+
+    def __init__(self, block):
+        super().__init__()
+        self.convs = nn.Sequential(*[fuse_conv_layer(l) for l in block.convs])
+        self.idconv = None if block.idconv is mxresnet.noop else fuse_conv_layer(block.idconv)
+        self.pool = None if block.pool is mxresnet.noop else block.pool
+        self.act = inference_act(block.act_fn)
+
+    def forward(self, x):
+        shortcut = x
+        if self.pool is not None:
+            shortcut = self.pool(shortcut)
+        if self.idconv is not None:
+            shortcut = self.idconv(shortcut)
+        return self.act(self.convs(x) + shortcut)
+
+
+def _optimize(m):
+    if isinstance(m, ResBlock):
+        return FusedResBlock(m)
+    if isinstance(m, nn.Sequential) and len(m) >= 2 and isinstance(m[0], nn.Conv2d) \
+            and isinstance(m[1], nn.BatchNorm2d):
+        return fuse_conv_layer(m)
+    if isinstance(m, nn.Sequential):
+        return nn.Sequential(*[_optimize(c) for c in m])
+    if isinstance(m, mxresnet.Flatten):
+        return nn.Flatten()
+    return inference_act(m)
+
+
+@torch.no_grad()
+def optimize_for_inference(model):
+    """Return an optimized eval-mode copy of the MXResNet `model`; the
+    original is left untouched."""
+    model = copy.deepcopy(model).eval()
+    optimized = nn.Sequential(*[_optimize(m) for m in model])
+    return optimized.eval()
+
+
+def export(model, fname, sz=224, fmt=None):
+    """Export an optimized model as frozen TorchScript (`.pt`) or ONNX
+    (`.onnx`), chosen by `fmt` or the extension of `fname`."""
+    fmt = fmt or ("onnx" if fname.endswith(".onnx") else "torchscript")
+    example = torch.randn(1, 3, sz, sz)
+    with torch.no_grad():
+        if fmt == "onnx":
+            torch.onnx.export(
+                model, example, fname,
+                input_names=["image"], output_names=["logfgas"],
+                dynamic_axes={"image": {0: "batch"}, "logfgas": {0: "batch"}},
+                opset_version=13,
+            )
+        else:
+            scripted = torch.jit.freeze(torch.jit.script(model))
+            torch.jit.save(scripted, fname)
+
+
+def max_abs_diff(model_a, model_b, x):
+    """Largest absolute difference in outputs of two models on `x`."""
+    with torch.no_grad():
+        return (model_a(x) - model_b(x)).abs().max().item()
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--out", dest="out", default=f"{PATH}/models/best_a40-inference.pt", help="output .pt or .onnx")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    model = load_weights(build_model(opt.model, act=opt.act), opt.weights).eval()
+    optimized = optimize_for_inference(model)
+
+    diff = max_abs_diff(model, optimized, torch.randn(4, 3, opt.sz, opt.sz))
+    print(f"Max |difference| between original and optimized outputs: {diff:.2e}")
+
+    export(optimized, opt.out, sz=opt.sz)
+    print(f"Exported optimized {opt.model} to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+John F. Wu
+
+Pack a folder of JPEG cutouts into a single contiguous uint8 array of shape
+(N, 3, sz, sz) with an ID index, and read it back through `np.memmap`.
+
+Training with `ImageList.from_df(..., folder="images-OC", suffix=".jpg")`
+re-opens and JPEG-decodes every file in every epoch. A packed store is
+decoded once; afterwards the data loader only slices pages out of the
+memory-mapped file, and since every worker maps the same file, those
+pages are shared through the OS page cache.
+
+Usage:
+    python packed_images.py --cat ../data/a40-SDSS_gas-frac.csv \
+        --cols AGCNr --folder images-OC --sz 224
+"""
+
+from fastai.vision import Image, ImageList
+
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import PIL.Image
+import torch
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def store_paths(prefix):
+    """Array and index filenames of the packed store at `prefix`."""
+    return f"{prefix}.npy", f"{prefix}-index.csv"
+
+
+def default_prefix(folder, sz):
+    return f"{PATH}/packed/{folder}-{sz}"
+
+
+def load_image(fn, sz):
+    """Decode `fn` as RGB, resize to (sz, sz) and return a (3, sz, sz)
+    uint8 array, or None if the file cannot be read."""
+    try:
+        with PIL.Image.open(fn) as img:
+            img = img.convert("RGB")
+            if img.size != (sz, sz):
+                img = img.resize((sz, sz), PIL.Image.BILINEAR)
+            return np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_image(args):
+    return load_image(*args)
+
+
+def decode_images(fnames, sz, n_workers=None):
+    """Decode `fnames` in a process pool, yielding (3, sz, sz) uint8 arrays
+    (or None for unreadable files) in order."""
+    with Pool(n_workers) as pool:
+        yield from pool.imap(_load_image, [(fn, sz) for fn in fnames], chunksize=64)
+
+
+def truncate_store(array_fn, n):
+    """Shrink the packed array in `array_fn` to its first `n` images."""
+    full = np.load(array_fn, mmap_mode="r")
+    if len(full) == n:
+        return
+    out = np.lib.format.open_memmap(
+        f"{array_fn}.shrink", mode="w+", dtype=np.uint8, shape=(n,) + full.shape[1:]
+    )
+    out[:] = full[:n]
+    out.flush()
+    del out, full
+    os.replace(f"{array_fn}.shrink", array_fn)
+
+
+def pack_images(ids, folder, prefix, sz, suffix=".jpg", n_workers=None):
+    """Decode the images `{folder}/{id}{suffix}` for each of `ids` and pack
+    them into the store at `prefix`. Images that are missing or cannot be
+    decoded are left out of the index. Returns the list of packed IDs.
+    """
+    ids = [str(i) for i in ids]
+    fnames = [os.path.join(folder, f"{i}{suffix}") for i in ids]
+
+    array_fn, index_fn = store_paths(prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(array_fn)), exist_ok=True)
+
+    # write to a temporary file first so a crash never leaves a half-packed
+    # store next to a valid-looking index
+    tmp_fn = f"{array_fn}.part"
+    arr = np.lib.format.open_memmap(
+        tmp_fn, mode="w+", dtype=np.uint8, shape=(len(ids), 3, sz, sz)
+    )
+
+    packed = []
+    for i, img in zip(ids, decode_images(fnames, sz, n_workers=n_workers)):
+        if img is None:
+            continue
+        arr[len(packed)] = img
+        packed.append(i)
+    arr.flush()
+    del arr
+
+    # drop the rows of missing or unreadable images
+    truncate_store(tmp_fn, len(packed))
+    os.replace(tmp_fn, array_fn)
+    pd.DataFrame({"id": packed}).to_csv(index_fn, index=False)
+    return packed
+
+
+class PackedImageStore:
+    """Read-only view of a packed store. The memmap is opened lazily so that
+    the store can be pickled into data loader workers cheaply."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.array_fn, self.index_fn = store_paths(prefix)
+        self.ids = pd.read_csv(self.index_fn, dtype=str)["id"].tolist()
+        self.index = {i: row for row, i in enumerate(self.ids)}
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.load(self.array_fn, mmap_mode="r")
+        return self._array
+
+    @property
+    def sz(self):
+        return self.array.shape[-1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, i):
+        return str(i) in self.index
+
+    def __getitem__(self, i):
+        return self.array[self.index[str(i)]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    @classmethod
+    def exists(cls, prefix):
+        return all(os.path.isfile(fn) for fn in store_paths(prefix))
+
+
+class PackedImageList(ImageList):
+    """`ImageList` whose items are catalog IDs looked up in a
+    `PackedImageStore`, so opening an item does no file I/O or decoding."""
+
+    def __init__(self, *args, store=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.copy_new.append("store")
+
+    def open(self, fn):
+        x = torch.from_numpy(np.array(self.store[fn]))
+        return Image(x.float().div_(255))
+
+    @classmethod
+    def from_df(cls, df, path, cols=0, store=None, **kwargs):
+        """Create from the ID column `cols` of `df`, keeping only the rows
+        present in `store` (a `PackedImageStore` or its prefix)."""
+        if not isinstance(store, PackedImageStore):
+            store = PackedImageStore(store)
+        col = cols if isinstance(cols, str) else df.columns[cols]
+        df = df[df[col].astype(str).isin(store.index)].reset_index(drop=True)
+        res = super(ImageList, cls).from_df(df, path=path, cols=col, store=store, **kwargs)
+        res.items = res.items.astype(str)
+        return res
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option(
+        "--cat",
+        dest="cat",
+        default=f"{PATH}/data/a40-SDSS_gas-frac.csv",
+        help="Catalog to get image names from.",
+    )
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--folder", dest="folder", default="images-OC", help="image folder relative to PATH")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="packed image size")
+    parser.add_option("--output", dest="output", default=None, help="prefix of the packed store")
+    parser.add_option("--workers", dest="workers", type=int, default=None, help="decoding processes")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    df = pd.read_csv(opt.cat)
+    prefix = opt.output or default_prefix(opt.folder, opt.sz)
+
+    packed = pack_images(
+        df[opt.cols],
+        f"{PATH}/{opt.folder}",
+        prefix,
+        opt.sz,
+        suffix=opt.suffix,
+        n_workers=opt.workers,
+    )
+
+    nbytes = len(packed) * 3 * opt.sz ** 2
+    print(f"Packed {len(packed)} of {len(df)} images ({nbytes / 1e9:.2f} GB) into {prefix}.npy")
+    if len(packed) < len(df):
+        sys.exit(f"{len(df) - len(packed)} images were missing or unreadable.")
+
+
+if __name__ == "__main__":
+    main()
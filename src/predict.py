@@ -0,0 +1,283 @@
+"""
+John F. Wu
+
+Batch inference of HI gas mass fractions for a whole catalog.
+
+Reads the catalog in chunks, streams batches of images (from a JPEG
+folder or a packed store, see `packed_images.py`) through a trained
+MXResNet on CPU, and appends `id, logfgas_pred` to a CSV or Parquet file
+as it goes, so memory use does not grow with the size of the catalog.
+With `--tta`, each decoded batch is also expanded on-tensor into flipped
+and rotated copies and the predictions averaged (see `tta.py`).
+
+Usage:
+    python predict.py --cat ../data/NIBLES_clean.csv --cols nibles_id \
+        --images ../images-nibles --model mxresnet50 \
+        --weights ../models/best_a40.pth --out ../results/nibles-preds.csv
+"""
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+
+import mxresnet
+from packed_images import PackedImageStore, load_image
+from scan_cutouts import load_exclusions
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+xGASS_stats = [
+    torch.tensor([-0.0169, -0.0105, -0.0004]),
+    torch.tensor([0.9912, 0.9968, 1.0224]),
+]
+
+
+class Printer:
+    """Print things to stdout on one line dynamically"""
+
+    def __init__(self, data):
+        sys.stdout.write("\r\x1b[K" + data.__str__())
+        sys.stdout.flush()
+
+
+def build_model(name, act="mish"):
+    """Return an MXResNet variant (e.g. "mxresnet50" or "50") with the
+    single-output regression head used by the training scripts."""
+    name = name if name.startswith("mxresnet") else f"mxresnet{name}"
+    if name not in mxresnet.__all__:
+        sys.exit("Please specify a valid model of the `mxresnet` variant")
+    model = getattr(mxresnet, name)(act=act)
+    model[-1] = nn.Linear(model[-1].in_features, 1, bias=True)
+    return model
+
+
+def load_weights(model, fname):
+    """Load weights saved by `learn.save` (with or without optimizer
+    state) or a plain state dict into `model`."""
+    state = torch.load(fname, map_location="cpu")
+    if "model" in state and isinstance(state["model"], dict):
+        state = state["model"]
+    model.load_state_dict(state)
+    return model
+
+
+def load_model(name, weights, act="mish"):
+    """Build the model, load `weights` and put it in eval mode."""
+    return load_weights(build_model(name, act=act), weights).eval()
+
+
+def open_images(images):
+    """Return a packed store if `images` is the prefix (or .npy file) of
+    one, else the image folder path itself."""
+    prefix = images[: -len(".npy")] if images.endswith(".npy") else images
+    if PackedImageStore.exists(prefix):
+        return PackedImageStore(prefix)
+    return images
+
+
+class CatalogImages(Dataset):
+    """Normalized (3, sz, sz) image tensors for a list of catalog IDs.
+
+    Each item is `(x, ok)`, where `ok` is False (and `x` is zeros) if the
+    image is missing, unreadable or excluded (see `scan_cutouts.py`).
+    `exclude` is a collection of IDs or the path of an exclusion list; it
+    defaults to the `exclude.csv` of an image folder. Packed stores do not
+    know their source folder, so pass it explicitly for them.
+    """
+
+    def __init__(self, ids, images, sz=224, suffix=".jpg", stats=xGASS_stats, exclude=None):
+        self.ids = [str(i) for i in ids]
+        self.images = images
+        if exclude is None and isinstance(images, str):
+            exclude = load_exclusions(images)
+        elif isinstance(exclude, str):
+            exclude = load_exclusions(fname=exclude)
+        self.exclude = set(map(str, exclude or ()))
+        self.sz = sz
+        self.suffix = suffix
+        self.mean = stats[0].view(3, 1, 1)
+        self.std = stats[1].view(3, 1, 1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load_uint8(self, i):
+        """Decoded (3, sz, sz) uint8 array of the i-th image, or None."""
+        id_ = self.ids[i]
+        if id_ in self.exclude:
+            return None
+        if isinstance(self.images, PackedImageStore):
+            if id_ not in self.images:
+                return None
+            img = np.array(self.images[id_])
+            if img.shape[-1] != self.sz:
+                img = nn.functional.interpolate(
+                    torch.from_numpy(img)[None].float(), size=(self.sz, self.sz),
+                    mode="bilinear", align_corners=False,
+                )[0].round().clamp(0, 255).byte().numpy()
+            return img
+        return load_image(os.path.join(self.images, f"{id_}{self.suffix}"), self.sz)
+
+    def __getitem__(self, i):
+        img = self.load_uint8(i)
+        if img is None:
+            return torch.zeros(3, self.sz, self.sz), False
+        x = torch.from_numpy(img).float().div_(255)
+        return (x - self.mean) / self.std, True
+
+
+def _worker_init(worker_id):
+    # the main process owns the intra-op threads; workers only decode
+    torch.set_num_threads(1)
+
+
+def make_loader(ids, images, sz=224, bs=64, n_workers=0, suffix=".jpg", exclude=None):
+    return DataLoader(
+        CatalogImages(ids, images, sz=sz, suffix=suffix, exclude=exclude),
+        batch_size=bs,
+        shuffle=False,
+        num_workers=n_workers,
+        worker_init_fn=_worker_init if n_workers > 0 else None,
+    )
+
+
+class PredictionWriter:
+    """Append prediction chunks to a CSV or Parquet (`.parquet`) file."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.parquet = fname.endswith(".parquet")
+        self.writer = None
+        self.n_rows = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.fname, table.schema)
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.fname, mode="a" if self.n_rows else "w", header=not self.n_rows, index=False)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@torch.no_grad()
+def predict_batches(model, loader):
+    """Yield `(preds, ok)` numpy arrays for each batch of `loader`; `preds`
+    is NaN where the image could not be loaded."""
+    for xb, ok in loader:
+        preds = model(xb).view(-1).numpy().astype(np.float64)
+        ok = ok.numpy()
+        preds[~ok] = np.nan
+        yield preds, ok
+
+
+def predict_catalog(
+    model, cat, id_col, images, out, sz=224, bs=64, n_workers=0, chunksize=20000,
+    suffix=".jpg", progress=True, exclude=None,
+):
+    """Stream predictions for every row of the catalog CSV `cat` into
+    `out`. Returns `(n_rows, n_missing, images_per_sec)`."""
+    images = open_images(images)
+    if isinstance(exclude, str):
+        exclude = load_exclusions(fname=exclude)
+    n_rows, n_missing = 0, 0
+    start = time.perf_counter()
+
+    with PredictionWriter(out) as writer:
+        for chunk in pd.read_csv(cat, usecols=[id_col], chunksize=chunksize):
+            ids = chunk[id_col].tolist()
+            loader = make_loader(
+                ids, images, sz=sz, bs=bs, n_workers=n_workers, suffix=suffix, exclude=exclude
+            )
+
+            offset = 0
+            for preds, ok in predict_batches(model, loader):
+                writer.write(
+                    pd.DataFrame({"id": ids[offset:offset + len(preds)], "logfgas_pred": preds})
+                )
+                offset += len(preds)
+                n_rows += len(preds)
+                n_missing += int((~ok).sum())
+                if progress:
+                    rate = n_rows / (time.perf_counter() - start)
+                    Printer(f"{n_rows} predictions ({rate:.1f} images/sec, {n_missing} missing)")
+
+    if progress:
+        print("")
+    return n_rows, n_missing, n_rows / (time.perf_counter() - start)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/NIBLES_clean.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="nibles_id", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-nibles", help="image folder or packed store prefix")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--exclude", dest="exclude", default=None, help="exclusion list CSV (default: exclude.csv of an image folder)")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/predictions.csv", help="output CSV or .parquet")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=64, help="batch size")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="data loader workers")
+    parser.add_option("--chunksize", dest="chunksize", type=int, default=20000, help="catalog rows per chunk")
+    parser.add_option("--tta", dest="tta", default="none", help="test-time augmentation: none, flip, dihedral or dihedral+rot")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    model = load_model(opt.model, opt.weights, act=opt.act)
+    if opt.tta != "none":
+        from tta import TTAModel
+
+        model = TTAModel(model, mode=opt.tta).eval()
+
+    n_rows, n_missing, rate = predict_catalog(
+        model, opt.cat, opt.cols, opt.images, opt.out, sz=opt.sz, bs=opt.bs,
+        n_workers=opt.workers, chunksize=opt.chunksize, suffix=opt.suffix, exclude=opt.exclude,
+    )
+    print(
+        f"Wrote {n_rows} predictions to {opt.out} ({n_missing} missing images) "
+        f"at {rate:.1f} images/sec with {torch.get_num_threads()} threads "
+        f"and {opt.workers} workers"
+    )
+
+
+if __name__ == "__main__":
+    main()
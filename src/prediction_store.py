@@ -0,0 +1,275 @@
+"""
+John F. Wu
+
+Incremental store of catalog predictions.
+
+Predictions are kept in a SQLite database keyed by (catalog ID, model
+weights hash, TTA mode), together with the checksum of the image they
+were computed from. Scoring a catalog looks up every row, recomputes only
+those that are missing or whose image has changed since, and returns the
+merged table, so rescoring a grown catalog or adding new weights only
+runs the network on the difference. Predictions are committed batch by
+batch, so an interrupted run keeps what it has computed. Images that could
+not be scored (unreadable or excluded) are stored with status `missing`
+and a NULL prediction, and are only retried when they change or with
+`--retry-missing`.
+
+Image checksums are SHA-1 digests of the JPEG bytes (or of the row of a
+packed store). They are cached per file by (mtime, size), and per packed
+row by the (mtime, size) of the store's array, so unchanged folders and
+stores are not read again.
+
+Usage:
+    python prediction_store.py --cat ../data/a100.code12.tab1.180315.csv --cols AGCNr \
+        --images ../images-OC --weights ../models/best_a40.pth --out ../results/a100-preds.csv
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from cutout_manifest import checksum
+from embeddings import weights_hash
+from packed_images import PackedImageStore
+from predict import load_model, make_loader, open_images, predict_batches
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    catalog_id TEXT NOT NULL,
+    weights TEXT NOT NULL,
+    tta TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    logfgas_pred REAL,
+    updated REAL,
+    status TEXT NOT NULL DEFAULT 'ok',
+    PRIMARY KEY (catalog_id, weights, tta)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    checksum TEXT
+);
+"""
+
+
+class PredictionStore:
+    """SQLite store of predictions and image checksums."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(predictions)")]
+        if "status" not in columns:
+            # stores written before unscorable images were recorded
+            self.db.execute("ALTER TABLE predictions ADD COLUMN status TEXT NOT NULL DEFAULT 'ok'")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def file_checksums(self, fnames, n_threads=8):
+        """SHA-1 of each file (None if it does not exist), reading only
+        files that are new or changed since they were last hashed."""
+        cached = {
+            path: (mtime, size, digest)
+            for path, mtime, size, digest in self.db.execute("SELECT * FROM files")
+        }
+
+        def digest(fn):
+            try:
+                st = os.stat(fn)
+            except FileNotFoundError:
+                return None, None
+            c = cached.get(fn)
+            if c is not None and c[:2] == (st.st_mtime_ns, st.st_size):
+                return c[2], None
+            with open(fn, "rb") as f:
+                d = checksum(f.read())
+            return d, (fn, st.st_mtime_ns, st.st_size, d)
+
+        with ThreadPoolExecutor(n_threads) as pool:
+            results = list(pool.map(digest, fnames))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", [r for _, r in results if r is not None]
+        )
+        self.db.commit()
+        return [d for d, _ in results]
+
+    def packed_checksums(self, images, ids):
+        """SHA-1 of the row of each ID in the `PackedImageStore` `images`
+        (None if it is not in the store), rehashing rows only when the
+        store's array has changed since they were last hashed."""
+        st = os.stat(images.array_fn)
+        fingerprint = (st.st_mtime_ns, st.st_size)
+        base = f"{images.array_fn}::"
+        # the rows of this store, keyed "{array file}::{id}"
+        cached = {
+            path[len(base):]: digest
+            for path, mtime, size, digest in self.db.execute(
+                "SELECT * FROM files WHERE path >= ? AND path < ?", (base, f"{images.array_fn}:;")
+            )
+            if (mtime, size) == fingerprint
+        }
+
+        digests, new = [], []
+        for i in ids:
+            if i not in images:
+                digests.append(None)
+            elif i in cached:
+                digests.append(cached[i])
+            else:
+                d = checksum(np.ascontiguousarray(images[i]).tobytes())
+                digests.append(d)
+                new.append((f"{base}{i}", *fingerprint, d))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", new)
+        return digests
+
+    def lookup(self, weights, tta):
+        """DataFrame of stored `checksum, logfgas_pred, status` indexed by ID."""
+        return pd.read_sql_query(
+            "SELECT catalog_id, checksum, logfgas_pred, status FROM predictions WHERE weights=? AND tta=?",
+            self.db, params=(weights, tta), index_col="catalog_id",
+        )
+
+    def record(self, ids, checksums, preds, weights, tta):
+        """Store one batch of predictions in its own transaction; NaN
+        predictions are stored as `missing`."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO predictions "
+                "(catalog_id, weights, tta, checksum, logfgas_pred, updated, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (str(i), weights, tta, c, None if np.isnan(p) else float(p), now,
+                     "missing" if np.isnan(p) else "ok")
+                    for i, c, p in zip(ids, checksums, preds)
+                ],
+            )
+
+
+def image_checksums(store, ids, images, suffix=".jpg"):
+    """Checksum of the image of each ID (None where it is missing)."""
+    if isinstance(images, PackedImageStore):
+        return store.packed_checksums(images, ids)
+    return store.file_checksums([os.path.join(images, f"{i}{suffix}") for i in ids])
+
+
+def score_catalog(store, ids, images, model_name, weights, act="mish", tta="none",
+                  sz=224, bs=64, n_workers=0, suffix=".jpg", retry_missing=False, exclude=None):
+    """Merged predictions for `ids`, computing only missing or stale rows
+    (and, with `retry_missing`, rows that could not be scored before).
+    Returns `(DataFrame of id, checksum, logfgas_pred, n_computed)`."""
+    ids = [str(i) for i in ids]
+    images = open_images(images)
+    w_hash = weights_hash(weights)
+    checksums = image_checksums(store, ids, images, suffix=suffix)
+
+    stored = store.lookup(w_hash, tta)
+    stored = stored[~stored.index.duplicated()]
+    old = stored.reindex(ids)
+    fresh = (old.checksum.to_numpy() == np.array(checksums, dtype=object))
+    if retry_missing:
+        fresh &= (old.status.to_numpy() != "missing")
+    todo = [i for i, c, f in zip(ids, checksums, fresh) if c is not None and not f]
+
+    if todo:
+        model = load_model(model_name, weights, act=act)
+        if tta != "none":
+            from tta import TTAModel
+
+            model = TTAModel(model, mode=tta).eval()
+        loader = make_loader(
+            todo, images, sz=sz, bs=bs, n_workers=n_workers, suffix=suffix, exclude=exclude
+        )
+        by_id = dict(zip(ids, checksums))
+        offset = 0
+        for preds, ok in predict_batches(model, loader):
+            batch = todo[offset:offset + len(preds)]
+            store.record(batch, [by_id[i] for i in batch], preds, w_hash, tta)
+            offset += len(preds)
+
+    merged = store.lookup(w_hash, tta)
+    merged = merged[~merged.index.duplicated()].reindex(ids)
+    # rows whose image is missing or changed without a new prediction;
+    # unscorable rows have a NULL prediction
+    valid = merged.checksum.to_numpy() == np.array(checksums, dtype=object)
+    return pd.DataFrame({
+        "id": ids,
+        "checksum": checksums,
+        "logfgas_pred": np.where(valid, merged.logfgas_pred.to_numpy(dtype=np.float64), np.nan),
+    }), len(todo)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-OC", help="image folder or packed store prefix")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--exclude", dest="exclude", default=None, help="exclusion list CSV (default: exclude.csv of an image folder)")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--tta", dest="tta", default="none", help="test-time augmentation: none, flip, dihedral or dihedral+rot")
+    parser.add_option("--retry-missing", dest="retry_missing", action="store_true", default=False, help="rescore images that could not be scored before")
+    parser.add_option("--store", dest="store", default=f"{PATH}/results/predictions.sqlite", help="prediction store")
+    parser.add_option("--out", dest="out", default=f"{PATH}/results/predictions.csv", help="merged output CSV")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=64, help="batch size")
+    parser.add_option("--threads", dest="threads", type=int, default=None, help="torch CPU threads")
+    parser.add_option("--workers", dest="workers", type=int, default=2, help="data loader workers")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    ids = pd.read_csv(opt.cat, usecols=[opt.cols])[opt.cols].tolist()
+    start = time.perf_counter()
+    with PredictionStore(opt.store) as store:
+        df, n_computed = score_catalog(
+            store, ids, opt.images, opt.model, opt.weights, act=opt.act, tta=opt.tta,
+            sz=opt.sz, bs=opt.bs, n_workers=opt.workers, suffix=opt.suffix,
+            retry_missing=opt.retry_missing, exclude=opt.exclude,
+        )
+
+    os.makedirs(os.path.dirname(os.path.abspath(opt.out)), exist_ok=True)
+    df.to_csv(opt.out, index=False)
+    print(
+        f"Scored {len(df)} galaxies ({n_computed} computed, {len(df) - n_computed} from the store, "
+        f"{df.logfgas_pred.isna().sum()} missing) in {time.perf_counter() - start:.1f} s; wrote {opt.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+John F. Wu
+
+Post-training static INT8 quantization of MXResNet for CPU batch scoring.
+
+Starting from the BatchNorm-folded graph of `optimize_inference.py`, we
+insert quant/dequant stubs around the model, turn the residual additions
+into quantized adds, and run Mish in float behind a dequant/quant
+boundary (there is no quantized Mish kernel, and a cheaper approximation
+would change the predictions of the trained network). Observers are
+calibrated on a sample of the training catalog loaded through the usual
+fastai `ImageList` pipeline; we then report the logfgas RMSE of the float
+and INT8 models on the validation split, the RMSE between them (drift),
+and CPU throughput, so one can decide per catalog if INT8 is acceptable.
+
+Usage:
+    python quantize.py --model mxresnet50 --weights ../models/best_a40.pth \
+        --out ../models/best_a40-int8.pt
+"""
+
+from fastai.vision import FloatList, ImageList
+
+from optparse import OptionParser
+import copy
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from optimize_inference import FusedResBlock, InferenceMish, optimize_for_inference
+from predict import build_model, load_weights, xGASS_stats
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class QuantMish(nn.Module):
+    """Mish evaluated in float between a dequant and a quant stub."""
+
+    def __init__(self):
+        super().__init__()
+        self.dequant = tq.DeQuantStub()
+        self.act = InferenceMish()
+        self.quant = tq.QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.act(self.dequant(x)))
+
+
+class QuantResBlock(nn.Module):
+    """`FusedResBlock` with a quantizable residual addition."""
+
+    def __init__(self, block):
+        super().__init__()
+        self.convs = _quantizable(block.convs)
+        self.idconv = None if block.idconv is None else _quantizable(block.idconv)
+        self.pool = block.pool
+        self.act = _quantizable(block.act)
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        shortcut = x
+        if self.pool is not None:
+            shortcut = self.pool(shortcut)
+        if self.idconv is not None:
+            shortcut = self.idconv(shortcut)
+        return self.act(self.skip_add.add(self.convs(x), shortcut))
+
+
+class QuantizableMXResNet(nn.Module):
+    def __init__(self, optimized):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.body = _quantizable(optimized)
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.body(self.quant(x)))
+
+
+def _quantizable(m):
+    if isinstance(m, FusedResBlock):
+        return QuantResBlock(m)
+    if isinstance(m, InferenceMish):
+        return QuantMish()
+    if isinstance(m, nn.Sequential):
+        return nn.Sequential(*[_quantizable(c) for c in m])
+    return m
+
+
+def prepare_model(model, backend="fbgemm"):
+    """Fold and wrap `model` for static quantization and attach observers.
+    The returned model must be calibrated before calling `convert_model`."""
+    torch.backends.quantized.engine = backend
+    qmodel = QuantizableMXResNet(optimize_for_inference(model)).eval()
+    qmodel.qconfig = tq.get_default_qconfig(backend)
+    return tq.prepare(qmodel)
+
+
+@torch.no_grad()
+def calibrate(prepared, batches):
+    for xb in batches:
+        prepared(xb)
+    return prepared
+
+
+def convert_model(prepared):
+    return tq.convert(copy.deepcopy(prepared).eval())
+
+
+def load_data(cat, cols, folder, sz=224, bs=32, val_pct=0.2, seed=12345):
+    """The training catalog as a fastai DataBunch with the same split and
+    normalization as the training scripts, but without augmentation."""
+    df = pd.read_csv(cat)
+    if "logfgas" not in df.columns:
+        df["logfgas"] = df.lgMHI - df.lgMstar
+    src = (
+        ImageList.from_df(df, path=PATH, folder=folder, suffix=".jpg", cols=cols)
+        .split_by_rand_pct(val_pct, seed=seed)
+        .label_from_df(cols=["logfgas"], label_cls=FloatList)
+    )
+    return (
+        src.transform(([], []), size=sz)
+        .databunch(bs=bs, device=torch.device("cpu"))
+        .normalize(xGASS_stats)
+    )
+
+
+@torch.no_grad()
+def predict_dl(model, dl, n_batches=None):
+    preds, targets = [], []
+    for i, (xb, yb) in enumerate(dl):
+        if n_batches is not None and i >= n_batches:
+            break
+        preds.append(model(xb).view(-1))
+        targets.append(yb.view(-1))
+    return torch.cat(preds).numpy(), torch.cat(targets).numpy()
+
+
+def rmse(p, y):
+    return float(np.sqrt(np.mean((p - y) ** 2)))
+
+
+@torch.no_grad()
+def throughput(model, bs=32, sz=224, n_runs=5):
+    """Images per second on a random batch."""
+    x = torch.randn(bs, 3, sz, sz)
+    model(x)
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        model(x)
+    return bs * n_runs / (time.perf_counter() - start)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/a40-SDSS_gas-frac.csv", help="training catalog")
+    parser.add_option("--cols", dest="cols", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--folder", dest="folder", default="images-OC", help="image folder relative to PATH")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=32, help="batch size")
+    parser.add_option("--calib-batches", dest="calib_batches", type=int, default=32, help="calibration batches")
+    parser.add_option("--eval-batches", dest="eval_batches", type=int, default=None, help="validation batches to score")
+    parser.add_option("--backend", dest="backend", default="fbgemm", help="`fbgemm` (x86) or `qnnpack` (ARM)")
+    parser.add_option("--out", dest="out", default=f"{PATH}/models/best_a40-int8.pt", help="TorchScript output")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    model = load_weights(build_model(opt.model, act=opt.act), opt.weights).eval()
+    data = load_data(opt.cat, opt.cols, opt.folder, sz=opt.sz, bs=opt.bs)
+
+    prepared = prepare_model(model, backend=opt.backend)
+    calibrate(prepared, (xb for i, (xb, _) in zip(range(opt.calib_batches), data.train_dl)))
+    qmodel = convert_model(prepared)
+
+    p_float, y = predict_dl(model, data.valid_dl, opt.eval_batches)
+    p_int8, _ = predict_dl(qmodel, data.valid_dl, opt.eval_batches)
+
+    print(f"Validation RMSE (float): {rmse(p_float, y):.4f} dex")
+    print(f"Validation RMSE (INT8):  {rmse(p_int8, y):.4f} dex")
+    print(f"INT8 drift from float:   {rmse(p_int8, p_float):.4f} dex RMSE, "
+          f"{np.abs(p_int8 - p_float).max():.4f} dex max over {len(y)} galaxies")
+
+    ips_float = throughput(model, bs=opt.bs, sz=opt.sz)
+    ips_int8 = throughput(qmodel, bs=opt.bs, sz=opt.sz)
+    print(f"Throughput: {ips_float:.1f} img/s (float), {ips_int8:.1f} img/s (INT8), "
+          f"{ips_int8 / ips_float:.2f}x with {torch.get_num_threads()} threads")
+
+    torch.jit.save(torch.jit.script(qmodel), opt.out)
+    print(f"Saved INT8 model to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -48,8 +48,60 @@ class Ranger(Optimizer):
     def __setstate__(self, state):
         print("set state called")
         super(Ranger, self).__setstate__(state)
+
+    def state_dict(self):
+        #include the lookahead slow weights and radam buffer, which live
+        #outside of the standard optimizer state
+        state = super().state_dict()
+        state['slow_weights'] = [[w.detach().clone() for w in ws] for ws in self.slow_weights]
+        state['radam_buffer'] = [list(b) for b in self.radam_buffer]
+        return state
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        slow_weights = state_dict.pop('slow_weights', None)
+        radam_buffer = state_dict.pop('radam_buffer', None)
+        super().load_state_dict(state_dict)
+
+        if slow_weights is not None:
+            for ws, saved_ws in zip(self.slow_weights, slow_weights):
+                for w, saved in zip(ws, saved_ws):
+                    w.data.copy_(saved)
+        if radam_buffer is not None:
+            self.radam_buffer = [list(b) for b in radam_buffer]
        
         
+    def _radam_step_size(self, group, step):
+        #cached rectification term and step size for this step count
+        beta1, beta2 = group['betas']
+        buffered = self.radam_buffer[int(step % 10)]
+        if step == buffered[0]:
+            N_sma, step_size = buffered[1], buffered[2]
+        else:
+            buffered[0] = step
+            beta2_t = beta2 ** step
+            N_sma_max = 2 / (1 - beta2) - 1
+            N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+            buffered[1] = N_sma
+            if N_sma > 5:
+                step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+            else:
+                step_size = group['lr'] / (1 - beta1 ** step)
+            buffered[2] = step_size
+        return N_sma, step_size
+
+    def lookahead_step(self):
+        #every k steps, pull the slow weights towards the fast ones and reset
+        for group,slow_weights in zip(self.param_groups,self.slow_weights):
+            group['step_counter'] += 1
+            if group['step_counter'] % self.k != 0:
+                continue
+            for p,q in zip(group['params'],slow_weights):
+                if p.grad is None:
+                    continue
+                q.data.add_(self.alpha,p.data - q.data)
+                p.data.copy_(q.data)
+
     def step(self, closure=None):
         loss = None
         #note - below is commented out b/c I have other work that passes back the loss as a float, and thus not a callable closure.  
@@ -87,20 +139,7 @@ class Ranger(Optimizer):
                 exp_avg.mul_(beta1).add_(1 - beta1, grad)
     
                 state['step'] += 1
-                buffered = self.radam_buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
-                else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-                    if N_sma > 5:
-                        step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    else:
-                        step_size = group['lr'] / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
+                N_sma, step_size = self._radam_step_size(group, state['step'])
     
                 if group['weight_decay'] != 0:
                     p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
@@ -117,17 +156,96 @@ class Ranger(Optimizer):
         #---------------- end radam step
         
         #look ahead tracking and updating if latest batch = k
+        self.lookahead_step()
+            
+        return loss
+
+
+class RangerForeach(Ranger):
+    """Ranger with the RAdam and lookahead updates applied to all parameters
+    of a group at once with multi-tensor `torch._foreach_*` ops. It performs
+    the same arithmetic in the same order as `Ranger`, and keeps its state
+    in the same layout, so the two are interchangeable (including for
+    checkpoints).
+    """
+
+    def step(self, closure=None):
+        loss = None
+
+        for group in self.param_groups:
+            #bucket parameters by step count (normally a single bucket)
+            buckets = {}
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError('RAdam does not support sparse gradients')
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p.data, dtype=torch.float32)
+                    state['exp_avg_sq'] = torch.zeros_like(p.data, dtype=torch.float32)
+                else:
+                    state['exp_avg'] = state['exp_avg'].float()
+                    state['exp_avg_sq'] = state['exp_avg_sq'].float()
+                state['step'] += 1
+                buckets.setdefault(state['step'], []).append(p)
+
+            for step, params in buckets.items():
+                self._radam_update(group, params, step)
+
+        self.lookahead_step()
+
+        return loss
+
+    def _radam_update(self, group, params, step):
+        beta1, beta2 = group['betas']
+        N_sma, step_size = self._radam_step_size(group, step)
+
+        #fp32 parameters are updated in place; others through fp32 copies
+        fp32 = all(p.dtype == torch.float32 for p in params)
+        p_data = [p.data if fp32 else p.data.float() for p in params]
+        grads = [p.grad.data.float() for p in params]
+        exp_avgs = [self.state[p]['exp_avg'] for p in params]
+        exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, 1 - beta2)
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+        if group['weight_decay'] != 0:
+            torch._foreach_add_(p_data, p_data, alpha=-group['weight_decay'] * group['lr'])
+
+        if N_sma > 5:
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denoms, group['eps'])
+            torch._foreach_addcdiv_(p_data, exp_avgs, denoms, -step_size)
+        else:
+            torch._foreach_add_(p_data, exp_avgs, alpha=-step_size)
+
+        if not fp32:
+            for p, d in zip(params, p_data):
+                p.data.copy_(d)
+
+    def lookahead_step(self):
         for group,slow_weights in zip(self.param_groups,self.slow_weights):
             group['step_counter'] += 1
             if group['step_counter'] % self.k != 0:
                 continue
-            for p,q in zip(group['params'],slow_weights):
-                if p.grad is None:
-                    continue
-                q.data.add_(self.alpha,p.data - q.data)
-                p.data.copy_(q.data)
-            
-        
-            
-        return loss
+            pairs = [(p.data, q.data) for p,q in zip(group['params'],slow_weights)
+                     if p.grad is not None]
+            if not pairs:
+                continue
+            fast, slow = map(list, zip(*pairs))
+            torch._foreach_add_(slow, torch._foreach_sub(fast, slow), alpha=self.alpha)
+            _foreach_copy_(fast, slow)
+
 
+def _foreach_copy_(dst, src):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
@@ -0,0 +1,235 @@
+"""
+John F. Wu
+
+Integrity scan and duplicate index of a folder of JPEG cutouts.
+
+Failed or off-footprint requests leave blank, truncated or repeated
+images in `images-OC`, `images-legacy`, etc. This script decodes every
+image once, in parallel, and records
+
+    status      ok, empty (zero bytes), unreadable, truncated, constant
+                (no pixel variation) or blank (mostly a single value, e.g.
+                outside the survey footprint)
+    phash       64-bit DCT perceptual hash
+    sha1        checksum of the file, for exact duplicates
+
+in `{folder}/scan.csv`. Pairs of images whose perceptual hashes differ in
+at most `--max-distance` bits are written to `{folder}/duplicates.csv`;
+they are found by splitting the hashes into `max_distance + 1` bands, of
+which a close pair must share at least one, so only images in the same
+band bucket are compared.
+
+Every image that is not `ok` (and, with `--exclude-duplicates`, all but
+one image of each group of near-duplicates) is listed in
+`{folder}/exclude.csv`, which the training scripts and the inference
+loaders in `predict.py` skip.
+
+Usage:
+    python scan_cutouts.py --folder ../images-OC --workers 8 --exclude-duplicates
+"""
+
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy.fft import dctn
+
+from cutout_manifest import checksum
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+EXCLUDE_FNAME = "exclude.csv"
+
+
+def phash(gray):
+    """64-bit perceptual hash of a 2-d grayscale image: signs of the
+    low-frequency DCT coefficients of a 32x32 thumbnail relative to their
+    median."""
+    thumb = np.asarray(Image.fromarray(gray).resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    low = dctn(thumb, norm="ortho")[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def scan_image(fname, blank_frac=0.9):
+    """Status and hashes of one image file."""
+    row = dict(id=os.path.splitext(os.path.basename(fname))[0], status="ok", nbytes=0,
+               sha1=None, phash=None, mean=np.nan, std=np.nan)
+    with open(fname, "rb") as f:
+        data = f.read()
+    row["nbytes"] = len(data)
+    if not data:
+        row["status"] = "empty"
+        return row
+    row["sha1"] = checksum(data)
+
+    try:
+        img = Image.open(fname)
+        img.load()
+        arr = np.asarray(img.convert("RGB"))
+    except OSError as e:
+        row["status"] = "truncated" if "truncated" in str(e) else "unreadable"
+        return row
+    if img.format == "JPEG" and not data.rstrip(b"\x00").endswith(b"\xff\xd9"):
+        row["status"] = "truncated"
+
+    row["mean"], row["std"] = float(arr.mean()), float(arr.std())
+    gray = np.asarray(Image.fromarray(arr).convert("L"))
+    if gray.max() - gray.min() <= 2:
+        row["status"] = "constant"
+    elif row["status"] == "ok":
+        counts = np.bincount(gray.ravel(), minlength=256)
+        if counts.max() >= blank_frac * gray.size:
+            row["status"] = "blank"
+    row["phash"] = f"{phash(gray):016x}"
+    return row
+
+
+def _popcount(x):
+    x = x.astype(np.uint64)
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(1)
+
+
+def near_duplicates(ids, hashes, max_distance=6, chunk=1024, max_bucket=20000):
+    """DataFrame of `id_a, id_b, distance` for every pair of 64-bit
+    `hashes` within `max_distance` bits of each other.
+
+    Buckets are compared `chunk` rows at a time, so memory stays
+    O(chunk * bucket). Buckets larger than `max_bucket` (e.g. thousands of
+    saturated cutouts sharing one band) are skipped with a warning; such
+    images are better caught by their scan status."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n_bands = max_distance + 1
+    edges = np.linspace(0, 64, n_bands + 1).astype(int)
+
+    pairs = set()
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        band = (hashes >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+        order = np.argsort(band, kind="stable")
+        bounds = np.flatnonzero(np.diff(band[order])) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) < 2:
+                continue
+            if len(bucket) > max_bucket:
+                print(f"Skipping {len(bucket)} images sharing hash band {lo}-{hi}")
+                continue
+            h = hashes[bucket]
+            for start in range(0, len(bucket), chunk):
+                # only compare each row with the rows after it
+                rows = h[start:start + chunk]
+                d = _popcount(rows[:, None] ^ h[None, start:]).reshape(len(rows), len(h) - start)
+                a, b = np.nonzero(np.triu(d <= max_distance, k=1))
+                pairs.update(
+                    (min(i, j), max(i, j), int(dist))
+                    for i, j, dist in zip(bucket[start + a], bucket[start + b], d[a, b])
+                )
+
+    pairs = sorted(pairs)
+    return pd.DataFrame(
+        [(ids[i], ids[j], dist) for i, j, dist in pairs], columns=["id_a", "id_b", "distance"]
+    )
+
+
+def duplicate_groups(pairs):
+    """Connected groups of near-duplicate IDs, as lists."""
+    parent = {}
+
+    def find(i):
+        while parent.setdefault(i, i) != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in zip(pairs.id_a, pairs.id_b):
+        parent[find(a)] = find(b)
+    groups = {}
+    for i in parent:
+        groups.setdefault(find(i), []).append(i)
+    return [sorted(g) for g in groups.values()]
+
+
+def scan_folder(folder, suffix=".jpg", n_workers=None, max_distance=6, exclude_duplicates=False):
+    """Scan `folder` and write `scan.csv`, `duplicates.csv` and
+    `exclude.csv` into it. Returns `(scan, duplicates, exclude)`."""
+    fnames = sorted(e.path for e in os.scandir(folder) if e.name.endswith(suffix))
+    with Pool(n_workers) as pool:
+        scan = pd.DataFrame(pool.map(scan_image, fnames, chunksize=64))
+    scan.to_csv(os.path.join(folder, "scan.csv"), index=False)
+
+    hashed = scan[scan.phash.notna() & (scan.status == "ok")].reset_index(drop=True)
+    duplicates = near_duplicates(
+        hashed.id.tolist(), [int(h, 16) for h in hashed.phash], max_distance=max_distance
+    )
+    duplicates.to_csv(os.path.join(folder, "duplicates.csv"), index=False)
+
+    exclude = scan.loc[scan.status != "ok", ["id", "status"]].rename(columns={"status": "reason"})
+    if exclude_duplicates:
+        dropped = [i for g in duplicate_groups(duplicates) for i in g[1:]]
+        exclude = pd.concat([exclude, pd.DataFrame({"id": dropped, "reason": "duplicate"})])
+    exclude.to_csv(os.path.join(folder, EXCLUDE_FNAME), index=False)
+
+    return scan, duplicates, exclude
+
+
+def load_exclusions(folder=None, fname=None):
+    """Set of excluded IDs from `fname`, or from the `exclude.csv` of an
+    image folder; empty if there is none."""
+    fname = fname or (os.path.join(folder, EXCLUDE_FNAME) if folder else None)
+    if not fname or not os.path.isfile(fname):
+        return set()
+    return set(pd.read_csv(fname, dtype={"id": str})["id"])
+
+
+def drop_excluded(df, col, folder, fname=None):
+    """Drop the rows of `df` whose `col` is in the exclusion list of
+    `folder` (or `fname`)."""
+    excluded = load_exclusions(folder, fname)
+    if not excluded:
+        return df
+    keep = ~df[col].astype(str).isin(excluded)
+    print(f"Excluding {(~keep).sum()} galaxies listed in {fname or os.path.join(folder, EXCLUDE_FNAME)}")
+    return df[keep].reset_index(drop=True)
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--folder", dest="folder", default=f"{PATH}/images-OC", help="image folder")
+    parser.add_option("--suffix", dest="suffix", default=".jpg", help="image file suffix")
+    parser.add_option("--workers", dest="workers", type=int, default=None, help="worker processes")
+    parser.add_option("--max-distance", dest="max_distance", type=int, default=6, help="perceptual hash bits for near-duplicates")
+    parser.add_option(
+        "--exclude-duplicates", dest="exclude_duplicates", action="store_true", default=False,
+        help="exclude all but one image of each near-duplicate group",
+    )
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    start = time.perf_counter()
+    scan, duplicates, exclude = scan_folder(
+        opt.folder, suffix=opt.suffix, n_workers=opt.workers,
+        max_distance=opt.max_distance, exclude_duplicates=opt.exclude_duplicates,
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"Scanned {len(scan)} images in {elapsed:.1f} s ({len(scan) / elapsed:.1f} images/sec)")
+    print(scan.status.value_counts().to_string())
+    print(f"{len(duplicates)} near-duplicate pairs; {len(exclude)} images excluded "
+          f"in {os.path.join(opt.folder, EXCLUDE_FNAME)}")
+
+
+if __name__ == "__main__":
+    main()
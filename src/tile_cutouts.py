@@ -0,0 +1,469 @@
+"""
+John F. Wu
+
+Cut galaxy images out of locally mirrored survey tiles.
+
+Instead of one HTTP request per galaxy (`get_sdss_cutouts.py`,
+`get_legacy_cutouts.py`), each catalog row is assigned to the tile
+(Legacy Survey brick, or a resampled SDSS field) that contains it, and
+every tile is opened once -- as a memory-mapped FITS image or `.npy`
+array -- to slice all of its cutouts. Tiles are processed in parallel,
+and the cutouts are written either as JPEGs into an image folder or
+straight into a packed store (`packed_images.py`).
+
+Tiles are described by a table (CSV) with one row per tile:
+
+    tile, path, ra0, dec0, crpix1, crpix2, scale, naxis1, naxis2
+
+for a north-up gnomonic (TAN) projection with tangent point (ra0, dec0)
+at the 1-based reference pixel (crpix1, crpix2) and `scale` degrees per
+pixel; `tile_table` builds it from FITS headers. A tile is either one
+(H, W) or (C, H, W) image, or one file per band with the paths joined by
+";" (e.g. Legacy bricks, `legacysurvey-<brick>-image-{g,r,z}.fits.fz`,
+with `--bands z,r,g` for R, G, B). Rows start at the south edge as in
+FITS. Float arrays are converted to RGB with an asinh stretch; uint8
+arrays are used as they are.
+
+Cutouts that reach over the edge of their tile are stitched from the
+neighbouring tiles, sampling the nearest neighbour pixel at the same sky
+position (the tiles of a survey share a pixel scale but not a tangent
+point). Cutouts that are still not fully covered, i.e. at the edge of the
+mirrored footprint, are skipped unless `--min-coverage` allows them.
+
+Cutouts are `--width` x `--height` pixels at the SDSS cutout scale
+(0.396 arcsec/pixel) or `--size` pixels at `--pixscale`, resampled from
+the tile pixels when the scales differ. `--self-test` extracts cutouts
+from synthetic tiles and checks that each galaxy lands at the center.
+
+Usage:
+    python tile_cutouts.py --tiles "../bricks/*/legacysurvey-*-image-z.fits.fz" --bands z,r,g --cat ../data/a100.code12.tab1.180315.csv \
+        --id-col AGCNr --radec RAdeg_OC,DECdeg_OC --size 224 --pixscale 0.262 --output ../images-legacy
+"""
+
+from glob import glob
+from multiprocessing import Pool
+from optparse import OptionParser
+from types import SimpleNamespace
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy.spatial import cKDTree
+
+from crossmatch import radec_to_xyz
+from packed_images import store_paths, truncate_store
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SDSS_PIXSCALE = 0.396127
+
+TILE_COLUMNS = ["tile", "path", "ra0", "dec0", "crpix1", "crpix2", "scale", "naxis1", "naxis2"]
+
+
+def band_paths(path, bands):
+    """Per-band files of a tile, given the file `path` of `bands[0]` named
+    `...-{band}.fits[.fz]` (as Legacy Survey bricks are)."""
+    directory, name = os.path.split(path)
+    head, sep, tail = name.rpartition(f"-{bands[0]}.")
+    if not sep:
+        raise ValueError(f"{path} is not named like a `{bands[0]}`-band file")
+    return [os.path.join(directory, f"{head}-{b}.{tail}") for b in bands]
+
+
+def tile_table(paths, bands=None):
+    """Tile table from the headers of FITS images (TAN, north up). With
+    `bands`, `paths` are the files of the first band and every tile is
+    made of one file per band."""
+    from astropy.io import fits
+
+    rows = []
+    for path in paths:
+        h = fits.getheader(path, ext=0 if fits.getheader(path).get("NAXIS") else 1)
+        scale = abs(h.get("CD2_2", h.get("CDELT2")))
+        name = os.path.basename(path).split(".")[0]
+        if bands:
+            name = name.rpartition(f"-{bands[0]}")[0]
+            path = ";".join(band_paths(path, bands))
+        rows.append((
+            name, path, h["CRVAL1"], h["CRVAL2"],
+            h["CRPIX1"], h["CRPIX2"], scale, h["NAXIS1"], h["NAXIS2"],
+        ))
+    return pd.DataFrame(rows, columns=TILE_COLUMNS)
+
+
+def world_to_pixel(ra, dec, tile):
+    """0-based (x, y) pixel coordinates of RA/Dec (degrees) in `tile`."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(tile.ra0), np.radians(tile.dec0)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    # RA increases to the left (east)
+    x = tile.crpix1 - 1 - np.degrees(xi) / tile.scale
+    y = tile.crpix2 - 1 + np.degrees(eta) / tile.scale
+    return x, y
+
+
+def pixel_to_world(x, y, tile):
+    """RA/Dec (degrees) of 0-based pixel coordinates in `tile`; the
+    inverse of `world_to_pixel`."""
+    xi = np.radians((tile.crpix1 - 1 - np.asarray(x, dtype=np.float64)) * tile.scale)
+    eta = np.radians((np.asarray(y, dtype=np.float64) - tile.crpix2 + 1) * tile.scale)
+    ra0, dec0 = np.radians(tile.ra0), np.radians(tile.dec0)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360, np.degrees(dec)
+
+
+def tile_centers(tiles):
+    """(N, 2) approximate RA/Dec of the tile centers."""
+    centers = []
+    for t in tiles.itertuples():
+        x_c, y_c = (t.naxis1 - 1) / 2, (t.naxis2 - 1) / 2
+        # tile centers from the reference pixel and scale, close enough for ranking
+        centers.append((t.ra0 - (x_c - t.crpix1 + 1) * t.scale / np.cos(np.radians(t.dec0)),
+                        t.dec0 + (y_c - t.crpix2 + 1) * t.scale))
+    return np.array(centers)
+
+
+def tile_neighbours(tiles):
+    """For each tile, the indices of the other tiles whose centers are
+    close enough for them to overlap a cutout reaching over its edge."""
+    centers = tile_centers(tiles)
+    xyz = radec_to_xyz(centers[:, 0], centers[:, 1])
+    extent = np.radians((np.maximum(tiles.naxis1, tiles.naxis2) * tiles.scale).to_numpy().max())
+    near = cKDTree(xyz).query_ball_point(xyz, 1.5 * extent)
+    return [[j for j in sorted(n) if j != i] for i, n in enumerate(near)]
+
+
+def assign_tiles(ra, dec, tiles, n_candidates=4):
+    """Index of the tile containing each position, chosen among the
+    tiles with the nearest centers as the one where the position is
+    farthest from the edge; -1 if none contains it."""
+    centers = tile_centers(tiles)
+    tree = cKDTree(radec_to_xyz(centers[:, 0], centers[:, 1]))
+    k = min(n_candidates, len(tiles))
+    _, cand = tree.query(radec_to_xyz(ra, dec), k=k)
+    cand = cand.reshape(len(ra), k)
+
+    best = np.full(len(ra), -1)
+    margin = np.full(len(ra), -np.inf)
+    for j in range(k):
+        t = SimpleNamespace(**{c: tiles[c].to_numpy()[cand[:, j]] for c in TILE_COLUMNS[2:]})
+        x, y = world_to_pixel(ra, dec, t)
+        m = np.minimum.reduce([x, y, t.naxis1 - 1 - x, t.naxis2 - 1 - y])
+        better = (m >= 0) & (m > margin)
+        best[better], margin[better] = cand[better, j], m[better]
+    return best
+
+
+class _Section:
+    """2-d FITS image read lazily through `hdu.section`, which for tiled
+    compressed (.fits.fz) images decompresses only the tiles overlapping a
+    slice."""
+
+    def __init__(self, hdul, hdu):
+        self.hdul, self.section = hdul, hdu.section  # keep the file open
+        self.shape = (hdu.header["NAXIS2"], hdu.header["NAXIS1"])
+        self.dtype = np.asarray(self.section[0:1, 0:1]).dtype
+
+    def __getitem__(self, key):
+        return np.asarray(self.section[key])
+
+
+class BandStack:
+    """Lazy (C, H, W) view of one 2-d image per band. Indexing with
+    `[:, ys, xs]` (slices, or integer arrays of pixel coordinates) reads
+    only those pixels of every band."""
+
+    def __init__(self, bands):
+        self.bands = bands
+        self.shape = (len(bands),) + tuple(bands[0].shape[-2:])
+        self.dtype = np.result_type(*[b.dtype for b in bands])
+
+    def __getitem__(self, key):
+        _, ys, xs = key
+        if isinstance(ys, slice):
+            return np.stack([np.asarray(b[ys, xs], dtype=self.dtype) for b in self.bands])
+        # pixel lists: read their bounding box from each band
+        y0, x0 = ys.min(), xs.min()
+        box = (slice(y0, ys.max() + 1), slice(x0, xs.max() + 1))
+        return np.stack([np.asarray(b[box], dtype=self.dtype)[ys - y0, xs - x0] for b in self.bands])
+
+
+def _open_band(path):
+    """Memory-mapped (or, if compressed, lazily decompressed) 2-d image."""
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    from astropy.io import fits
+
+    hdul = fits.open(path, memmap=True)
+    hdu = next(h for h in hdul if h.header.get("NAXIS", 0) >= 2)
+    if isinstance(hdu, fits.CompImageHDU):
+        return _Section(hdul, hdu)
+    return hdu.data
+
+
+def open_tile(path):
+    """Memory-mapped (C, H, W) view of a FITS or .npy tile; a tile of
+    per-band files (paths joined by ";") is a `BandStack` of them."""
+    if ";" in path:
+        return BandStack([_open_band(p) for p in path.split(";")])
+    if path.endswith(".npy"):
+        data = np.load(path, mmap_mode="r")
+    else:
+        from astropy.io import fits
+
+        with fits.open(path, memmap=True) as hdul:
+            hdu = next(h for h in hdul if h.data is not None)
+            data = hdu.data
+    return data[None] if data.ndim == 2 else data
+
+
+def to_rgb(cutout, stretch=0.5, q=10.0):
+    """(3, H, W) uint8 from a uint8 or float (C, H, W) cutout, with an
+    asinh stretch for floats. Single bands are repeated."""
+    if cutout.shape[0] == 1:
+        cutout = np.repeat(cutout, 3, axis=0)
+    if cutout.dtype == np.uint8:
+        return cutout
+    x = np.arcsinh(q * np.clip(cutout, 0, None) / stretch) / q
+    return (np.clip(x, 0, 1) * 255).round().astype(np.uint8)
+
+
+def extract(data, x, y, n_src, n_out=None, tile=None, neighbours=()):
+    """`n_src` x `n_src` (C, H, W) cutout centered on (x, y), flipped north
+    up and resized to `n_out`. Pixels outside the tile are taken from the
+    `(data, tile)` pairs of `neighbours` (which needs `tile`) or left at
+    zero. Returns the cutout and the fraction of pixels covered."""
+    C, H, W = data.shape
+    x0, y0 = int(round(x - n_src / 2)), int(round(y - n_src / 2))
+    out = np.zeros((C, n_src, n_src), dtype=data.dtype)
+    covered = np.zeros((n_src, n_src), dtype=bool)
+    xs, ys = slice(max(x0, 0), min(x0 + n_src, W)), slice(max(y0, 0), min(y0 + n_src, H))
+    if xs.start < xs.stop and ys.start < ys.stop:
+        out[:, ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0] = data[:, ys, xs]
+        covered[ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0] = True
+
+    if neighbours and not covered.all():
+        # nearest pixel at the same sky position in the neighbouring tiles
+        yy, xx = np.nonzero(~covered)
+        ra, dec = pixel_to_world(x0 + xx, y0 + yy, tile)
+        for n_data, n_tile in neighbours:
+            nx, ny = world_to_pixel(ra, dec, n_tile)
+            nx, ny = np.round(nx).astype(int), np.round(ny).astype(int)
+            inside = (nx >= 0) & (nx < n_data.shape[2]) & (ny >= 0) & (ny < n_data.shape[1])
+            if inside.any():
+                out[:, yy[inside], xx[inside]] = n_data[:, ny[inside], nx[inside]]
+                covered[yy[inside], xx[inside]] = True
+                yy, xx, ra, dec = yy[~inside], xx[~inside], ra[~inside], dec[~inside]
+            if not len(yy):
+                break
+
+    out = out[:, ::-1]
+    if n_out is not None and n_out != n_src:
+        resized = np.stack([
+            np.asarray(Image.fromarray(np.ascontiguousarray(band, dtype=np.float32)).resize(
+                (n_out, n_out), Image.BILINEAR))
+            for band in out
+        ])
+        if out.dtype == np.uint8:
+            resized = np.clip(resized.round(), 0, 255)
+        out = resized.astype(out.dtype)
+    return out, covered.mean()
+
+
+def _cut_tile(args):
+    """Worker: all cutouts `(id, ra, dec)` of one tile, as `(id, (3, H, W)
+    uint8 or None if written to the folder, ok)`; `ok` is False for
+    cutouts below `min_coverage`."""
+    tile, neighbour_tiles, rows, size, pixscale, folder, stretch, q, min_coverage = args
+    data = open_tile(tile.path)
+    n_src = int(round(size * pixscale / 3600 / tile.scale))
+    neighbours = None
+    results = []
+    for id_, ra, dec in rows:
+        x, y = world_to_pixel(ra, dec, tile)
+        at_edge = min(x, y, tile.naxis1 - 1 - x, tile.naxis2 - 1 - y) < n_src / 2 + 1
+        if at_edge and neighbours is None:
+            # opened once per task, only if a cutout needs them
+            neighbours = [(open_tile(t.path), t) for t in neighbour_tiles]
+        cut, coverage = extract(
+            data, x, y, n_src, n_out=size, tile=tile, neighbours=neighbours if at_edge else ()
+        )
+        if coverage < min_coverage:
+            results.append((id_, None, False))
+            continue
+        img = to_rgb(cut, stretch=stretch, q=q)
+        if folder is not None:
+            Image.fromarray(img.transpose(1, 2, 0)).save(f"{folder}/{id_}.jpg", quality=95)
+            img = None
+        results.append((id_, img, True))
+    return results
+
+
+def cut_catalog(ids, ra, dec, tiles, size, pixscale, output, packed=False, n_workers=None,
+                stretch=0.5, q=10.0, min_coverage=1.0):
+    """Cut `size` x `size` images at `pixscale` arcsec/pixel for each
+    catalog position and write them to the folder `output` or, with
+    `packed`, to a packed store at prefix `output`. Returns the list of IDs
+    written; positions outside every tile, and cutouts of which less than
+    `min_coverage` is covered by the tiles, are skipped."""
+    ids = [str(i) for i in ids]
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    which = assign_tiles(ra, dec, tiles)
+
+    folder = None if packed else output
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+    neighbours = tile_neighbours(tiles)
+    tasks = [
+        (tiles.iloc[t], [tiles.iloc[n] for n in neighbours[t]],
+         [(ids[i], ra[i], dec[i]) for i in np.flatnonzero(which == t)],
+         size, pixscale, folder, stretch, q, min_coverage)
+        for t in np.unique(which[which >= 0])
+    ]
+
+    arr, written = None, []
+    if packed:
+        array_fn, index_fn = store_paths(output)
+        os.makedirs(os.path.dirname(os.path.abspath(array_fn)), exist_ok=True)
+        arr = np.lib.format.open_memmap(
+            f"{array_fn}.part", mode="w+", dtype=np.uint8, shape=(len(ids), 3, size, size)
+        )
+
+    with Pool(n_workers) as pool:
+        for results in pool.imap_unordered(_cut_tile, tasks):
+            for id_, img, ok in results:
+                if not ok:
+                    continue  # not covered by the tiles
+                if arr is not None:
+                    arr[len(written)] = img
+                written.append(id_)
+
+    if arr is not None:
+        arr.flush()
+        del arr
+        truncate_store(f"{array_fn}.part", len(written))
+        os.replace(f"{array_fn}.part", array_fn)
+        pd.DataFrame({"id": written}).to_csv(index_fn, index=False)
+    return written
+
+
+def make_synthetic_tiles(directory, n_side=2, npix=512, scale=0.262 / 3600, ra0=180.0, dec0=10.0,
+                         bands=("g", "r", "z"), background=0.1):
+    """Write an `n_side` x `n_side` grid of adjoining float tiles, one .npy
+    file per band, to `directory` and return their tile table."""
+    rows = []
+    for i in range(n_side):
+        for j in range(n_side):
+            dec_c = dec0 + (j - (n_side - 1) / 2) * npix * scale
+            ra_c = ra0 + (i - (n_side - 1) / 2) * npix * scale / np.cos(np.radians(dec_c))
+            paths = [os.path.join(directory, f"tile-{i}-{j}-{b}.npy") for b in bands]
+            for path in paths:
+                np.save(path, np.full((npix, npix), background, dtype=np.float32))
+            rows.append((f"tile-{i}-{j}", ";".join(paths), ra_c, dec_c, (npix + 1) / 2, (npix + 1) / 2,
+                         scale, npix, npix))
+    return pd.DataFrame(rows, columns=TILE_COLUMNS)
+
+
+def self_test(n_galaxies=50, size=64, seed=0):
+    """Place point sources at random positions in synthetic tiles and
+    check that every cutout has its source at the center, and that a
+    cutout across the corner shared by four tiles is stitched without
+    gaps."""
+    rng = np.random.RandomState(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        tiles = make_synthetic_tiles(tmp)
+        scale = tiles.scale[0]
+        span = scale * tiles.naxis1[0] * 0.8
+        ra = 180.0 + rng.uniform(-span, span, n_galaxies)
+        dec = 10.0 + rng.uniform(-span, span, n_galaxies)
+        # two pixels from the corner shared by all four tiles
+        ra[0], dec[0] = 180.0 + 2 * scale / np.cos(np.radians(10.0)), 10.0 + 2 * scale
+
+        which = assign_tiles(ra, dec, tiles)
+        for t, tile in tiles.iterrows():
+            for path in tile.path.split(";"):
+                data = np.load(path)
+                for i in np.flatnonzero(which == t):
+                    x, y = world_to_pixel(ra[i], dec[i], tile)
+                    data[int(round(y)), int(round(x))] = 1.0
+                np.save(path, data)
+
+        written = cut_catalog(
+            range(n_galaxies), ra, dec, tiles, size, scale * 3600,
+            os.path.join(tmp, "store"), packed=True, n_workers=2,
+        )
+        from packed_images import PackedImageStore
+
+        store = PackedImageStore(os.path.join(tmp, "store"))
+        for i in written:
+            img = np.asarray(store[i])
+            peak = np.unravel_index(img[0].argmax(), img[0].shape)
+            assert max(abs(peak[0] - size / 2), abs(peak[1] - size / 2)) <= 1, f"{i}: source at {peak}"
+        assert "0" in written, "corner cutout was not stitched"
+        assert np.asarray(store["0"]).min() > 0, "corner cutout has unfilled pixels"
+    print(f"Self-test passed: {len(written)}/{n_galaxies} cutouts centered on their source "
+          f"({n_galaxies - len(written)} off the mirrored footprint skipped)")
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--tiles", dest="tiles", default="", help="tile table CSV, or a glob of FITS tiles")
+    parser.add_option("--bands", dest="bands", default="", help="comma-separated bands of per-band tile files (R,G,B order); the glob matches the first")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/a100.code12.tab1.180315.csv", help="catalog CSV")
+    parser.add_option("--id-col", dest="id_col", default="AGCNr", help="ID column of the catalog")
+    parser.add_option("--radec", dest="radec", default="RAdeg_OC,DECdeg_OC", help="RA,Dec columns of the catalog")
+    parser.add_option("--width", dest="width", type=int, default=None, help="width of SDSS-scale cutouts")
+    parser.add_option("--height", dest="height", type=int, default=None, help="height of SDSS-scale cutouts")
+    parser.add_option("--size", dest="size", type=int, default=224, help="size of cutouts at --pixscale")
+    parser.add_option("--pixscale", dest="pixscale", type=float, default=0.262, help="arcsec per cutout pixel")
+    parser.add_option("--stretch", dest="stretch", type=float, default=0.5, help="asinh stretch for float tiles")
+    parser.add_option("--output", dest="output", default=f"{PATH}/images-legacy", help="image folder or store prefix")
+    parser.add_option("--packed", dest="packed", action="store_true", default=False, help="write a packed store")
+    parser.add_option("--min-coverage", dest="min_coverage", type=float, default=1.0, help="skip cutouts less covered by the tiles")
+    parser.add_option("--workers", dest="workers", type=int, default=None, help="worker processes")
+    parser.add_option("--self-test", dest="self_test", action="store_true", default=False, help="run on synthetic tiles")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+    if opt.self_test:
+        self_test()
+        return
+
+    if opt.tiles.endswith(".csv"):
+        tiles = pd.read_csv(opt.tiles)
+    else:
+        tiles = tile_table(sorted(glob(opt.tiles)), bands=opt.bands.split(",") if opt.bands else None)
+
+    size, pixscale = opt.size, opt.pixscale
+    if opt.width or opt.height:
+        if (opt.width or opt.height) != (opt.height or opt.width):
+            raise SystemExit("Only square cutouts are supported")
+        size, pixscale = opt.width or opt.height, SDSS_PIXSCALE
+
+    ra_col, dec_col = opt.radec.split(",")
+    df = pd.read_csv(opt.cat, usecols=[opt.id_col, ra_col, dec_col])
+    written = cut_catalog(
+        df[opt.id_col], df[ra_col], df[dec_col], tiles, size, pixscale,
+        opt.output.rstrip("/"), packed=opt.packed, n_workers=opt.workers, stretch=opt.stretch,
+        min_coverage=opt.min_coverage,
+    )
+    print(f"Cut {len(written)} of {len(df)} galaxies from {len(tiles)} tiles into {opt.output}")
+
+
+if __name__ == "__main__":
+    main()
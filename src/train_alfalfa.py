@@ -3,6 +3,11 @@ John F. Wu
 
 Train a deep convnet to predict gas mass fraction using the ALFALFA a.40
 data set. Saves the best model in the `{PATH}/models` directory.
+
+Runs data-parallel on several CPU processes or nodes when launched with
+`torchrun` or `distributed.py`. Deep models at large image sizes fit in
+less memory with `--checkpoint-stages` and `--accum-steps` (see
+`bench_memory.py` for the trade-off against step time).
 """
 
 
@@ -18,7 +23,18 @@ PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(f"{PATH}/src")
 
 from mxresnet import *
-from ranger import Ranger
+from ranger import Ranger, RangerForeach
+from packed_images import PackedImageList
+from image_cache import cached_store
+from checkpoint import CheckpointCallback, load_checkpoint
+from instrument import PhaseTimer, ProfilerCallback
+from batch_augment import add_batch_tfms
+from scan_cutouts import drop_excluded
+from accumulate import GradientAccumulation
+from distributed import (
+    DistributedCPUTrainer, broadcast_checkpoint, init_distributed, is_distributed, is_main_process,
+    local_main_first, seed_rank,
+)
 
 
 xGASS_stats = [tensor([-0.0169, -0.0105, -0.0004]), tensor([0.9912, 0.9968, 1.0224])]
@@ -49,12 +65,96 @@ def command_line():
     parser.add_option("--n_epochs", dest="n_epochs", type=int, default=100, help="number of epochs")
     parser.add_option("--lr", dest="lr", type=float, default=3e-2, help="maximum learning rate")
     parser.add_option("--model", dest="model", type=str, default="mxresnet50", help="convnet architecture")
+    parser.add_option(
+        "--act",
+        dest="act",
+        type=str,
+        default="mish",
+        help="activation: `mish`, `memory_efficient` or `jit` (fused Mish), or `relu`"
+    )
     parser.add_option(
         "--catalog",
         dest="catalog",
         default="fgas",
         help="Load catalog with only `fgas`, or `all` galaxy properties"
     )
+    parser.add_option(
+        "--foreach",
+        dest="foreach",
+        action="store_true",
+        default=False,
+        help="use the multi-tensor `RangerForeach` optimizer step"
+    )
+    parser.add_option(
+        "--packed",
+        dest="packed",
+        type=str,
+        default="",
+        help="prefix of a packed image store (see `packed_images.py`)"
+    )
+    parser.add_option(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=True,
+        help="decode JPEGs every epoch instead of using the pre-resized cache"
+    )
+    parser.add_option(
+        "--batch-tfms",
+        dest="batch_tfms",
+        action="store_true",
+        default=False,
+        help="augment and normalize whole batches on-tensor instead of per item"
+    )
+    parser.add_option(
+        "--checkpoint-stages",
+        dest="checkpoint_stages",
+        action="store_true",
+        default=False,
+        help="recompute the activations of each MXResNet stage in backward to save memory"
+    )
+    parser.add_option(
+        "--accum-steps",
+        dest="accum_steps",
+        type=int,
+        default=1,
+        help="accumulate gradients over N batches of `--bs` per optimizer step"
+    )
+    parser.add_option(
+        "--checkpoint-every",
+        dest="checkpoint_every",
+        type=int,
+        default=1,
+        help="save a resumable checkpoint every N epochs (0 to disable)"
+    )
+    parser.add_option(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help="resume training from the last checkpoint, if there is one"
+    )
+    parser.add_option(
+        "--instrument",
+        dest="instrument",
+        type=str,
+        default="",
+        help="write per-batch phase timings to this JSONL file"
+    )
+    parser.add_option(
+        "--profile-steps",
+        dest="profile_steps",
+        type=int,
+        default=0,
+        help="record a `torch.profiler` trace of this many training steps"
+    )
+    parser.add_option(
+        "--profile-start",
+        dest="profile_start",
+        type=int,
+        default=10,
+        help="training steps to skip before profiling"
+    )
     parser.add_option(
         "--save",
         dest="save_fname",
@@ -80,58 +180,82 @@ def load_df(all_properties):
         return pd.read_csv(f"{PATH}/data/a40-SDSS_gas-frac.csv")
 
 
-if __name__ == "__main__":
-
-    # load options
-    opt, args = command_line()
+def get_learner(opt):
+    """Build the DataBunch and `Learner` described by the command line
+    options `opt`.
+    """
 
     # load DataBunch
     all_properties = (opt.catalog == "all")
     df = load_df(all_properties=all_properties)
     print(f"Loaded `{opt.catalog}` catalog of length {len(df)}")
 
-    src = (
-        ImageList.from_df(
+    # skip images flagged by `scan_cutouts.py`
+    df = drop_excluded(df, "AGCNr", f"{PATH}/images-OC")
+
+    if opt.packed:
+        items = PackedImageList.from_df(df, path=PATH, cols="AGCNr", store=opt.packed)
+    elif opt.cache:
+        # one process per node builds the cache, the others wait and open it
+        with local_main_first():
+            store = cached_store(df.AGCNr, f"{PATH}/images-OC", opt.sz)
+        items = PackedImageList.from_df(df, path=PATH, cols="AGCNr", store=store)
+    else:
+        items = ImageList.from_df(
             df, path=PATH, folder="images-OC", suffix=".jpg", cols="AGCNr"
         )
+
+    src = (
+        items
         .split_by_rand_pct(opt.val_pct, seed=opt.seed)
         .label_from_df(cols=["logfgas"], label_cls=FloatList)
     )
 
-    data = (
-        src.transform(tfms, size=opt.sz)
-        .databunch(bs=opt.bs)
-        .normalize(xGASS_stats)
-    )
+    if opt.batch_tfms:
+        # flips, rotations and normalization are applied to whole batches
+        data = add_batch_tfms(
+            src.transform(([], []), size=opt.sz).databunch(bs=opt.bs),
+            xGASS_stats,
+            max_rotate=15.0,
+            flip_vert=True,
+        )
+    else:
+        data = (
+            src.transform(tfms, size=opt.sz)
+            .databunch(bs=opt.bs)
+            .normalize(xGASS_stats)
+        )
 
     # select model
     if opt.model in ["mxresnet18", "18"]:
-        model = mxresnet18()
+        model = mxresnet18(act=opt.act, checkpoint_stages=opt.checkpoint_stages)
     elif opt.model in ["mxresnet34", "34"]:
-        model = mxresnet34()
+        model = mxresnet34(act=opt.act, checkpoint_stages=opt.checkpoint_stages)
     elif opt.model in ["mxresnet50", "50"]:
-        model = mxresnet50()
+        model = mxresnet50(act=opt.act, checkpoint_stages=opt.checkpoint_stages)
     elif opt.model in ["mxresnet101", "101"]:
-        model = mxresnet101()
+        model = mxresnet101(act=opt.act, checkpoint_stages=opt.checkpoint_stages)
     elif opt.model in ["mxresnet152", "152"]:
-        model = mxresnet152()
+        model = mxresnet152(act=opt.act, checkpoint_stages=opt.checkpoint_stages)
     else:
         sys.exit("Please specify a valid model of the `mxresnet` variant")
 
     # reformulate model to output single regression
-    model[-1] = nn.Linear(model[-1].in_features, 1, bias=True).cuda()
+    model[-1] = nn.Linear(model[-1].in_features, 1, bias=True)
 
     # initialize Fastai learner
     learn = Learner(
         data,
         model=model,
-        opt_func=partial(Ranger),
+        opt_func=partial(RangerForeach if opt.foreach else Ranger),
         loss_func=root_mean_squared_error,
         wd=1e-3,
         bn_wd=False,
         true_wd=True,
     )
 
+    if opt.precision == "mixed" and opt.accum_steps > 1:
+        sys.exit("Gradient accumulation is not supported with mixed precision.")
     if opt.precision == "mixed":
         learn.to_fp16()
     elif opt.precision == "full":
@@ -139,13 +263,66 @@ if __name__ == "__main__":
     else:
         sys.exit("Please specify mixed or full floating-point precision.")
 
+    return learn
+
+
+def train(learn, opt):
+    """Run the one-cycle schedule (resuming from a checkpoint if asked to)
+    and save the final model.
+    """
+
+    # checkpoints are kept next to the saved model, e.g. `models/best_a40-checkpoint.pth`
+    checkpoint_fname = learn.path/learn.model_dir/f"{opt.save_fname}-checkpoint.pth"
+    checkpoint_fname.parent.mkdir(parents=True, exist_ok=True)
+
+    start_epoch = None
+    if opt.resume and is_distributed():
+        # rank 0 reads the checkpoint and broadcasts it to the other ranks
+        start_epoch = broadcast_checkpoint(learn, checkpoint_fname, lr=opt.lr)
+    elif opt.resume and checkpoint_fname.is_file():
+        start_epoch = load_checkpoint(learn, checkpoint_fname, lr=opt.lr)
+    if start_epoch is not None:
+        print(f"Resuming from {checkpoint_fname} after epoch {start_epoch}")
+
+    if is_distributed():
+        # same split and initial weights everywhere, different augmentations
+        seed_rank(opt.seed, offset=start_epoch or 0)
+
+    callbacks = []
+    if is_distributed():
+        callbacks.append(DistributedCPUTrainer(learn))
+    if opt.checkpoint_every > 0 and is_main_process():
+        callbacks.append(CheckpointCallback(learn, checkpoint_fname, every=opt.checkpoint_every))
+    if opt.accum_steps > 1:
+        callbacks.append(GradientAccumulation(learn, opt.accum_steps))
+    # timings and traces of rank 0 only; the ranks would share the files
+    if opt.instrument and is_main_process():
+        callbacks.append(PhaseTimer(learn, opt.instrument))
+    if opt.profile_steps > 0 and is_main_process():
+        trace_fname = f"{PATH}/results/profile/{opt.save_fname}-trace.json"
+        callbacks.append(
+            ProfilerCallback(learn, trace_fname, start=opt.profile_start, n_steps=opt.profile_steps)
+        )
+
     # train (do not keep track of best model)
     learn.fit_one_cycle(
             cyc_len=opt.n_epochs,
             max_lr=opt.lr,
+            start_epoch=start_epoch,
+            callbacks=callbacks,
         )
     
-    if (opt.save_fname != "") and (opt.save_fname.lower() != "none"):
+    if (opt.save_fname != "") and (opt.save_fname.lower() != "none") and is_main_process():
         learn.save(opt.save_fname)
-        
-        
+
+
+if __name__ == "__main__":
+
+    # load options
+    opt, args = command_line()
+
+    # join the process group if launched with `torchrun` (see `distributed.py`)
+    init_distributed()
+
+    learn = get_learner(opt)
+    train(learn, opt)
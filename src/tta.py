@@ -0,0 +1,156 @@
+"""
+John F. Wu
+
+Batched test-time augmentation (TTA) for MXResNet.
+
+Galaxy images have no preferred orientation, and the training `tfms` use
+flips and +/-15 deg rotations. Rather than decoding every image once per
+augmentation (as repeated `learn.get_preds` runs would), `TTAModel`
+expands an already-decoded batch on-tensor into the 8 dihedral variants
+(4 quarter turns, with and without a flip) plus optional small rotations,
+runs them through the network as one enlarged batch and averages the
+predictions per galaxy.
+
+`predict.py --tta dihedral` uses it for catalog inference; this script
+reports the latency overhead against plain inference.
+
+Usage:
+    python tta.py --cat ../data/NIBLES_clean.csv --cols nibles_id \
+        --images ../images-nibles --weights ../models/best_a40.pth --tta dihedral
+"""
+
+from optparse import OptionParser
+import math
+import os
+import time
+
+import pandas as pd
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from predict import load_model, make_loader, open_images
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+TTA_MODES = ["none", "flip", "dihedral", "dihedral+rot"]
+
+
+def dihedral(x):
+    """The 8 dihedral variants of a (B, C, H, W) batch, as (8 * B, C, H, W),
+    grouped by variant."""
+    flipped = x.flip(-1)
+    return torch.cat(
+        [torch.rot90(t, k, dims=(-2, -1)) for t in (x, flipped) for k in range(4)]
+    )
+
+
+def rotate(x, angles):
+    """Rotations of a (B, C, H, W) batch by each of `angles` (degrees), as
+    (len(angles) * B, C, H, W), with reflection padding like fastai's
+    `rotate` transform."""
+    B = len(x)
+    theta = []
+    for a in angles:
+        c, s = math.cos(math.radians(a)), math.sin(math.radians(a))
+        theta.append(torch.tensor([[c, -s, 0.0], [s, c, 0.0]], dtype=x.dtype).expand(B, 2, 3))
+    theta = torch.cat(theta)
+    xs = x.repeat(len(angles), 1, 1, 1)
+    grid = F.affine_grid(theta, xs.shape, align_corners=False)
+    return F.grid_sample(xs, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+
+
+def augment(x, mode="dihedral", angles=(-15, 15)):
+    """Stack the TTA variants of `x` for one of `TTA_MODES`."""
+    if mode == "none":
+        return x
+    if mode == "flip":
+        return torch.cat([x, x.flip(-1)])
+    if mode == "dihedral":
+        return dihedral(x)
+    if mode == "dihedral+rot":
+        return torch.cat([dihedral(x), rotate(x, angles)])
+    raise ValueError(f"Unknown TTA mode: {mode}")
+
+
+class TTAModel(nn.Module):
+    """Wrap `model` so that each forward pass averages its output over the
+    TTA variants of the batch. With `return_std`, also returns the spread
+    across variants."""
+
+    def __init__(self, model, mode="dihedral", angles=(-15, 15), return_std=False):
+        super().__init__()
+        self.model = model
+        self.mode = mode
+        self.angles = angles
+        self.return_std = return_std
+
+    def forward(self, x):
+        B = len(x)
+        out = self.model(augment(x, self.mode, self.angles))
+        out = out.view(-1, B, *out.shape[1:])
+        if self.return_std:
+            return out.mean(0), out.std(0)
+        return out.mean(0)
+
+
+@torch.no_grad()
+def time_batches(model, batches):
+    """Forward-pass seconds per batch, summed over `batches`."""
+    model(batches[0])
+    start = time.perf_counter()
+    for xb in batches:
+        model(xb)
+    return time.perf_counter() - start
+
+
+def cmdline():
+    """ Controls the command line argument handling for this little program.
+    """
+
+    parser = OptionParser(usage="usage:\t %prog [options]\n")
+    parser.add_option("--cat", dest="cat", default=f"{PATH}/data/NIBLES_clean.csv", help="catalog CSV")
+    parser.add_option("--cols", dest="cols", default="nibles_id", help="ID column of the catalog")
+    parser.add_option("--images", dest="images", default=f"{PATH}/images-nibles", help="image folder or packed store prefix")
+    parser.add_option("--model", dest="model", default="mxresnet50", help="convnet architecture")
+    parser.add_option("--act", dest="act", default="mish", help="activation the model was built with")
+    parser.add_option("--weights", dest="weights", default=f"{PATH}/models/best_a40.pth", help="trained weights")
+    parser.add_option("--tta", dest="tta", default="dihedral", help=f"one of {', '.join(TTA_MODES)}")
+    parser.add_option("--sz", dest="sz", type=int, default=224, help="image size")
+    parser.add_option("--bs", dest="bs", type=int, default=16, help="batch size (before expansion)")
+    parser.add_option("--n", dest="n", type=int, default=256, help="number of galaxies to time")
+
+    (options, args) = parser.parse_args()
+
+    return options, args
+
+
+def main():
+
+    opt, arg = cmdline()
+
+    model = load_model(opt.model, opt.weights, act=opt.act)
+    tta_model = TTAModel(model, mode=opt.tta).eval()
+
+    ids = pd.read_csv(opt.cat, usecols=[opt.cols], nrows=opt.n)[opt.cols].tolist()
+    loader = make_loader(ids, open_images(opt.images), sz=opt.sz, bs=opt.bs)
+
+    # decode once, then time only the forward passes
+    start = time.perf_counter()
+    batches = [xb for xb, ok in loader]
+    t_decode = time.perf_counter() - start
+
+    t_plain = time_batches(model, batches)
+    t_tta = time_batches(tta_model, batches)
+    n_variants = len(augment(batches[0][:1], opt.tta))
+
+    print(f"{len(ids)} galaxies, bs={opt.bs}, {n_variants} variants, {torch.get_num_threads()} threads")
+    print(f"Decoding:         {t_decode:.2f} s (shared)")
+    print(f"Plain inference:  {t_plain:.2f} s ({len(ids) / t_plain:.1f} images/sec)")
+    print(f"TTA inference:    {t_tta:.2f} s ({len(ids) / t_tta:.1f} images/sec)")
+    print(f"TTA overhead:     {t_tta / t_plain:.2f}x forward, "
+          f"{(t_decode + t_tta) / (t_decode + t_plain):.2f}x end-to-end")
+
+
+if __name__ == "__main__":
+    main()